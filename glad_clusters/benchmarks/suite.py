@@ -0,0 +1,217 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import numpy as np
+import imageio as io
+from glad_clusters.clusters.meanshift import MShift
+from glad_clusters.clusters.convex_hull import ConvexHull
+import glad_clusters.clusters.processors as proc
+import glad_clusters.benchmarks.tiles as tiles
+
+
+DIR=os.path.dirname(os.path.abspath(__file__))
+BASELINES_PATH=os.path.join(DIR,'baselines.json')
+DEFAULT_REPEAT=3
+DEFAULT_THRESHOLD=1.25
+DEFAULT_WIDTH=5
+DEFAULT_MIN_COUNT=25
+DEFAULT_ITERATIONS=25
+DEFAULT_THREADS=4
+START_DATE='2016-01-01'
+END_DATE='2017-01-01'
+TIMINGS=['glad_between_dates','meanshift','meanshift_threads','convex_hull']
+RESULTS=['nb_alerts','nb_clusters','total_count']
+TIERS={
+    'sparse': {
+        'nb_clusters': 2,
+        'cluster_size': 40,
+        'noise_density': 0.0005 },
+    'medium': {
+        'nb_clusters': 8,
+        'cluster_size': 80,
+        'noise_density': 0.002 },
+    'dense': {
+        'nb_clusters': 20,
+        'cluster_size': 120,
+        'noise_density': 0.005 }}
+
+
+def run(tiers=None,
+        repeat=DEFAULT_REPEAT,
+        width=DEFAULT_WIDTH,
+        min_count=DEFAULT_MIN_COUNT,
+        iterations=DEFAULT_ITERATIONS,
+        tile_dir=None):
+    """ benchmark the clustering hot path
+
+        For each density tier a synthetic tile is written to png,
+        read back and timed through glad_between_dates, MShift
+        and ConvexHull (the best of `repeat` runs is kept). MShift
+        is also timed with threads=DEFAULT_THREADS and threads_match
+        is set if it clusters the points as the default update.
+
+        Args:
+            tiers<list>: names of tiers to run (default all TIERS)
+            repeat<int>: number of timed repeats
+            width,min_count,iterations<int>: MShift params
+            tile_dir<str>: if set keep the png tiles in this folder
+
+        Returns:
+            dict of results keyed by tier
+    """
+    tiers=tiers or sorted(TIERS.keys())
+    folder=tile_dir or tempfile.mkdtemp()
+    results={}
+    try:
+        for tier in tiers:
+            path=tiles.write_tile(
+                tiles.synthetic_tile(
+                    start_date=START_DATE,
+                    end_date=END_DATE,
+                    **TIERS[tier]),
+                os.path.join(folder,'{}.png'.format(tier)))
+            results[tier]=_run_tier(
+                io.imread(path),repeat,width,min_count,iterations)
+    finally:
+        if not tile_dir: shutil.rmtree(folder)
+    return results
+
+
+def compare(results,baselines,threshold=DEFAULT_THRESHOLD):
+    """ compare results against baselines
+
+        Args:
+            results<dict>: output of run
+            baselines<dict>: stored results
+            threshold<float>: max allowed ratio of time/baseline-time
+
+        Returns:
+            list of regression messages (empty if none)
+    """
+    regressions=[]
+    for tier,result in sorted(results.items()):
+        if not result.get('threads_match',True):
+            regressions.append('{}.threads_match: threaded MShift results differ'.format(
+                tier))
+        baseline=baselines.get(tier)
+        if not baseline:
+            continue
+        for key in RESULTS:
+            if result[key]!=baseline.get(key,result[key]):
+                regressions.append('{}.{}: {} (baseline {})'.format(
+                    tier,key,result[key],baseline[key]))
+        for key in TIMINGS:
+            if baseline.get(key):
+                ratio=result[key]/baseline[key]
+                if ratio>threshold:
+                    regressions.append('{}.{}: {:.4f}s is {:.2f}x baseline'.format(
+                        tier,key,result[key],ratio))
+    return regressions
+
+
+def read_baselines(path=BASELINES_PATH):
+    if os.path.exists(path):
+        with open(path) as file:
+            return json.load(file)
+    return {}
+
+
+def write_baselines(results,path=BASELINES_PATH):
+    with open(path,'w') as file:
+        json.dump(results,file,indent=4,sort_keys=True)
+    return path
+
+
+#
+# INTERNAL
+#
+def _run_tier(im,repeat,width,min_count,iterations):
+    days,t_dates=_time(
+        lambda: proc.glad_between_dates(im,START_DATE,END_DATE),repeat)
+    mshift,t_mshift=_time(
+        lambda: _clustered(days,width,min_count,iterations),repeat)
+    threaded,t_threads=_time(
+        lambda: _clustered(days,width,min_count,iterations,DEFAULT_THREADS),
+        repeat)
+    alerts=[mshift._alerts_for_points(i,j)[:,:-1] for i,j,_ in mshift.clusters()]
+    _,t_hull=_time(lambda: [ConvexHull(a) for a in alerts],repeat)
+    return {
+        'nb_alerts': int(mshift.ij_data().shape[0]),
+        'nb_clusters': len(mshift.clusters()),
+        'total_count': int(sum(c[-1] for c in mshift.clusters())),
+        'glad_between_dates': t_dates,
+        'threads_match': bool(np.array_equal(
+            threaded.clustered_data(),mshift.clustered_data())),
+        'meanshift': t_mshift,
+        'meanshift_threads': t_threads,
+        'convex_hull': t_hull }
+
+
+def _clustered(days,width,min_count,iterations,threads=None):
+    mshift=MShift(
+        days,
+        width=width,
+        min_count=min_count,
+        iterations=iterations,
+        threads=threads)
+    mshift.clusters()
+    return mshift
+
+
+def _time(func,repeat):
+    best=None
+    for n in range(max(1,repeat)):
+        start=time.time()
+        out=func()
+        elapsed=time.time()-start
+        if (best is None) or (elapsed<best):
+            best=elapsed
+    return out, best
+
+
+def _print_results(results):
+    for tier,result in sorted(results.items()):
+        print("{}:".format(tier.upper()))
+        for key in RESULTS+['threads_match']:
+            print("\t{}: {}".format(key,result.get(key)))
+        for key in TIMINGS:
+            if key in result:
+                print("\t{}: {:.4f}s".format(key,result[key]))
+
+
+#
+#   MAIN (RUN)
+#
+if __name__ == "__main__":
+    import argparse
+    parser=argparse.ArgumentParser(description='CLUSTER BENCHMARKS')
+    parser.add_argument('-t','--tiers',nargs='+',choices=sorted(TIERS.keys()),
+        help='density tiers to run (default all)')
+    parser.add_argument('-r','--repeat',type=int,default=DEFAULT_REPEAT,
+        help='number of timed repeats')
+    parser.add_argument('--threshold',type=float,default=DEFAULT_THRESHOLD,
+        help='max allowed ratio of time to baseline time')
+    parser.add_argument('--baselines',default=BASELINES_PATH,
+        help='baselines json file')
+    parser.add_argument('--tile_dir',default=None,
+        help='if set keep the synthetic tiles in this folder')
+    parser.add_argument('--update',action='store_true',
+        help='write results to the baselines file')
+    args=parser.parse_args()
+    results=run(args.tiers,args.repeat,tile_dir=args.tile_dir)
+    _print_results(results)
+    if args.update:
+        baselines=read_baselines(args.baselines)
+        baselines.update(results)
+        print("\nBASELINES: {}".format(write_baselines(baselines,args.baselines)))
+    else:
+        regressions=compare(results,read_baselines(args.baselines),args.threshold)
+        if regressions:
+            print("\nREGRESSIONS:")
+            for regression in regressions:
+                print("\t{}".format(regression))
+            sys.exit(1)
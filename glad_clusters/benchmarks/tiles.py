@@ -0,0 +1,106 @@
+import os
+import numpy as np
+import imageio as io
+import glad_clusters.clusters.processors as proc
+
+SIZE=256
+DAYS_BASE=255
+CONFIDENCE_VALUE=255
+DEFAULT_START_DATE='2016-01-01'
+DEFAULT_END_DATE='2017-01-01'
+DEFAULT_NB_CLUSTERS=8
+DEFAULT_CLUSTER_SIZE=60
+DEFAULT_CLUSTER_SPREAD=4
+DEFAULT_DATE_SPREAD=30
+DEFAULT_NOISE_DENSITY=0.002
+TILE_NAME_TMPL='{}/{}/{}.png'
+
+
+def synthetic_tile(
+        nb_clusters=DEFAULT_NB_CLUSTERS,
+        cluster_size=DEFAULT_CLUSTER_SIZE,
+        cluster_spread=DEFAULT_CLUSTER_SPREAD,
+        noise_density=DEFAULT_NOISE_DENSITY,
+        start_date=DEFAULT_START_DATE,
+        end_date=DEFAULT_END_DATE,
+        date_spread=DEFAULT_DATE_SPREAD,
+        seed=0):
+    """ generate a GLAD encoded tile
+
+        Alerts are drawn as gaussian blobs around random centers plus
+        uniformly scattered noise. Days-since-20150101 are encoded across
+        the R/G bands (days=255*R+G) as expected by
+        processors._get_intensity_days.
+
+        Args:
+            nb_clusters<int>: number of alert blobs
+            cluster_size<int>: number of alerts drawn for each blob
+            cluster_spread<float>: std-dev (pixels) of each blob
+            noise_density<float>: fraction of pixels with a random alert
+            start_date<str>: yyyy-mm-dd, earliest alert date
+            end_date<str>: yyyy-mm-dd, latest alert date (exclusive)
+            date_spread<int>: max number of days between alerts in a blob
+            seed<int>: random seed
+
+        Returns:
+            uint8 array of shape (SIZE,SIZE,3)
+    """
+    rng=np.random.RandomState(seed)
+    start_days=proc._days_since_glad_start(start_date)
+    end_days=proc._days_since_glad_start(end_date)
+    date_spread=max(1,min(date_spread,end_days-start_days))
+    days=np.zeros((SIZE,SIZE),dtype=int)
+    noise=rng.rand(SIZE,SIZE)<noise_density
+    days[noise]=rng.randint(start_days,end_days,size=noise.sum())
+    margin=int(2*cluster_spread)
+    for n in range(nb_clusters):
+        center=rng.randint(margin,SIZE-margin,size=2)
+        first_day=rng.randint(start_days,end_days-date_spread+1)
+        pts=rng.normal(center,cluster_spread,size=(cluster_size,2))
+        pts=np.clip(pts.round().astype(int),0,SIZE-1)
+        days[pts[:,0],pts[:,1]]=first_day+rng.randint(
+            0,date_spread,size=cluster_size)
+    return encode_days(days)
+
+
+def encode_days(days):
+    """ encode days-since-20150101 array as GLAD RGB image
+    """
+    days=np.asarray(days).astype(int)
+    im=np.zeros(days.shape+(3,),dtype=np.uint8)
+    im[:,:,0]=days//DAYS_BASE
+    im[:,:,1]=days%DAYS_BASE
+    im[:,:,2]=np.where(days>0,CONFIDENCE_VALUE,0)
+    return im
+
+
+def write_tile(im,path):
+    """ write tile to png
+    """
+    folder=os.path.dirname(path)
+    if folder and (not os.path.exists(folder)):
+        os.makedirs(folder)
+    io.imwrite(path,im)
+    return path
+
+
+def write_tiles(folder,z,x,y,nb_tiles=1,**tile_kwargs):
+    """ write a row of synthetic tiles as <folder>/z/x/y.png
+
+        Args:
+            folder<str>: root folder (use as download_folder/url)
+            z,x,y<int>: tile of the first tile in the row
+            nb_tiles<int>: number of tiles (along x)
+            tile_kwargs: passed to synthetic_tile. the seed is
+                offset by the tile number.
+
+        Returns:
+            list of paths
+    """
+    seed=tile_kwargs.pop('seed',0)
+    paths=[]
+    for n in range(nb_tiles):
+        im=synthetic_tile(seed=seed+n,**tile_kwargs)
+        path=os.path.join(folder,TILE_NAME_TMPL.format(z,x+n,y))
+        paths.append(write_tile(im,path))
+    return paths
@@ -0,0 +1,200 @@
+import numpy as np
+from glad_clusters.clusters.convex_hull import ConvexHull
+
+
+CONCAVE=100
+MIN_EDGE_LENGTH=1.5
+MAX_CANDIDATES=8
+
+
+def concave_hulls(alerts,concave=CONCAVE,min_edge_length=MIN_EDGE_LENGTH):
+    """ concave hulls for many clusters
+
+        Args:
+            alerts<iterable>: (n,3) alerts arrays (ie RaggedAlerts)
+            concave<int[CONCAVE]>: target percent of convex hull area
+
+        Returns:
+            list of ConcaveHull
+    """
+    return [ConcaveHull(a[:,0:2],concave,min_edge_length) for a in alerts]
+
+
+def bbox_ring(points):
+    """ closed ring for the pixel bounding box of points (ie for
+        clusters whose hull has no area)
+    """
+    (min_i,min_j),(max_i,max_j)=points.min(axis=0)-0.5,points.max(axis=0)+0.5
+    return np.array([
+        [min_i,min_j],[min_i,max_j],[max_i,max_j],[max_i,min_j],[min_i,min_j]])
+
+
+
+
+class ConcaveHull(object):
+    """ ConcaveHull:
+
+        Concave hull of 2d points by "digging" into the convex hull
+        (Park & Oh, 2012). The longest boundary edge is repeatedly
+        replaced by two edges through the closest interior point until
+        the area is reduced to concave percent of the convex hull area,
+        like PostGIS' ST_ConcaveHull(geom, concave/100).
+
+        Args:
+            points<arr>: (n,2) array of points
+            concave<int[CONCAVE]>:
+                target percent of convex hull area. 100 returns the
+                convex hull
+            min_edge_length<float[MIN_EDGE_LENGTH]>:
+                edges shorter than this are never dug (by default edges
+                between neighboring pixels)
+    """
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,points,concave=CONCAVE,min_edge_length=MIN_EDGE_LENGTH):
+        self.points=np.unique(np.asarray(points,dtype=float).reshape(-1,2),axis=0)
+        self.concave=concave
+        self.min_edge_length=min_edge_length
+        convex=ConvexHull(self.points)
+        self.convex_area=convex.area
+        self.hull=self._concave_hull(convex.hull[:-1])
+        self.area=_area(self.hull)
+
+
+    #
+    # INTERNAL METHODS
+    #
+    def _concave_hull(self,ring):
+        if (self.concave>=100) or (ring.shape[0]<3):
+            return _closed(ring)
+        if _signed_area(ring)<0:
+            ring=ring[::-1]
+        target=self.convex_area*self.concave/100.0
+        area=self.convex_area
+        on_ring=(self.points[:,None,:]==ring[None,:,:]).all(axis=-1).any(axis=-1)
+        inner=self.points[~on_ring]
+        ring=list(ring)
+        blocked=set()
+        while (area>target) and inner.shape[0]:
+            edge=self._longest_edge(ring,blocked)
+            if edge is None:
+                break
+            a,b=ring[edge],ring[(edge+1)%len(ring)]
+            index=self._dig_point(a,b,edge,np.array(ring),inner)
+            if index is None:
+                blocked.add(_edge_key(a,b))
+            else:
+                p=inner[index]
+                area-=_cross(b-a,p-a)/2.0
+                ring.insert(edge+1,p)
+                inner=np.delete(inner,index,axis=0)
+        return _closed(np.array(ring))
+
+
+    def _longest_edge(self,ring,blocked):
+        """ index of the longest edge that can still be dug
+        """
+        arr=np.array(ring)
+        lengths=np.hypot(*(np.roll(arr,-1,axis=0)-arr).T)
+        for k in np.argsort(-lengths,kind='mergesort'):
+            if lengths[k]<self.min_edge_length:
+                return None
+            if _edge_key(arr[k],arr[(k+1)%len(arr)]) not in blocked:
+                return k
+        return None
+
+
+    def _dig_point(self,a,b,edge,ring,inner):
+        """ index of the closest inner point p for which replacing
+            edge a-b by a-p-b keeps the polygon simple and every other
+            point inside it
+        """
+        left=_cross(b-a,inner-a)>0
+        if not left.any():
+            return None
+        indices=np.nonzero(left)[0]
+        dist=(
+            np.hypot(*(inner[indices]-a).T)+
+            np.hypot(*(inner[indices]-b).T))
+        others=np.delete(ring,[edge,(edge+1)%ring.shape[0]],axis=0)
+        for index in indices[np.argsort(dist,kind='mergesort')[:MAX_CANDIDATES]]:
+            p=inner[index]
+            points=np.delete(inner,index,axis=0)
+            if _in_triangle(a,b,p,points,strict=True).any():
+                continue
+            if _in_triangle(a,b,p,others,strict=False).any():
+                continue
+            n=ring.shape[0]
+            if _intersects(a,p,ring,[(edge-1)%n,edge]):
+                continue
+            if _intersects(p,b,ring,[edge,(edge+1)%n]):
+                continue
+            return index
+        return None
+
+
+
+
+#
+# HELPERS
+#
+def _cross(u,v):
+    u,v=np.asarray(u),np.asarray(v)
+    return u[...,0]*v[...,1]-u[...,1]*v[...,0]
+
+
+def _in_triangle(a,b,p,points,strict=True):
+    """ mask for points in the (counter-clockwise) triangle a,b,p
+
+        The edge a-b is always included. The edges b-p and p-a are
+        included unless strict.
+    """
+    if not points.shape[0]:
+        return np.zeros(0,dtype=bool)
+    ab=_cross(b-a,points-a)>=0
+    if strict:
+        return ab & (_cross(p-b,points-b)>0) & (_cross(a-p,points-p)>0)
+    else:
+        return ab & (_cross(p-b,points-b)>=0) & (_cross(a-p,points-p)>=0)
+
+
+def _intersects(u,v,ring,skip):
+    """ true if segment u-v touches or crosses a ring edge (excluding
+        the edges in skip)
+    """
+    starts=ring
+    ends=np.roll(ring,-1,axis=0)
+    keep=np.ones(ring.shape[0],dtype=bool)
+    keep[skip]=False
+    starts,ends=starts[keep],ends[keep]
+    d1=_cross(v-u,starts-u)
+    d2=_cross(v-u,ends-u)
+    d3=_cross(ends-starts,u-starts)
+    d4=_cross(ends-starts,v-starts)
+    collinear=(d1==0) & (d2==0)
+    overlaps=(
+        (np.minimum(starts,ends)<=np.maximum(u,v)).all(axis=1) &
+        (np.maximum(starts,ends)>=np.minimum(u,v)).all(axis=1))
+    crosses=(d1*d2<=0) & (d3*d4<=0) & ~collinear
+    return (crosses | (collinear & overlaps)).any()
+
+
+def _edge_key(a,b):
+    return tuple(a.tolist())+tuple(b.tolist())
+
+
+def _signed_area(ring):
+    x,y=ring[:,0],ring[:,1]
+    return 0.5*(np.dot(x,np.roll(y,-1))-np.dot(y,np.roll(x,-1)))
+
+
+def _area(ring):
+    return abs(_signed_area(ring))
+
+
+def _closed(ring):
+    ring=np.asarray(ring)
+    if ring.shape[0]:
+        ring=np.concatenate([ring,ring[:1]])
+    return ring
@@ -0,0 +1,202 @@
+import io
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import threading
+import numpy as np
+
+SIZE=256
+MAX_CACHE_SIZE=256
+MAX_THREADS=8
+NEIGHBORS=[
+    (dx,dy) for dy in (-1,0,1) for dx in (-1,0,1) if (dx or dy)]
+
+
+class FrameCache(object):
+    """ FrameCache:
+
+        LRU cache of tile border frames. A frame holds the top, bottom,
+        left and right margin-wide strips of a decoded tile, which is
+        everything any of its 8 neighbors need for their halo. Frames
+        are small (4*margin*256 pixels) so decoded tiles are never kept.
+
+        The cache only lives as long as the (warm) process. Frames can
+        also be persisted with frame_bytes/read_frame (see handler).
+
+        Args:
+            max_size<int[MAX_CACHE_SIZE]>: max number of frames
+    """
+    def __init__(self,max_size=MAX_CACHE_SIZE):
+        self.max_size=max_size
+        self.hits=0
+        self.misses=0
+        self._frames=OrderedDict()
+        self._lock=threading.Lock()
+
+
+    def get(self,key):
+        with self._lock:
+            frame=self._frames.pop(key,None)
+            if frame is None:
+                self.misses+=1
+            else:
+                self.hits+=1
+                self._frames[key]=frame
+            return frame
+
+
+    def set(self,key,frame):
+        with self._lock:
+            self._frames.pop(key,None)
+            self._frames[key]=frame
+            while len(self._frames)>self.max_size:
+                self._frames.popitem(last=False)
+
+
+    def frame(self,key,frame_func):
+        """ cached frame for key, calling frame_func on a miss
+        """
+        frame=self.get(key)
+        if frame is None:
+            frame=frame_func()
+            self.set(key,frame)
+        return frame
+
+
+
+
+#
+# PUBLIC
+#
+def border_frame(im_data,margin):
+    """ margin-wide border strips of a tile (empty if im_data is missing)
+    """
+    if (im_data is None) or (im_data is False):
+        return {}
+    return {
+        'top': np.array(im_data[:margin]),
+        'bottom': np.array(im_data[-margin:]),
+        'left': np.array(im_data[:,:margin]),
+        'right': np.array(im_data[:,-margin:]) }
+
+
+def frame_bytes(frame):
+    """ compressed (npz) bytes for a border frame
+    """
+    buffer=io.BytesIO()
+    np.savez_compressed(buffer,**frame)
+    return buffer.getvalue()
+
+
+def read_frame(data):
+    """ border frame from frame_bytes data
+    """
+    npz=np.load(io.BytesIO(data))
+    try:
+        return { side: npz[side] for side in npz.files }
+    finally:
+        npz.close()
+
+
+def neighbor_strip(frame,dx,dy,margin):
+    """ part of neighbor (dx,dy)'s frame adjacent to the core tile
+
+        ie. the neighbor to the north-west (-1,-1) contributes the
+        bottom-right margin x margin corner.
+    """
+    if not frame:
+        return None
+    if dy<0:
+        strip=frame['bottom']
+    elif dy>0:
+        strip=frame['top']
+    elif dx<0:
+        strip=frame['right']
+    else:
+        strip=frame['left']
+    if dx<0:
+        strip=strip[:,-margin:]
+    elif dx>0:
+        strip=strip[:,:margin]
+    return strip
+
+
+def halo_data(im_data,strips,margin):
+    """ core tile surrounded by a margin of neighbor pixels
+
+        Args:
+            im_data<arr>: (SIZE,SIZE,...) core tile
+            strips<dict>:
+                neighbor_strip for each (dx,dy) in NEIGHBORS. missing
+                neighbors (None) are left as zeros
+            margin<int>: halo width in pixels
+
+        Returns:
+            (SIZE+2*margin,SIZE+2*margin,...) array. the core tile is at
+            [margin:margin+SIZE,margin:margin+SIZE]
+    """
+    height,width=im_data.shape[:2]
+    shape=(height+2*margin,width+2*margin)+im_data.shape[2:]
+    data=np.zeros(shape,dtype=im_data.dtype)
+    data[margin:margin+height,margin:margin+width]=im_data
+    for (dx,dy),strip in strips.items():
+        if strip is None:
+            continue
+        rows=_span(dy,margin,height)
+        cols=_span(dx,margin,width)
+        if data.ndim==3:
+            strip=strip[...,:data.shape[2]]
+        data[rows,cols]=strip
+    return data
+
+
+def core_bounds(margin,size=SIZE):
+    """ (row_min,row_max,col_min,col_max) of the core tile in halo data
+    """
+    return (margin,margin+size,margin,margin+size)
+
+
+def read_strips(z,x,y,margin,frame_func,key_func,cache,max_threads=MAX_THREADS):
+    """ neighbor strips for tile z/x/y
+
+        Args:
+            z,x,y<int>: core tile
+            margin<int>: halo width in pixels
+            frame_func<func>: 
+                frame_func(z,x,y) returns the tile's border_frame (called on
+                cache misses)
+            key_func<func>: key_func(z,x,y) returns a cache key
+            cache<FrameCache>: frame cache
+            max_threads<int>: number of threads used to read neighbors
+
+        Returns:
+            dict of (dx,dy): strip (None for missing neighbors)
+    """
+    n=2**int(z)
+    def _strip(offset):
+        dx,dy=offset
+        nx,ny=(x+dx)%n,y+dy
+        if (ny<0) or (ny>=n):
+            return offset, None
+        frame=cache.frame(
+            key_func(z,nx,ny),
+            lambda: frame_func(z,nx,ny))
+        return offset, neighbor_strip(frame,dx,dy,margin)
+    pool=ThreadPool(processes=min(max_threads,len(NEIGHBORS)))
+    try:
+        strips=pool.map(_strip,NEIGHBORS)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(strips)
+
+
+#
+# INTERNAL
+#
+def _span(offset,margin,size):
+    if offset<0:
+        return slice(0,margin)
+    elif offset>0:
+        return slice(margin+size,size+2*margin)
+    else:
+        return slice(margin,margin+size)
@@ -1,6 +1,9 @@
 import math
+import time
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from glad_clusters.clusters.convex_hull import ConvexHull
+from glad_clusters.clusters.concave_hull import ConcaveHull
 import glad_clusters.clusters.processors as proc
 
 NOISY=False
@@ -11,6 +14,10 @@ ITERATIONS=25
 SIZE=256
 INDICES=np.indices((SIZE,SIZE))
 SHIFT=(SIZE-1)/2.0
+SEED_TOLERANCE=0.05
+DEADLINE_CHECK=256
+BLOCK_SIZE=256
+CHUNK_SIZE=2048
 
 class MShift(object):
 
@@ -31,11 +38,59 @@ class MShift(object):
             data,
             width=WIDTH,
             min_count=MIN_COUNT,
-            iterations=ITERATIONS):
+            iterations=ITERATIONS,
+            concave=None,
+            core=None,
+            origin=None,
+            seeds=None,
+            seed_distance=None,
+            approximate=False,
+            deadline=None,
+            threads=None):
+        """
+            Args:
+                data<arr>: (rows,cols) days-since image (any size)
+                core<tuple>: 
+                    (row_min,row_max,col_min,col_max). if set only keep
+                    clusters whose mode is inside these bounds
+                origin<tuple>: 
+                    (row,col) subtracted from reported cluster and alert
+                    pixel values (ie the core offset in halo data)
+                seeds<list>:
+                    [i,j] cluster modes from a previous run (same frame as
+                    the reported clusters). only used if approximate is set
+                approximate<bool[False]>:
+                    if true (and seeds are set) points within seed_distance
+                    (defaults to 2*width) of a seed start at that seed and
+                    iterations stop once no point moves more than 
+                    SEED_TOLERANCE pixels. this is faster but new alerts
+                    near a previous mode are merged into it before shifting,
+                    so clusters can not split or move as in a full run. 
+                    otherwise seeds are ignored
+                deadline<float>:
+                    time (time.time()) after which shifting stops (checked
+                    every DEADLINE_CHECK points). clusters are then built 
+                    from the current, partially shifted, points, concave
+                    hulls are skipped and partial is set
+                threads<int>:
+                    if set, points are moved (in place, as by default) by
+                    blocks of BLOCK_SIZE points whose weights against the
+                    other points are computed on a pool of threads (numpy
+                    releases the GIL). see _block_update
+        """
         self.data=data
         self.width=width
         self.min_count=min_count
         self.iterations=iterations
+        self.concave=concave
+        self.core=core
+        self.origin=np.array(origin or (0,0))
+        self.seeds=seeds
+        self.seed_distance=seed_distance or 2*width
+        self.approximate=approximate
+        self.deadline=deadline
+        self.threads=threads
+        self.partial=False
         self._init_properties()
 
 
@@ -45,8 +100,9 @@ class MShift(object):
             Returns: 
                 array of [i,j,days-since] valued arrays
         """
-        self._ij_data=np.dstack((INDICES[0],INDICES[1],self.data))
-        self._ij_data=self._ij_data.reshape(SIZE**2,-1)
+        indices=self._indices()
+        self._ij_data=np.dstack((indices[0],indices[1],self.data))
+        self._ij_data=self._ij_data.reshape(indices[0].size,-1)
         self._ij_data=self._ij_data[self._ij_data[:,-1]>0]
         return self._ij_data
 
@@ -61,16 +117,32 @@ class MShift(object):
         """
         if self._clustered_data is None:
             cdata=self.ij_data()[:,:2].copy()
-            cdata=np.subtract(cdata,SHIFT)
-            for n in range(self.iterations):
-                if NOISY: 
-                    if (n+1)%5==0: print("...{}/{}".format(n+1,self.iterations))
-                for i, x in enumerate(cdata):
-                    dist=np.sqrt(((x-cdata)**2).sum(1))
-                    weight=self._gaussian(dist)
-                    cdata[i]=(
-                        np.expand_dims(weight,1)*cdata).sum(0)/weight.sum()
-            self._clustered_data=np.add(cdata,SHIFT).round().astype(int)
+            shift=self._shift()
+            cdata=np.subtract(cdata,shift)
+            seeded=bool(self.seeds and self.approximate)
+            if seeded:
+                cdata=self._seeded(cdata,shift)
+            pool=self._pool(cdata)
+            try:
+                for n in range(self.iterations):
+                    if NOISY: 
+                        if (n+1)%5==0: print("...{}/{}".format(n+1,self.iterations))
+                    if self._expired():
+                        break
+                    previous=cdata.copy()
+                    if self.threads:
+                        self._block_update(cdata,pool)
+                    else:
+                        self._point_update(cdata)
+                    if self.partial:
+                        break
+                    if seeded and self._converged(previous,cdata):
+                        break
+            finally:
+                if pool:
+                    pool.close()
+                    pool.join()
+            self._clustered_data=np.add(cdata,shift).round().astype(int)
         return self._clustered_data
 
 
@@ -97,6 +169,8 @@ class MShift(object):
                     axis=-1)
                 self._clusters=self._clusters[
                     self._clusters[:,-1]>=self.min_count]
+                if self.core:
+                    self._clusters=self._clusters[self._in_core(self._clusters)]
         return self._clusters
 
 
@@ -116,6 +190,10 @@ class MShift(object):
         """
         i,j,count=cluster
         alerts=self._alerts_for_points(i,j)
+        if self.origin.any():
+            i,j=i-self.origin[0],j-self.origin[1]
+            alerts=alerts.copy()
+            alerts[:,:2]-=self.origin
         area=ConvexHull(alerts[:,:-1]).area
         min_date=proc.date_for_days(np.amin(alerts[:,-1]))
         max_date=proc.date_for_days(np.amax(alerts[:,-1]))
@@ -127,6 +205,10 @@ class MShift(object):
             'max_date':max_date,
             'min_date':min_date,
             'alerts':alerts.astype(int).tolist() }
+        if self.concave and (not self.partial):
+            hull=ConcaveHull(alerts[:,:-1],self.concave)
+            cluster_dict['concave_area']=int(round(hull.area))
+            cluster_dict['concave_hull']=hull.hull.astype(int).tolist()
         return cluster_dict
 
 
@@ -140,6 +222,132 @@ class MShift(object):
         self._clusters=None
 
 
+    def _indices(self):
+        shape=self.data.shape[:2]
+        if shape==(SIZE,SIZE):
+            return INDICES
+        return np.indices(shape)
+
+
+    def _shift(self):
+        shape=self.data.shape[:2]
+        if shape==(SIZE,SIZE):
+            return SHIFT
+        return (np.array(shape)-1)/2.0
+
+
+    def _seeded(self,cdata,shift):
+        """ move points to the closest seed (within seed_distance). 
+            approximate only, see __init__
+        """
+        if not cdata.shape[0]:
+            return cdata
+        seeds=np.array(self.seeds,dtype=float).reshape(-1,2)+self.origin-shift
+        dist=np.sqrt(((cdata[:,None,:]-seeds[None,:,:])**2).sum(-1))
+        closest=dist.argmin(axis=1)
+        is_seeded=dist[np.arange(cdata.shape[0]),closest]<=self.seed_distance
+        cdata[is_seeded]=seeds[closest[is_seeded]]
+        return cdata
+
+
+    def _pool(self,cdata):
+        """ thread pool for block updates (None for a single thread or chunk)
+        """
+        if self.threads and (int(self.threads)>1) and (cdata.shape[0]>CHUNK_SIZE):
+            return ThreadPool(processes=int(self.threads))
+        return None
+
+
+    def _point_update(self,cdata):
+        """ move points one at a time (in place)
+        """
+        for i, x in enumerate(cdata):
+            if (i%DEADLINE_CHECK==0) and self._expired():
+                break
+            dist=np.sqrt(((x-cdata)**2).sum(1))
+            weight=self._gaussian(dist)
+            cdata[i]=(
+                np.expand_dims(weight,1)*cdata).sum(0)/weight.sum()
+
+
+    def _block_update(self,cdata,pool):
+        """ move points one at a time (in place) as _point_update, by 
+            blocks of BLOCK_SIZE points
+
+            When a block is reached the points before it have moved and
+            the points after it have not, so the weighted sums of the 
+            block's points over all other points are computed at once (in
+            chunks of CHUNK_SIZE points on the pool). Only the sums over 
+            the block itself are then computed point by point. Results 
+            equal _point_update up to floating point summation order and 
+            do not depend on the number of threads
+        """
+        size=cdata.shape[0]
+        for start in range(0,size,BLOCK_SIZE):
+            if self._expired():
+                break
+            end=min(start+BLOCK_SIZE,size)
+            block=cdata[start:end].copy()
+            sums,weights=self._outer_sums(cdata,block,start,end,pool)
+            for k, x in enumerate(block):
+                if ((start+k)%DEADLINE_CHECK==0) and self._expired():
+                    break
+                inner=cdata[start:end]
+                dist=np.sqrt(((x-inner)**2).sum(1))
+                weight=self._gaussian(dist)
+                cdata[start+k]=(
+                    sums[k]+np.dot(weight,inner))/(weights[k]+weight.sum())
+        return cdata
+
+
+    def _outer_sums(self,cdata,block,start,end,pool):
+        """ weighted sums of points and sums of weights for block (the 
+            current positions of cdata[start:end]) over the points outside
+            of [start,end)
+        """
+        size=cdata.shape[0]
+        chunks=[
+            (a,min(a+CHUNK_SIZE,stop)) 
+            for first,stop in ((0,start),(end,size)) 
+            for a in range(first,stop,CHUNK_SIZE)]
+        def _chunk(bounds):
+            points=cdata[bounds[0]:bounds[1]]
+            dist=np.sqrt(
+                (block[:,0,None]-points[None,:,0])**2+
+                (block[:,1,None]-points[None,:,1])**2)
+            weight=self._gaussian(dist)
+            return np.dot(weight,points), weight.sum(1)
+        if pool and (len(chunks)>1):
+            parts=pool.map(_chunk,chunks,chunksize=1)
+        else:
+            parts=[_chunk(bounds) for bounds in chunks]
+        sums=np.zeros(block.shape)
+        weights=np.zeros(block.shape[0])
+        for chunk_sums,chunk_weights in parts:
+            sums+=chunk_sums
+            weights+=chunk_weights
+        return sums, weights
+
+
+    def _expired(self):
+        if self.deadline and (time.time()>=self.deadline):
+            self.partial=True
+        return self.partial
+
+
+    def _converged(self,previous,cdata):
+        if not cdata.shape[0]:
+            return True
+        return np.abs(cdata-previous).max()<SEED_TOLERANCE
+
+
+    def _in_core(self,clusters):
+        row_min,row_max,col_min,col_max=self.core
+        return (
+            (clusters[:,0]>=row_min) & (clusters[:,0]<row_max) &
+            (clusters[:,1]>=col_min) & (clusters[:,1]<col_max))
+
+
     def _joined_data(self):
         if self._joined is None:
             self._joined=np.concatenate(
@@ -47,6 +47,21 @@ def glad_between_dates(
     return im
 
 
+def glad_days(data):
+    """ days-since band of a glad image (decode once, then filter with
+        days_between_dates for each date window)
+    """
+    return _get_intensity_days(data)[1]
+
+
+def days_between_dates(days,start_date,end_date):
+    """ days-since image with zeros outside of [start_date,end_date)
+    """
+    return _between_dates(
+        _days_are_between_dates(days,start_date,end_date),
+        days)
+
+
 def date_for_days(days):
     date=(GLAD_START_DATE+timedelta(days=days))
     return int(date.strftime(INT_DATE_FMT))
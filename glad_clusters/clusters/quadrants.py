@@ -0,0 +1,54 @@
+SIZE=256
+NB_QUADRANTS=4
+OVERLAP_WIDTHS=3
+
+
+#
+# PUBLIC
+#
+def overlap(width):
+    """ pixels of context kept around a quadrant (OVERLAP_WIDTHS*width)
+    """
+    return int(OVERLAP_WIDTHS*int(width))
+
+
+def quadrant_bounds(quadrant,margin=0,size=SIZE):
+    """ (row_min,row_max,col_min,col_max) of a quadrant of the core tile
+
+        Args:
+            quadrant<int>: 0 (north-west), 1 (north-east), 2 (south-west)
+                or 3 (south-east)
+            margin<int>: halo margin (the core tile is at [margin:margin+size])
+            size<int[SIZE]>: tile size
+    """
+    half=size//2
+    row=margin+(int(quadrant)//2)*half
+    col=margin+(int(quadrant)%2)*half
+    return (row,row+half,col,col+half)
+
+
+def quadrant_window(data,quadrant,overlap,margin=0):
+    """ sub-window of data around a quadrant
+
+        The quadrant is padded with overlap pixels (clipped to data) so
+        clusters near its edges converge as they would on the full tile.
+
+        Args:
+            data<arr>: (rows,cols,...) tile (or halo) data
+            quadrant<int>: see quadrant_bounds
+            overlap<int>: context in pixels
+            margin<int>: halo margin of data
+
+        Returns:
+            window, core (quadrant bounds in the window) and origin (for
+            MShift, so reported pixels are relative to the core tile)
+    """
+    row_min,row_max,col_min,col_max=quadrant_bounds(quadrant,margin)
+    top=max(row_min-overlap,0)
+    bottom=min(row_max+overlap,data.shape[0])
+    left=max(col_min-overlap,0)
+    right=min(col_max+overlap,data.shape[1])
+    window=data[top:bottom,left:right]
+    core=(row_min-top,row_max-top,col_min-left,col_max-left)
+    origin=(margin-top,margin-left)
+    return window, core, origin
@@ -29,6 +29,15 @@ class RequestParser(object):
         'width',
         'iterations',
         'min_count',
+        'concave',
+        'halo',
+        'since',
+        'seeds',
+        'approximate',
+        'windows',
+        'quadrant',
+        'threads',
+        'frame_bucket',
         'csv_bucket',
         'bucket',
         'data_path',
@@ -46,7 +55,13 @@ class RequestParser(object):
         'timestamp',
         'width',
         'iterations',
-        'min_count']
+        'min_count',
+        'concave',
+        'halo',
+        'since',
+        'approximate',
+        'windows',
+        'quadrant']
 
 
     #
@@ -123,8 +138,12 @@ class RequestParser(object):
             'width': env.int('width'),
             'iterations': env.int('iterations'),
             'min_count': env.int('min_count'),
+            'concave': env.int('concave'),
+            'halo': env.int('halo'),
+            'threads': env.int('threads'),
             'url': env.get('url',default=None),
             'csv_bucket': env.get('csv_bucket',default=None),
+            'frame_bucket': env.get('frame_bucket',default=None),
             'bucket': env.get('bucket',default=None),
             'download_folder': env.get('download_folder',default=DEFAULT_DOWNLOAD_FOLDER),
             'preprocess_data': env.get('preprocess_data',default=DEFAULT_PREPROCESS_DATA)}
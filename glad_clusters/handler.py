@@ -1,15 +1,29 @@
 from __future__ import print_function
 import json
+import time
 import logging
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+import boto3
+import numpy as np
 import imageio as io
 from clusters.meanshift import MShift
 from clusters.request_parser import RequestParser
 import clusters.processors as proc
+import clusters.halo as halo
+import clusters.quadrants as quadrants
 
 #
 # CONFIG
 #
 RETURN_EMPTY=False
+DEADLINE_MARGIN=15
+FRAME_CACHE=halo.FrameCache()
+FRAME_PREFIX='frames'
+FRAME_VERSION_KEY='source-version'
+S3_CLIENT=None
 
 
 #
@@ -25,6 +39,7 @@ logger.setLevel(logging.INFO)
 # PUBLIC METHODS
 #
 def meanshift(event, context):
+    deadline=_deadline(context)
     req=RequestParser(event)
     if req.is_not_valid():
         return _error(req,'request not valid',1)
@@ -34,14 +49,25 @@ def meanshift(event, context):
             if im_data is False:
                 return _error(req,'{} not found'.format(req.data_path),2)
             else:
-                im_data=_preprocess(req,im_data)
-                mshift=MShift(
-                    data=im_data,
-                    width=req.width,
-                    min_count=req.min_count,
-                    iterations=req.iterations)
-                output_data, nb_clusters=_output_data(req,mshift)
-                if (nb_clusters>0) or RETURN_EMPTY:
+                margin=_margin(req)
+                if margin:
+                    im_data=_halo_data(req,im_data,margin)
+                if req.since and (not _has_new_alerts(req,im_data)):
+                    return _unchanged(req)
+                if req.windows:
+                    output_data, nb_clusters=_windows_output_data(
+                        req,
+                        im_data,
+                        margin,
+                        deadline)
+                else:
+                    im_data=_preprocess(req,im_data)
+                    mshift=_mshift(req,im_data,margin,deadline)
+                    output_data, nb_clusters=_output_data(
+                        req,
+                        mshift,
+                        _nb_alerts(im_data,margin))
+                if (nb_clusters>0) or _keep(output_data) or RETURN_EMPTY:
                     return output_data
                 else:
                     return None
@@ -50,6 +76,35 @@ def meanshift(event, context):
 
 
 
+def _keep(output_data):
+    """ true if a response without clusters is still returned: partial
+        tiles and tiles with (unclustered) alerts, whose alert count is
+        used to split dense tiles
+    """
+    return bool(output_data.get('partial') or output_data.get('nb_alerts'))
+
+
+def _nb_alerts(data,margin):
+    """ number of alerts on the core tile, clustered or not
+    """
+    if margin:
+        row_min,row_max,col_min,col_max=halo.core_bounds(margin)
+        data=data[row_min:row_max,col_min:col_max]
+    return int(np.count_nonzero(data))
+
+
+def _deadline(context):
+    """ time after which MShift stops (the lambda's remaining time less
+        DEADLINE_MARGIN seconds for building the response). None for local
+        runs without a context
+    """
+    try:
+        remaining=context.get_remaining_time_in_millis()/1000.0
+    except AttributeError:
+        return None
+    return time.time()+max(remaining-DEADLINE_MARGIN,0)
+
+
 def _im_data(req):
     if not req.url: _download(req.bucket,req.file_name,req.data_path)
     try:
@@ -60,6 +115,155 @@ def _im_data(req):
         return False
 
 
+def _margin(req):
+    if req.halo and req.width:
+        return int(req.halo)*int(req.width)
+    return 0
+
+
+def _halo_data(req,im_data,margin):
+    """ core tile plus margin pixels from its 8 neighbors
+
+        Neighbor border frames (halo.border_frame) are read in parallel,
+        from FRAME_CACHE, then (if req.frame_bucket is set) from frame
+        objects on the frame bucket, and only then from the full neighbor
+        tile. FRAME_CACHE only lives in a warm container, frame objects 
+        are shared by all invocations. They are tagged with the etag of
+        the tile they were built from and rebuilt when the tile changes.
+        The core tile's frame is stored as well, so neighbors clustered 
+        later do not need to decode it.
+
+        Cost: a neighbor whose frame is stored costs a HEAD request on
+        the tile plus the download of its frame (4*margin*256 pixels, 
+        compressed). Otherwise the neighbor is fully downloaded and 
+        decoded, and its frame is uploaded. Without a frame bucket a cold
+        container therefore reads and decodes 9 tiles instead of 1.
+    """
+    def _key(z,x,y):
+        return (_neighbor_req(req,x,y).data_path,margin)
+    def _frame(z,x,y):
+        return _neighbor_frame(_neighbor_req(req,x,y),margin)
+    frame=halo.border_frame(im_data,margin)
+    FRAME_CACHE.set(_key(req.z,req.x,req.y),frame)
+    if req.frame_bucket:
+        _store_frame(req,margin,frame)
+    strips=halo.read_strips(req.z,req.x,req.y,margin,_frame,_key,FRAME_CACHE)
+    return halo.halo_data(im_data,strips,margin)
+
+
+def _neighbor_frame(req,margin):
+    """ border frame for req's tile: the stored frame if it is up to date,
+        otherwise built from the full tile (and stored)
+    """
+    version=req.frame_bucket and _tile_version(req)
+    if version:
+        frame=_stored_frame(req,margin,version)
+        if frame is not None:
+            return frame
+    frame=halo.border_frame(_im_data(req),margin)
+    if version and frame:
+        _write_frame(req,margin,frame,version)
+    return frame
+
+
+def _store_frame(req,margin,frame):
+    """ store the frame of req's (decoded) tile if it is missing or out
+        of date
+    """
+    version=_tile_version(req)
+    if version and frame and (_stored_version(req,margin)!=version):
+        _write_frame(req,margin,frame,version)
+
+
+def _tile_version(req):
+    """ etag of req's tile (None if it is missing or can not be read)
+    """
+    try:
+        if req.url:
+            request=Request(req.data_path)
+            request.get_method=lambda: 'HEAD'
+            etag=urlopen(request).info().get('ETag')
+        else:
+            etag=_s3().head_object(Bucket=req.bucket,Key=req.file_name).get('ETag')
+    except Exception:
+        return None
+    return etag and etag.strip('"')
+
+
+def _frame_key(req,margin):
+    return '{}/{}/{}/{}/{}.npz'.format(FRAME_PREFIX,margin,req.z,req.x,req.y)
+
+
+def _stored_version(req,margin):
+    try:
+        response=_s3().head_object(
+            Bucket=req.frame_bucket,
+            Key=_frame_key(req,margin))
+    except Exception:
+        return None
+    return response.get('Metadata',{}).get(FRAME_VERSION_KEY)
+
+
+def _stored_frame(req,margin,version):
+    """ stored frame for req's tile if built from version (otherwise None)
+    """
+    try:
+        response=_s3().get_object(
+            Bucket=req.frame_bucket,
+            Key=_frame_key(req,margin))
+        if response.get('Metadata',{}).get(FRAME_VERSION_KEY)!=version:
+            return None
+        return halo.read_frame(response['Body'].read())
+    except Exception:
+        return None
+
+
+def _write_frame(req,margin,frame,version):
+    try:
+        _s3().put_object(
+            Bucket=req.frame_bucket,
+            Key=_frame_key(req,margin),
+            Body=halo.frame_bytes(frame),
+            Metadata={ FRAME_VERSION_KEY: version })
+    except Exception as e:
+        logger.warn(
+            "\nfailed to store frame ({}) -- {}".format(_frame_key(req,margin),e))
+
+
+def _s3():
+    global S3_CLIENT
+    if S3_CLIENT is None:
+        S3_CLIENT=boto3.client('s3')
+    return S3_CLIENT
+
+
+def _neighbor_req(req,x,y):
+    request=dict(req.request,x=x,y=y)
+    request.pop('file_name',None)
+    request.pop('data_path',None)
+    return RequestParser(request)
+
+
+def _has_new_alerts(req,im_data):
+    """ true if there are alerts between req.since and req.end_date
+        (always true for data that is not glad encoded)
+    """
+    if not req.preprocess_data:
+        return True
+    return proc.glad_between_dates(
+        im_data,
+        req.since,
+        req.end_date,
+        return_days=False).any()
+
+
+def _unchanged(req):
+    data=req.data()
+    data['unchanged']=True
+    data['nb_clusters']=0
+    return data
+
+
 def _preprocess(req,im_data): 
     if req.preprocess_data:
         im_data=proc.glad_between_dates(
@@ -69,11 +273,71 @@ def _preprocess(req,im_data):
     return im_data
 
 
-def _output_data(req,mshift):
+def _mshift(req,im_data,margin,deadline=None):
+    """ MShift for the (halo) tile data or, for quadrant requests, the 
+        quadrant plus an overlap of OVERLAP_WIDTHS*width pixels
+    """
+    core=halo.core_bounds(margin) if margin else None
+    origin=(margin,margin) if margin else None
+    if req.quadrant is not None:
+        im_data,core,origin=quadrants.quadrant_window(
+            im_data,
+            req.quadrant,
+            quadrants.overlap(req.width),
+            margin)
+    return MShift(
+        data=im_data,
+        width=req.width,
+        min_count=req.min_count,
+        iterations=req.iterations,
+        concave=req.concave,
+        core=core,
+        origin=origin,
+        seeds=req.seeds,
+        approximate=req.approximate,
+        deadline=deadline,
+        threads=req.threads)
+
+
+def _windows_output_data(req,im_data,margin,deadline=None):
+    """ clusters for each [start_date,end_date] in req.windows
+
+        days are decoded once and masked for each window. clusters
+        have a 'window' key (index in req.windows). nb_alerts is the
+        alert count of the largest window.
+    """
+    if req.preprocess_data:
+        days=proc.glad_days(im_data)
+    else:
+        days=im_data
+    clusters=[]
+    partial=False
+    nb_alerts=0
+    for window,(start_date,end_date) in enumerate(req.windows):
+        window_data=proc.days_between_dates(days,start_date,end_date)
+        nb_alerts=max(nb_alerts,_nb_alerts(window_data,margin))
+        mshift=_mshift(req,window_data,margin,deadline)
+        for cluster in mshift.clusters_data()['clusters']:
+            cluster['window']=window
+            clusters.append(cluster)
+        partial=partial or mshift.partial
+    data=req.data()
+    data['data']={ 'clusters': clusters }
+    data['nb_clusters']=len(clusters)
+    data['nb_alerts']=nb_alerts
+    if partial:
+        data['partial']=True
+    return data, len(clusters)
+
+
+def _output_data(req,mshift,nb_alerts):
     data=req.data()
     data['data']=mshift.clusters_data() or {}
     nb_clusters=data['data'].pop('nb_clusters',0)
     data['nb_clusters']=nb_clusters
+    data['nb_alerts']=nb_alerts
+    if mshift.partial:
+        data['partial']=True
     return data, nb_clusters
 
 
@@ -0,0 +1,189 @@
+import numpy as np
+
+ALERTS_DTYPE=np.int32
+ALERTS_WIDTH=3
+I=0
+J=1
+DAYS=2
+
+
+class RaggedAlerts(object):
+    """ RaggedAlerts:
+
+        Compact container for the alerts of many clusters. All alerts
+        are stored in a single contiguous (N,3) array of [i,j,days-since]
+        values, alerts for cluster k are data[offsets[k]:offsets[k+1]].
+
+        Columns follow MShift (ij_data) and the clusters dataframe: I is
+        the pixel row (along the tile's y axis), J the pixel column (along
+        its x axis) and DAYS is days-since. This is the i,j convention used
+        throughout (see projection.lonlat).
+
+        Args:
+            data<arr>: (N,3) alerts array
+            offsets<arr>: (nb_clusters+1,) offsets array
+    """
+    @staticmethod
+    def from_arrays(alerts):
+        """ build from list/series of (n,3) alert arrays (or nested lists)
+        """
+        alerts=[np.asarray(a).reshape(-1,ALERTS_WIDTH) for a in alerts]
+        offsets=np.zeros(len(alerts)+1,dtype=np.int64)
+        if alerts:
+            offsets[1:]=np.cumsum([a.shape[0] for a in alerts])
+            data=np.concatenate(alerts)
+        else:
+            data=np.zeros((0,ALERTS_WIDTH),dtype=ALERTS_DTYPE)
+        return RaggedAlerts(data,offsets)
+
+
+    @staticmethod
+    def from_counts(data,counts):
+        """ build from (N,3) alerts array and per-cluster alert counts
+        """
+        offsets=np.zeros(len(counts)+1,dtype=np.int64)
+        offsets[1:]=np.cumsum(counts)
+        return RaggedAlerts(data,offsets)
+
+
+    @staticmethod
+    def concatenate(alerts):
+        """ build from a list of RaggedAlerts (rows in order)
+        """
+        if not alerts:
+            return RaggedAlerts.from_arrays([])
+        return RaggedAlerts.from_counts(
+            np.concatenate([a.data for a in alerts]),
+            np.concatenate([a.counts() for a in alerts]))
+
+
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,data,offsets):
+        self.data=np.asarray(data,dtype=ALERTS_DTYPE).reshape(-1,ALERTS_WIDTH)
+        self.offsets=np.asarray(offsets).astype(np.int64)
+
+
+    def __len__(self):
+        return self.offsets.shape[0]-1
+
+
+    def __getitem__(self,key):
+        """ alerts for a single cluster (a view into data) or, for
+            slices/arrays of rows, a new RaggedAlerts
+        """
+        if isinstance(key,(int,np.integer)):
+            if key<0: key+=len(self)
+            if (key<0) or (key>=len(self)):
+                raise IndexError('cluster index out of range')
+            return self.data[self.offsets[key]:self.offsets[key+1]]
+        return self.take(np.arange(len(self))[key])
+
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.data[self.offsets[k]:self.offsets[k+1]]
+
+
+    def counts(self):
+        """ number of alerts per cluster
+        """
+        return np.diff(self.offsets)
+
+
+    def row_ids(self):
+        """ cluster row for each alert
+        """
+        return np.repeat(np.arange(len(self)),self.counts())
+
+
+    def take(self,rows):
+        """ new RaggedAlerts with the clusters for rows (in order)
+        """
+        rows=np.asarray(rows,dtype=np.int64)
+        counts=self.counts()[rows]
+        starts=self.offsets[:-1][rows]
+        idx=np.repeat(starts-np.cumsum(counts)+counts,counts)
+        idx+=np.arange(counts.sum())
+        return RaggedAlerts.from_counts(self.data[idx],counts)
+
+
+    def filter(self,mask):
+        """ new RaggedAlerts keeping only the alerts where mask is true
+
+            Args:
+                mask<arr>: (N,) boolean array over all alerts
+        """
+        counts=np.bincount(self.row_ids()[mask],minlength=len(self))
+        return RaggedAlerts.from_counts(self.data[mask],counts)
+
+
+    def reduce(self,ufunc,column):
+        """ per-cluster reduction of a column (ie np.minimum, DAYS)
+
+            Returns:
+                (nb_clusters,) array. empty clusters are set to 0
+        """
+        out=np.zeros(len(self),dtype=self.data.dtype)
+        counts=self.counts()
+        has_alerts=counts>0
+        if has_alerts.any():
+            starts=self.offsets[:-1][has_alerts]
+            out[has_alerts]=ufunc.reduceat(self.data[:,column],starts)
+        return out
+
+
+    def bounds(self):
+        """ per-cluster bounding box
+
+            Returns:
+                (nb_clusters,4) array of [min_i,min_j,max_i,max_j]
+        """
+        return np.column_stack([
+            self.reduce(np.minimum,I),
+            self.reduce(np.minimum,J),
+            self.reduce(np.maximum,I),
+            self.reduce(np.maximum,J)])
+
+
+    def in_bbox(self,min_i,min_j,max_i,max_j):
+        """ per-alert mask for alerts inside the (inclusive) pixel bbox
+        """
+        return (
+            (self.data[:,I]>=min_i) & (self.data[:,I]<=max_i) &
+            (self.data[:,J]>=min_j) & (self.data[:,J]<=max_j))
+
+
+    def clusters_in_bbox(self,min_i,min_j,max_i,max_j):
+        """ per-cluster mask for clusters with any alert inside the bbox
+        """
+        mask=self.in_bbox(min_i,min_j,max_i,max_j)
+        return np.bincount(self.row_ids()[mask],minlength=len(self))>0
+
+
+    def date_histogram(self,bins=10,range=None,rows=None):
+        """ histogram of days-since for all alerts
+
+            Args:
+                bins<int|arr>: passed to np.histogram
+                range<tuple>: passed to np.histogram
+                rows<arr>: if set only use alerts for these clusters
+        """
+        data=self.data if rows is None else self.take(rows).data
+        return np.histogram(data[:,DAYS],bins=bins,range=range)
+
+
+    def tolist(self):
+        """ list of nested lists (one per cluster)
+        """
+        return [a.tolist() for a in self]
+
+
+    def to_object_array(self):
+        """ object array of per-cluster views (ie for a dataframe column)
+        """
+        arr=np.empty(len(self),dtype=object)
+        for k,alerts in enumerate(self):
+            arr[k]=alerts
+        return arr
@@ -0,0 +1,220 @@
+import os
+import json
+import numpy as np
+import glad_clusters.utils.projection as proj
+
+
+MAX_LATITUDE=85.0511287798
+POLYGON='Polygon'
+MULTIPOLYGON='MultiPolygon'
+
+
+#
+# PUBLIC
+#
+def polygons(geojson):
+    """ polygons from a geojson AOI
+
+        Args:
+            geojson<dict|str>:
+                geojson dict, geojson string or path to a geojson file.
+                Polygon, MultiPolygon, Feature, FeatureCollection and
+                GeometryCollection are supported (other geometries are
+                ignored)
+
+        Returns:
+            list of polygons. each polygon is a list of (n,2) lon/lat
+            rings (exterior first)
+    """
+    if isinstance(geojson,str):
+        if os.path.exists(geojson):
+            with open(geojson) as file:
+                geojson=json.load(file)
+        else:
+            geojson=json.loads(geojson)
+    return [
+        [np.asarray(ring,dtype=float)[:,:2] for ring in polygon]
+        for polygon in _polygon_coordinates(geojson)]
+
+
+def edges(polygons):
+    """ (N,4) array of [lon0,lat0,lon1,lat1] ring edges
+    """
+    segments=[]
+    for polygon in polygons:
+        for ring in polygon:
+            if ring.shape[0]<2:
+                continue
+            closed=ring
+            if not np.array_equal(ring[0],ring[-1]):
+                closed=np.vstack([ring,ring[:1]])
+            segments.append(np.hstack([closed[:-1],closed[1:]]))
+    if not segments:
+        return np.zeros((0,4))
+    return np.vstack(segments)
+
+
+def tile_cover(polygons,z):
+    """ tiles (x,y) intersecting the polygons
+
+        Scanline cover in tile units: for each tile row, tiles between
+        the min/max x of every edge clipped to the row (the boundary) are
+        added to the tiles between pairs of edge crossings of the row's
+        center line (the interior, even-odd so holes are excluded).
+
+        Args:
+            polygons<list>: see polygons
+            z<int>: tile-zoom
+
+        Returns:
+            sorted list of tile-xy values (x,y)
+    """
+    segments=_tile_edges(edges(polygons),z)
+    if not segments.shape[0]:
+        return []
+    rows,starts,ends=_boundary_spans(segments)
+    interior=_interior_spans(segments)
+    rows=np.concatenate([rows,interior[0]])
+    starts=np.concatenate([starts,interior[1]])
+    ends=np.concatenate([ends,interior[2]])
+    n=2**int(z)
+    starts=np.clip(starts,0,n-1)
+    ends=np.clip(ends,0,n-1)
+    rows=np.clip(rows,0,n-1)
+    lengths=np.maximum(ends-starts+1,0)
+    xs=np.repeat(starts,lengths)+_ranges(lengths)
+    ys=np.repeat(rows,lengths)
+    tiles=np.unique(np.column_stack([ys,xs]),axis=0)
+    return [(int(x),int(y)) for y,x in tiles]
+
+
+def contains(polygons,lon,lat):
+    """ mask for points inside the polygons (even-odd)
+
+        Points are grouped by row of a coarse grid so each point is only
+        tested against the edges that span its latitude.
+
+        Args:
+            polygons<list>: see polygons
+            lon,lat<arr>: points
+    """
+    lon=np.atleast_1d(np.asarray(lon,dtype=float))
+    lat=np.atleast_1d(np.asarray(lat,dtype=float))
+    segments=edges(polygons)
+    inside=np.zeros(lon.shape[0],dtype=bool)
+    if not (segments.shape[0] and lon.shape[0]):
+        return inside
+    nb_rows=max(1,int(np.sqrt(segments.shape[0])))
+    low=np.minimum(segments[:,1],segments[:,3])
+    high=np.maximum(segments[:,1],segments[:,3])
+    lat_min,lat_max=low.min(),high.max()
+    step=max((lat_max-lat_min)/nb_rows,1e-12)
+    point_rows=np.floor((lat-lat_min)/step).astype(int)
+    valid=(lat>=lat_min) & (lat<=lat_max)
+    first=np.floor((low-lat_min)/step).astype(int)
+    last=np.floor((high-lat_min)/step).astype(int)
+    for row in np.unique(point_rows[valid]):
+        points=np.nonzero(valid & (point_rows==row))[0]
+        row_segments=segments[(first<=row) & (last>=row)]
+        inside[points]=_crossings(lon[points],lat[points],row_segments)%2==1
+    return inside
+
+
+
+
+#
+# INTERNAL
+#
+def _polygon_coordinates(geojson):
+    kind=geojson.get('type')
+    if kind=='FeatureCollection':
+        return [p for f in geojson.get('features',[]) for p in _polygon_coordinates(f)]
+    elif kind=='Feature':
+        return _polygon_coordinates(geojson.get('geometry') or {})
+    elif kind=='GeometryCollection':
+        return [p for g in geojson.get('geometries',[]) for p in _polygon_coordinates(g)]
+    elif kind==POLYGON:
+        return [geojson['coordinates']]
+    elif kind==MULTIPOLYGON:
+        return list(geojson['coordinates'])
+    return []
+
+
+def _tile_edges(segments,z):
+    """ edges in fractional tile coordinates (x along lon, y along lat)
+    """
+    lats=np.clip(segments[:,[1,3]],-MAX_LATITUDE,MAX_LATITUDE)
+    px,py=proj.lonlat_to_pixel(segments[:,[0,2]],lats,z)
+    tx,ty=px/proj.TILE_SIZE,py/proj.TILE_SIZE
+    return np.column_stack([tx[:,0],ty[:,0],tx[:,1],ty[:,1]])
+
+
+def _boundary_spans(segments):
+    """ (rows,start,end) tile spans touched by each edge in each row
+    """
+    x0,y0,x1,y1=segments.T
+    low,high=np.minimum(y0,y1),np.maximum(y0,y1)
+    first=np.floor(low).astype(np.int64)
+    counts=np.floor(high).astype(np.int64)-first+1
+    edge=np.repeat(np.arange(segments.shape[0]),counts)
+    rows=np.repeat(first,counts)+_ranges(counts)
+    ya=np.maximum(low[edge],rows)
+    yb=np.minimum(high[edge],rows+1)
+    xa=_x_at(segments[edge],ya)
+    xb=_x_at(segments[edge],yb)
+    flat=(y0==y1)[edge]
+    xa[flat]=x0[edge][flat]
+    xb[flat]=x1[edge][flat]
+    starts=np.floor(np.minimum(xa,xb)).astype(np.int64)
+    ends=np.floor(np.maximum(xa,xb)).astype(np.int64)
+    return rows, starts, ends
+
+
+def _interior_spans(segments):
+    """ (rows,start,end) tile spans between pairs of crossings of the
+        row center lines
+    """
+    x0,y0,x1,y1=segments.T
+    low,high=np.minimum(y0,y1),np.maximum(y0,y1)
+    # rows whose center r+0.5 is in [low,high)
+    first=np.ceil(low-0.5).astype(np.int64)
+    last=np.ceil(high-0.5).astype(np.int64)-1
+    counts=np.maximum(last-first+1,0)
+    edge=np.repeat(np.arange(segments.shape[0]),counts)
+    rows=np.repeat(first,counts)+_ranges(counts)
+    xs=_x_at(segments[edge],rows+0.5)
+    order=np.lexsort((xs,rows))
+    rows,xs=rows[order],xs[order]
+    # pair crossings within each row
+    rank=_ranges(np.unique(rows,return_counts=True)[1])
+    is_start=rank%2==0
+    has_end=np.zeros(rows.shape[0],dtype=bool)
+    has_end[:-1]=is_start[:-1] & (rows[1:]==rows[:-1])
+    starts=np.floor(xs[:-1][has_end[:-1]]).astype(np.int64)
+    ends=np.floor(xs[1:][has_end[:-1]]).astype(np.int64)
+    return rows[:-1][has_end[:-1]], starts, ends
+
+
+def _x_at(segments,y):
+    x0,y0,x1,y1=segments.T
+    dy=y1-y0
+    t=np.where(dy!=0,(y-y0)/np.where(dy!=0,dy,1),0)
+    return x0+t*(x1-x0)
+
+
+def _crossings(lon,lat,segments):
+    """ number of edges crossed by a ray from each point towards +lon
+    """
+    x0,y0,x1,y1=[v[None,:] for v in segments.T]
+    lon,lat=lon[:,None],lat[:,None]
+    spans=(y0>lat)!=(y1>lat)
+    dy=np.where(y1!=y0,y1-y0,1)
+    x=x0+(lat-y0)*(x1-x0)/dy
+    return (spans & (lon<x)).sum(axis=1)
+
+
+def _ranges(sizes):
+    """ concatenated aranges: [0..sizes[0]),[0..sizes[1]),...
+    """
+    starts=np.cumsum(sizes)-sizes
+    return np.arange(sizes.sum())-np.repeat(starts,sizes)
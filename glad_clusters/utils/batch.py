@@ -0,0 +1,196 @@
+from __future__ import print_function
+from collections import OrderedDict
+import glad_clusters.utils.regional as regional
+
+
+LAMBDA='lambda'
+LOCAL='local'
+BACKENDS=[LAMBDA,LOCAL]
+MAX_PROCESSES=200
+
+
+
+
+class BatchQueue(object):
+    """ BatchQueue:
+
+        Job queue for many (overlapping) ClusterService requests. Requests
+        are grouped by parameter set (the tile request without x/y: z,
+        dates/windows, width, min_count, iterations, halo). For each group
+        the union of the requested tiles is run once and the responses are
+        fanned back out to each service, which then builds its dataframe
+        as if it had run its own tiles.
+
+        Usage:
+
+            queue=BatchQueue()
+            for aoi in aois:
+                queue.add(ClusterService(aoi=aoi,start_date=...))
+            queue.run()     # {'nb_tiles_requested': ..., 'nb_invocations_saved': ...}
+            queue.services[0].dataframe()
+
+        Args:
+            backend<str[LAMBDA]>:
+                LAMBDA invokes the lambda function for each tile (through the
+                service's result cache if set). LOCAL runs the tiles with the
+                regional engine (see ClusterService.run_regional)
+            max_processes<int[MAX_PROCESSES]>: threads invoking lambda
+            url<str>: url/folder of glad tiles (LOCAL backend)
+            processes<int>: process pool size for the LOCAL backend
+    """
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,
+            backend=LAMBDA,
+            max_processes=MAX_PROCESSES,
+            url=None,
+            processes=None):
+        if backend not in BACKENDS:
+            raise ValueError('backend must be one of {}'.format(BACKENDS))
+        self.backend=backend
+        self.max_processes=max_processes
+        self.url=url
+        self.processes=processes
+        self.services=[]
+        self.report=None
+
+
+    def add(self,service):
+        """ add a ClusterService to the queue
+
+            Returns:
+                index of the service in self.services
+        """
+        self.services.append(service)
+        return len(self.services)-1
+
+
+    def groups(self):
+        """ ordered dict of parameter-key: list of services
+        """
+        groups=OrderedDict()
+        for service in self.services:
+            groups.setdefault(service.parameter_key(),[]).append(service)
+        return groups
+
+
+    def tiles(self,services):
+        """ sorted union of the tiles of services
+        """
+        tiles=set()
+        for service in services:
+            tiles.update(service.tiles())
+        return sorted(tiles)
+
+
+    def run(self):
+        """ run each group's tiles once and fan the responses out
+
+            Returns:
+                report dict (see summary)
+        """
+        groups=self.groups()
+        nb_requested=0
+        nb_run=0
+        for services in groups.values():
+            tiles=self.tiles(services)
+            responses=self._run_group(services[0],tiles)
+            for service in services:
+                service_tiles=service.tiles()
+                service.load_responses([
+                    responses[t] for t in service_tiles if t in responses])
+                nb_requested+=len(service_tiles)
+            nb_run+=len(tiles)
+        self.report={
+            'nb_requests': len(self.services),
+            'nb_groups': len(groups),
+            'nb_tiles_requested': nb_requested,
+            'nb_tiles_run': nb_run,
+            'nb_invocations_saved': nb_requested-nb_run }
+        return self.report
+
+
+    def summary(self):
+        """ one line summary of the last run
+        """
+        if not self.report:
+            return None
+        return (
+            "{nb_requests} requests in {nb_groups} groups, "
+            "{nb_tiles_run} of {nb_tiles_requested} tiles run, "
+            "{nb_invocations_saved} invocations saved").format(**self.report)
+
+
+    #
+    # INTERNAL METHODS
+    #
+    def _run_group(self,service,tiles):
+        """ dict of (x,y): processed response for tiles
+        """
+        if not tiles:
+            return {}
+        if self.backend==LOCAL:
+            responses=self._run_local(service,tiles)
+        else:
+            responses=self._run_lambda(service,tiles)
+        return {
+            (int(r['x']),int(r['y'])): r
+            for r in (responses or []) if r }
+
+
+    def _run_lambda(self,service,tiles):
+        """ responses of the runner. a failed run still returns a response
+            for every tile, with an error response for each tile it did not
+            complete (see ClusterService.run)
+        """
+        runner=_runner(service,tiles)
+        runner.run(max_processes=self.max_processes,force=True,tiles=tiles)
+        return runner.responses
+
+
+    def _run_local(self,service,tiles):
+        if service.windows:
+            raise ValueError('the local backend does not support windows')
+        xs,ys=zip(*tiles)
+        engine=regional.HaloTileEngine(
+            z=service.z,
+            tile_bounds=[[min(xs),min(ys)],[max(xs),max(ys)]],
+            start_date=service.start_date,
+            end_date=service.end_date,
+            width=service.width,
+            min_count=service.min_count,
+            iterations=service.iterations,
+            halo=service.halo,
+            threads=service.threads,
+            url=self.url,
+            processes=self.processes,
+            tiles=tiles)
+        return list(engine.responses())
+
+
+
+
+#
+# HELPERS
+#
+def _runner(service,tiles):
+    """ service with the parameters of service covering tiles. a fresh
+        service is used so single-tile services (x,y) do not short-cut run
+    """
+    xs,ys=zip(*tiles)
+    return type(service)(
+        tile_bounds=[[min(xs),min(ys)],[max(xs),max(ys)]],
+        start_date=service.start_date,
+        end_date=service.end_date,
+        min_count=service.min_count,
+        width=service.width,
+        iterations=service.iterations,
+        z=service.z,
+        bucket=service.bucket,
+        halo=service.halo,
+        threads=service.threads,
+        windows=service.windows,
+        cache=service.cache,
+        history=service.history,
+        split_count=service.split_count)
@@ -0,0 +1,327 @@
+from __future__ import print_function
+import os
+import io
+import gzip
+import json
+import hashlib
+import threading
+try:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, Request, HTTPError
+import boto3
+import glad_clusters.utils.regional as regional
+import glad_clusters.utils.responses as resp
+
+
+CACHE_VERSION=1
+DEFAULT_DIRECTORY=os.path.join(os.path.expanduser('~'),'.glad_clusters','cache')
+DEFAULT_MAX_SIZE=2*1024**3
+DEFAULT_PREFIX='glad_clusters/cache'
+EXT='json.gz'
+MISSING_ETAG='missing'
+ETAG_TIMEOUT=10
+IGNORED_KEYS=['timestamp','threads']
+NEIGHBORS=[(dx,dy) for dy in (-1,0,1) for dx in (-1,0,1)]
+
+
+
+
+class ResultCache(object):
+    """ ResultCache:
+
+        Content-addressed cache for processed tile responses. Keys are
+        the sha1 of the tile request (z/x/y, dates/windows, width,
+        min_count, iterations, halo, ...), the engine (lambda function
+        name and CACHE_VERSION) and the ETag of the tile png (plus its 8
+        neighbors for halo requests), so a cached result is only used if
+        the tile content is unchanged.
+
+        Responses are stored as gzipped json files in a local directory.
+        When the directory grows over max_size the least recently used
+        files are evicted. If bucket is set results are also written to
+        (and on local misses read from) s3://bucket/prefix/<key>.json.gz
+        (use a bucket lifecycle rule to bound its size).
+
+        Args:
+            directory<str[DEFAULT_DIRECTORY]>: local cache directory
+            max_size<int[DEFAULT_MAX_SIZE]>: max size of the directory (bytes)
+            bucket<str>: optional s3 bucket
+            prefix<str[DEFAULT_PREFIX]>: key prefix in bucket
+            tile_url<str>:
+                url of glad tiles (url/z/x/y.png) used for ETags. defaults
+                to environ['url'] or regional.DEFAULT_URL
+            etags<bool[True]>:
+                if false tile content is not part of the key (results are
+                reused even if the tile changed)
+    """
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,
+            directory=DEFAULT_DIRECTORY,
+            max_size=DEFAULT_MAX_SIZE,
+            bucket=None,
+            prefix=DEFAULT_PREFIX,
+            tile_url=None,
+            etags=True):
+        self.directory=directory
+        self.max_size=max_size
+        self.bucket=bucket
+        self.prefix=prefix
+        self.tile_url=tile_url or os.environ.get('url') or regional.DEFAULT_URL
+        self.etags=etags
+        self._lock=threading.Lock()
+        self._s3=None
+        self._size=None
+        self.reset_stats()
+
+
+    def key(self,request,engine):
+        """ cache key for request dict and engine (None if the tile
+            content can not be checked)
+        """
+        request={ k: v for k,v in request.items() if k not in IGNORED_KEYS }
+        content={
+            'request': request,
+            'engine': engine,
+            'version': CACHE_VERSION }
+        if self.etags:
+            etags=self._etags(request)
+            if etags is None:
+                self._count('uncacheable')
+                return None
+            content['etags']=etags
+        content=json.dumps(content,sort_keys=True).encode('utf-8')
+        return hashlib.sha1(content).hexdigest()
+
+
+    def get(self,key):
+        """ cached response for key (None on misses)
+        """
+        response=self._local_get(key)
+        if response is not None:
+            self._count('local_hits')
+            return response
+        if self.bucket:
+            data=self._remote_get(key)
+            if data is not None:
+                self._count('remote_hits')
+                self._local_set(key,data)
+                return _loads(data)
+        self._count('misses')
+        return None
+
+
+    def set(self,key,response):
+        """ cache a processed response (error and partial responses are
+            skipped). raw payloads are stored as is, not decoded
+        """
+        if (not response) or resp.is_error(response) or resp.is_partial(response):
+            return False
+        payload=response.get(resp.PAYLOAD_KEY)
+        if isinstance(payload,bytes) and (not isinstance(payload,str)):
+            response=dict(response)
+            response[resp.PAYLOAD_KEY]=payload.decode('utf-8')
+        data=_dumps(response)
+        self._local_set(key,data)
+        if self.bucket:
+            self._remote_set(key,data)
+        self._count('sets')
+        return True
+
+
+    def reset_stats(self):
+        self.stats={
+            'local_hits': 0,
+            'remote_hits': 0,
+            'misses': 0,
+            'sets': 0,
+            'evictions': 0,
+            'uncacheable': 0 }
+
+
+    def summary(self):
+        """ one line summary of stats
+        """
+        hits=self.stats['local_hits']+self.stats['remote_hits']
+        total=hits+self.stats['misses']+self.stats['uncacheable']
+        return (
+            "{} hits ({} local, {} remote), {} misses, {} uncacheable, "
+            "{} evictions, hit rate {:.1%}, {:.1f} MB").format(
+                hits,
+                self.stats['local_hits'],
+                self.stats['remote_hits'],
+                self.stats['misses'],
+                self.stats['uncacheable'],
+                self.stats['evictions'],
+                (hits/float(total)) if total else 0.0,
+                self.size()/1024.0**2)
+
+
+    def size(self):
+        """ size of the local cache directory (bytes)
+        """
+        with self._lock:
+            if self._size is None:
+                self._size=sum(os.path.getsize(p) for p in self._paths())
+            return self._size
+
+
+    def clear(self):
+        for path in self._paths():
+            os.remove(path)
+        with self._lock:
+            self._size=0
+
+
+    #
+    # INTERNAL METHODS
+    #
+    def _count(self,stat):
+        with self._lock:
+            self.stats[stat]+=1
+
+
+    def _path(self,key):
+        return os.path.join(self.directory,key[:2],'{}.{}'.format(key,EXT))
+
+
+    def _paths(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [
+            os.path.join(root,name)
+            for root,_,names in os.walk(self.directory)
+            for name in names if name.endswith(EXT)]
+
+
+    def _local_get(self,key):
+        path=self._path(key)
+        try:
+            with open(path,'rb') as file:
+                data=file.read()
+            os.utime(path,None)
+            return _loads(data)
+        except (IOError,OSError,ValueError):
+            return None
+
+
+    def _local_set(self,key,data):
+        path=self._path(key)
+        folder=os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass
+        tmp_path='{}.{}.tmp'.format(path,threading.current_thread().ident)
+        with open(tmp_path,'wb') as file:
+            file.write(data)
+        os.rename(tmp_path,path)
+        size=self.size()
+        with self._lock:
+            self._size=size+len(data)
+        if self._size>self.max_size:
+            self._evict()
+
+
+    def _evict(self):
+        """ remove least recently used files until under 90% of max_size
+        """
+        with self._lock:
+            paths=[(os.path.getmtime(p),os.path.getsize(p),p) for p in self._paths()]
+            size=sum(p[1] for p in paths)
+            for _,nbytes,path in sorted(paths):
+                if size<=0.9*self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                    size-=nbytes
+                    self.stats['evictions']+=1
+                except OSError:
+                    pass
+            self._size=size
+
+
+    def _client(self):
+        if self._s3 is None:
+            self._s3=boto3.client('s3')
+        return self._s3
+
+
+    def _remote_key(self,key):
+        return '{}/{}.{}'.format(self.prefix,key,EXT)
+
+
+    def _remote_get(self,key):
+        try:
+            obj=self._client().get_object(Bucket=self.bucket,Key=self._remote_key(key))
+            return obj['Body'].read()
+        except Exception:
+            return None
+
+
+    def _remote_set(self,key,data):
+        try:
+            self._client().put_object(
+                Bucket=self.bucket,
+                Key=self._remote_key(key),
+                Body=data)
+        except Exception as e:
+            print("WARNING: cache upload failed -- {}".format(e))
+
+
+    def _etags(self,request):
+        """ ETags for the tile (and its neighbors for halo requests)
+        """
+        z,x,y=int(request['z']),int(request['x']),int(request['y'])
+        offsets=NEIGHBORS if request.get('halo') else [(0,0)]
+        n=2**z
+        etags=[]
+        for dx,dy in offsets:
+            if 0<=(y+dy)<n:
+                etag=_etag(regional.URL_TMPL.format(self.tile_url,z,(x+dx)%n,y+dy))
+                if etag is None:
+                    return None
+                etags.append(etag)
+        return etags
+
+
+
+
+#
+# HELPERS
+#
+def _etag(url):
+    """ ETag of url (MISSING_ETAG if it does not exist, None on failures)
+    """
+    if not url.startswith('http'):
+        try:
+            stat=os.stat(url)
+            return '{}-{}'.format(stat.st_mtime,stat.st_size)
+        except OSError:
+            return MISSING_ETAG
+    request=Request(url)
+    request.get_method=lambda: 'HEAD'
+    try:
+        return urlopen(request,timeout=ETAG_TIMEOUT).info().get('ETag') or None
+    except HTTPError as e:
+        if e.code in (403,404):
+            return MISSING_ETAG
+        return None
+    except Exception:
+        return None
+
+
+def _dumps(response):
+    buffer=io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer,mode='wb') as file:
+        file.write(json.dumps(response).encode('utf-8'))
+    return buffer.getvalue()
+
+
+def _loads(data):
+    with gzip.GzipFile(fileobj=io.BytesIO(data),mode='rb') as file:
+        return json.loads(file.read().decode('utf-8'))
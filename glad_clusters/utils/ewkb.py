@@ -0,0 +1,107 @@
+import binascii
+import numpy as np
+
+SRID=4326
+WKB_POINT=1
+WKB_POLYGON=3
+WKB_MULTIPOINT=4
+WKB_Z=0x80000000
+WKB_SRID=0x20000000
+LITTLE_ENDIAN=1
+HEADER_DTYPE=np.dtype([
+    ('order','u1'),
+    ('type','<u4'),
+    ('srid','<u4'),
+    ('size','<u4')])
+POLYGON_HEADER_DTYPE=np.dtype([
+    ('order','u1'),
+    ('type','<u4'),
+    ('srid','<u4'),
+    ('nb_rings','<u4'),
+    ('size','<u4')])
+POINT_DTYPE=np.dtype([
+    ('x','<f8'),
+    ('y','<f8')])
+POINT_Z_DTYPE=np.dtype([
+    ('order','u1'),
+    ('type','<u4'),
+    ('x','<f8'),
+    ('y','<f8'),
+    ('z','<f8')])
+
+
+def multipoints_z(coords,offsets,srid=SRID,hex=True):
+    """ EWKB MULTIPOINT Z geometries
+
+        Args:
+            coords<arr>: (N,3) array of [x,y,z] values for all points
+            offsets<arr>:
+                (nb_geometries+1,) array. points for geometry k are
+                coords[offsets[k]:offsets[k+1]]
+            srid<int[SRID]>: spatial reference id
+            hex<bool[True]>: if true return hex strings otherwise bytes
+
+        Returns:
+            list of geometries
+    """
+    coords=np.asarray(coords,dtype=float).reshape(-1,3)
+    offsets=np.asarray(offsets,dtype=np.int64)
+    points=np.zeros(coords.shape[0],dtype=POINT_Z_DTYPE)
+    points['order']=LITTLE_ENDIAN
+    points['type']=WKB_POINT|WKB_Z
+    points['x'],points['y'],points['z']=coords[:,0],coords[:,1],coords[:,2]
+    headers=np.zeros(offsets.shape[0]-1,dtype=HEADER_DTYPE)
+    headers['order']=LITTLE_ENDIAN
+    headers['type']=WKB_MULTIPOINT|WKB_Z|WKB_SRID
+    headers['srid']=srid
+    headers['size']=np.diff(offsets)
+    points=points.tobytes()
+    headers=headers.tobytes()
+    psize=POINT_Z_DTYPE.itemsize
+    hsize=HEADER_DTYPE.itemsize
+    geoms=[
+        headers[k*hsize:(k+1)*hsize]+points[s*psize:e*psize]
+        for k,(s,e) in enumerate(zip(offsets[:-1],offsets[1:]))]
+    if hex:
+        geoms=[_hex(g) for g in geoms]
+    return geoms
+
+
+def polygons(coords,offsets,srid=SRID,hex=True):
+    """ EWKB POLYGON geometries (exterior ring only)
+
+        Args:
+            coords<arr>: (N,2) array of [x,y] values for all (closed) rings
+            offsets<arr>:
+                (nb_geometries+1,) array. ring for geometry k is
+                coords[offsets[k]:offsets[k+1]]
+            srid<int[SRID]>: spatial reference id
+            hex<bool[True]>: if true return hex strings otherwise bytes
+
+        Returns:
+            list of geometries
+    """
+    coords=np.asarray(coords,dtype=float).reshape(-1,2)
+    offsets=np.asarray(offsets,dtype=np.int64)
+    points=np.zeros(coords.shape[0],dtype=POINT_DTYPE)
+    points['x'],points['y']=coords[:,0],coords[:,1]
+    headers=np.zeros(offsets.shape[0]-1,dtype=POLYGON_HEADER_DTYPE)
+    headers['order']=LITTLE_ENDIAN
+    headers['type']=WKB_POLYGON|WKB_SRID
+    headers['srid']=srid
+    headers['nb_rings']=1
+    headers['size']=np.diff(offsets)
+    points=points.tobytes()
+    headers=headers.tobytes()
+    psize=POINT_DTYPE.itemsize
+    hsize=POLYGON_HEADER_DTYPE.itemsize
+    geoms=[
+        headers[k*hsize:(k+1)*hsize]+points[s*psize:e*psize]
+        for k,(s,e) in enumerate(zip(offsets[:-1],offsets[1:]))]
+    if hex:
+        geoms=[_hex(g) for g in geoms]
+    return geoms
+
+
+def _hex(geom):
+    return binascii.hexlify(geom).decode('ascii').upper()
@@ -0,0 +1,452 @@
+import json
+import struct
+import numpy as np
+import glad_clusters.utils.projection as proj
+from glad_clusters.clusters.convex_hull import ConvexHull
+from glad_clusters.clusters.concave_hull import ConcaveHull
+from glad_clusters.clusters.concave_hull import bbox_ring
+try:
+    import flatbuffers
+except ImportError:
+    flatbuffers=None
+
+
+FORMATS=['geojson','fgb']
+EXTENSIONS={ 'geojson': 'geojsonl', 'fgb': 'fgb' }
+GEOMETRIES=['concave','convex','centroid']
+DEFAULT_GEOMETRY='concave'
+DEFAULT_CONCAVE=100
+CHUNK_SIZE=1000
+PROPERTY_COLUMNS=[
+    'index',
+    'count',
+    'area',
+    'min_date',
+    'max_date',
+    'longitude',
+    'latitude',
+    'z','x','y','i','j',
+    'file_name',
+    'timestamp',
+    'window']
+FOOTPRINT_AREA='footprint_area'
+
+
+#
+# FLATGEOBUF CONSTANTS
+#
+FGB_MAGIC=b'fgb\x03fgb\x00'
+FGB_POINT=1
+FGB_POLYGON=3
+FGB_INT=5
+FGB_LONG=7
+FGB_DOUBLE=10
+FGB_STRING=11
+FGB_FORMATS={ FGB_INT: '<i', FGB_LONG: '<q', FGB_DOUBLE: '<d' }
+NODE_SIZE=16
+NODE_DTYPE=np.dtype([
+    ('min_x','<f8'),
+    ('min_y','<f8'),
+    ('max_x','<f8'),
+    ('max_y','<f8'),
+    ('offset','<u8')])
+HILBERT_ORDER=16
+
+
+#
+# PUBLIC
+#
+def footprint(alerts,geometry=DEFAULT_GEOMETRY,concave=DEFAULT_CONCAVE):
+    """ footprint ring for cluster alerts
+
+        Clusters whose hull has no area use their pixel bounding box.
+
+        Args:
+            alerts<arr>: (n,3) alerts for cluster
+            geometry<str>: 'concave' or 'convex'
+            concave<int>: target percent of convex area (concave only)
+
+        Returns:
+            closed ring of [i,j] pixel vertices, hull area (pixels)
+    """
+    points=np.asarray(alerts[:,0:2],dtype=float)
+    if geometry=='concave':
+        hull=ConcaveHull(points,concave)
+    else:
+        hull=ConvexHull(points)
+    if hull.area>0:
+        return hull.hull, hull.area
+    else:
+        return bbox_ring(points), hull.area
+
+
+def features(dataframe,
+        alerts,
+        geometry=DEFAULT_GEOMETRY,
+        concave=DEFAULT_CONCAVE,
+        rows=None,
+        chunk_size=CHUNK_SIZE):
+    """ cluster-by-cluster feature generator
+
+        Args:
+            dataframe<dataframe>: clusters dataframe (full=True)
+            alerts<RaggedAlerts>: alerts aligned with dataframe rows
+            geometry<str>: one of GEOMETRIES
+            concave<int>: target percent of convex area for 'concave'
+            rows<arr>: row order (default dataframe order)
+            chunk_size<int>: number of rows converted at a time
+
+        Yields:
+            properties dict, (k,2) array of [longitude,latitude] vertices
+            (a single point for 'centroid')
+    """
+    _check_geometry(geometry)
+    columns=_property_columns(dataframe)
+    if rows is None:
+        rows=np.arange(dataframe.shape[0])
+    for start in range(0,len(rows),chunk_size):
+        chunk_rows=rows[start:start+chunk_size]
+        chunk=dataframe.iloc[chunk_rows]
+        values=[chunk[c].tolist() for c in columns]
+        z,x,y=chunk.z.values,chunk.x.values,chunk.y.values
+        for k,row in enumerate(chunk_rows):
+            properties=dict(zip(columns,[v[k] for v in values]))
+            if geometry=='centroid':
+                coords=np.array([[properties['longitude'],properties['latitude']]])
+            else:
+                ring,area=footprint(alerts[int(row)],geometry,concave)
+                lons,lats=proj.alerts_lonlat(z[k],x[k],y[k],ring)
+                coords=np.column_stack([lons,lats])
+                properties[FOOTPRINT_AREA]=float(area)
+            yield properties, coords
+
+
+def write(path,fmt,dataframe,alerts,geometry=DEFAULT_GEOMETRY,concave=DEFAULT_CONCAVE):
+    """ write clusters to a file format ('geojson' or 'fgb')
+
+        Returns:
+            number of features written
+    """
+    if fmt=='geojson':
+        return write_geojson(path,dataframe,alerts,geometry,concave)
+    elif fmt=='fgb':
+        return write_fgb(path,dataframe,alerts,geometry,concave)
+    else:
+        raise ValueError('Unsupported export format: {}'.format(fmt))
+
+
+def write_geojson(path,dataframe,alerts,geometry=DEFAULT_GEOMETRY,concave=DEFAULT_CONCAVE):
+    """ write newline-delimited GeoJSON (one Feature per cluster)
+
+        Args:
+            path<str|file>: path or (text) file-like object
+            dataframe<dataframe>: clusters dataframe (full=True)
+            alerts<RaggedAlerts>: alerts aligned with dataframe rows
+            geometry<str>: one of GEOMETRIES
+            concave<int>: target percent of convex area for 'concave'
+
+        Returns:
+            number of features written
+    """
+    nb_features=0
+    with _open(path,'w') as file:
+        for properties,coords in features(dataframe,alerts,geometry,concave):
+            file.write(json.dumps(_geojson_feature(properties,coords,geometry)))
+            file.write('\n')
+            nb_features+=1
+    return nb_features
+
+
+def write_fgb(path,
+        dataframe,
+        alerts,
+        geometry=DEFAULT_GEOMETRY,
+        concave=DEFAULT_CONCAVE,
+        name='clusters',
+        node_size=NODE_SIZE):
+    """ write FlatGeobuf (requires flatbuffers)
+
+        Features are written in hilbert order of their bounding boxes,
+        followed (in the file, before the features) by a packed hilbert
+        r-tree. Bounding boxes are computed from the per-cluster alert
+        bounds so only the index (40 bytes per cluster) is held in memory.
+        The index is written last, so path must be seekable.
+
+        Args:
+            path<str|file>: path or (binary) seekable file-like object
+            dataframe<dataframe>: clusters dataframe (full=True)
+            alerts<RaggedAlerts>: alerts aligned with dataframe rows
+            geometry<str>: one of GEOMETRIES
+            concave<int>: target percent of convex area for 'concave'
+            name<str>: layer name
+            node_size<int>: r-tree node size
+
+        Returns:
+            number of features written
+    """
+    _require_flatbuffers()
+    _check_geometry(geometry)
+    nb_features=dataframe.shape[0]
+    columns=_fgb_columns(dataframe,geometry)
+    bboxes=_bboxes(dataframe,alerts)
+    order=_hilbert_order(bboxes)
+    if geometry=='centroid':
+        geometry_type=FGB_POINT
+    else:
+        geometry_type=FGB_POLYGON
+    envelope=_envelope(bboxes)
+    with _open(path,'wb') as file:
+        file.write(FGB_MAGIC)
+        file.write(_fgb_header(name,envelope,geometry_type,columns,nb_features,node_size))
+        index_start=file.tell()
+        if nb_features:
+            file.write(b'\x00'*(_tree_size(nb_features,node_size)*NODE_DTYPE.itemsize))
+        features_start=file.tell()
+        offsets=np.zeros(nb_features,dtype=np.uint64)
+        for k,(properties,coords) in enumerate(
+                features(dataframe,alerts,geometry,concave,rows=order)):
+            offsets[k]=file.tell()-features_start
+            file.write(_fgb_feature(properties,coords,columns,geometry_type))
+        if nb_features:
+            end=file.tell()
+            file.seek(index_start)
+            file.write(_packed_rtree(bboxes[order],offsets,node_size).tobytes())
+            file.seek(end)
+    return nb_features
+
+
+#
+# INTERNAL
+#
+class _open(object):
+    """ open path or pass through file-like objects
+    """
+    def __init__(self,path,mode):
+        self.path=path
+        self.mode=mode
+        self.file=None
+
+
+    def __enter__(self):
+        if hasattr(self.path,'write'):
+            return self.path
+        self.file=open(self.path,self.mode)
+        return self.file
+
+
+    def __exit__(self,*args):
+        if self.file:
+            self.file.close()
+
+
+def _check_geometry(geometry):
+    if geometry not in GEOMETRIES:
+        raise ValueError('Unsupported geometry: {}'.format(geometry))
+
+
+def _property_columns(dataframe):
+    return [c for c in PROPERTY_COLUMNS if c in dataframe.columns]
+
+
+def _geojson_feature(properties,coords,geometry):
+    if geometry=='centroid':
+        geom={ 'type': 'Point', 'coordinates': coords[0].tolist() }
+    else:
+        geom={ 'type': 'Polygon', 'coordinates': [coords.tolist()] }
+    feature={ 'type': 'Feature', 'geometry': geom, 'properties': properties }
+    if 'index' in properties:
+        feature['id']=properties['index']
+    return feature
+
+
+def _bboxes(dataframe,alerts):
+    """ (n,4) [min_lon,min_lat,max_lon,max_lat] from alert pixel bounds
+        (padded by half a pixel) and cluster centroids
+    """
+    bounds=alerts.bounds().astype(float)
+    z,x,y=dataframe.z.values,dataframe.x.values,dataframe.y.values
+    lon_0,lat_0=proj.alerts_lonlat(z,x,y,bounds[:,0:2]-0.5)
+    lon_1,lat_1=proj.alerts_lonlat(z,x,y,bounds[:,2:4]+0.5)
+    lons=np.column_stack([lon_0,lon_1,dataframe.longitude.values.astype(float)])
+    lats=np.column_stack([lat_0,lat_1,dataframe.latitude.values.astype(float)])
+    return np.column_stack([
+        lons.min(axis=1),lats.min(axis=1),lons.max(axis=1),lats.max(axis=1)])
+
+
+def _envelope(bboxes):
+    if not bboxes.shape[0]:
+        return np.zeros(4)
+    return np.array([
+        bboxes[:,0].min(),bboxes[:,1].min(),bboxes[:,2].max(),bboxes[:,3].max()])
+
+
+def _hilbert_order(bboxes):
+    """ row order by hilbert value of the bbox centers
+    """
+    if not bboxes.shape[0]:
+        return np.zeros(0,dtype=int)
+    min_x,min_y,max_x,max_y=_envelope(bboxes)
+    size=(1<<HILBERT_ORDER)-1
+    cx=(bboxes[:,0]+bboxes[:,2])/2.0
+    cy=(bboxes[:,1]+bboxes[:,3])/2.0
+    hx=np.floor(size*(cx-min_x)/max(max_x-min_x,1e-12)).astype(np.int64)
+    hy=np.floor(size*(cy-min_y)/max(max_y-min_y,1e-12)).astype(np.int64)
+    return np.argsort(_hilbert(hx,hy),kind='mergesort')
+
+
+def _hilbert(x,y,order=HILBERT_ORDER):
+    """ hilbert curve distance for integer x,y arrays in [0,2**order)
+    """
+    n=1<<order
+    d=np.zeros(x.shape[0],dtype=np.int64)
+    s=n>>1
+    while s>0:
+        rx=((x & s)>0).astype(np.int64)
+        ry=((y & s)>0).astype(np.int64)
+        d+=s*s*((3*rx)^ry)
+        flip=(ry==0)&(rx==1)
+        x=np.where(flip,n-1-x,x)
+        y=np.where(flip,n-1-y,y)
+        swap=(ry==0)
+        x,y=np.where(swap,y,x),np.where(swap,x,y)
+        s>>=1
+    return d
+
+
+def _level_bounds(nb_items,node_size):
+    """ [start,end) node ranges for each tree level, leaves first
+    """
+    n=nb_items
+    level_sizes=[n]
+    while n!=1:
+        n=-(-n//node_size)
+        level_sizes.append(n)
+    end=sum(level_sizes)
+    bounds=[]
+    for size in level_sizes:
+        bounds.append((end-size,end))
+        end-=size
+    return bounds
+
+
+def _tree_size(nb_items,node_size):
+    return _level_bounds(nb_items,node_size)[0][1]
+
+
+def _packed_rtree(bboxes,offsets,node_size):
+    """ packed r-tree nodes. leaves hold feature byte offsets, parents
+        hold the node index of their first child
+    """
+    levels=_level_bounds(bboxes.shape[0],node_size)
+    nodes=np.zeros(levels[0][1],dtype=NODE_DTYPE)
+    start,end=levels[0]
+    nodes['min_x'][start:end]=bboxes[:,0]
+    nodes['min_y'][start:end]=bboxes[:,1]
+    nodes['max_x'][start:end]=bboxes[:,2]
+    nodes['max_y'][start:end]=bboxes[:,3]
+    nodes['offset'][start:end]=offsets
+    for (start,end),(parent,_) in zip(levels[:-1],levels[1:]):
+        children=np.arange(start,end,node_size)
+        parents=slice(parent,parent+children.shape[0])
+        groups=children-start
+        nodes['min_x'][parents]=np.minimum.reduceat(nodes['min_x'][start:end],groups)
+        nodes['min_y'][parents]=np.minimum.reduceat(nodes['min_y'][start:end],groups)
+        nodes['max_x'][parents]=np.maximum.reduceat(nodes['max_x'][start:end],groups)
+        nodes['max_y'][parents]=np.maximum.reduceat(nodes['max_y'][start:end],groups)
+        nodes['offset'][parents]=children
+    return nodes
+
+
+def _fgb_columns(dataframe,geometry):
+    """ [(name,column-type)] for feature properties
+    """
+    columns=[]
+    for column in _property_columns(dataframe):
+        dtype=dataframe[column].dtype
+        if dtype.kind in 'iu':
+            columns.append((column,FGB_LONG if dtype.itemsize>4 else FGB_INT))
+        elif dtype.kind=='f':
+            columns.append((column,FGB_DOUBLE))
+        else:
+            columns.append((column,FGB_STRING))
+    if geometry!='centroid':
+        columns.append((FOOTPRINT_AREA,FGB_DOUBLE))
+    return columns
+
+
+def _fgb_header(name,envelope,geometry_type,columns,nb_features,node_size):
+    builder=flatbuffers.Builder(1024)
+    name=builder.CreateString(name)
+    column_offsets=[]
+    for column,column_type in columns:
+        column=builder.CreateString(column)
+        builder.StartObject(11)
+        builder.PrependUOffsetTRelativeSlot(0,column,0)
+        builder.PrependUint8Slot(1,column_type,0)
+        column_offsets.append(builder.EndObject())
+    builder.StartVector(4,len(column_offsets),4)
+    for offset in reversed(column_offsets):
+        builder.PrependUOffsetTRelative(offset)
+    column_offsets=_end_vector(builder,len(columns))
+    envelope=builder.CreateNumpyVector(np.asarray(envelope,dtype='<f8'))
+    org=builder.CreateString('EPSG')
+    builder.StartObject(6)
+    builder.PrependUOffsetTRelativeSlot(0,org,0)
+    builder.PrependInt32Slot(1,4326,0)
+    crs=builder.EndObject()
+    builder.StartObject(14)
+    builder.PrependUOffsetTRelativeSlot(0,name,0)
+    builder.PrependUOffsetTRelativeSlot(1,envelope,0)
+    builder.PrependUint8Slot(2,geometry_type,0)
+    builder.PrependUOffsetTRelativeSlot(7,column_offsets,0)
+    builder.PrependUint64Slot(8,nb_features,0)
+    builder.PrependUint16Slot(9,node_size,NODE_SIZE)
+    builder.PrependUOffsetTRelativeSlot(10,crs,0)
+    builder.FinishSizePrefixed(builder.EndObject())
+    return bytes(builder.Output())
+
+
+def _fgb_feature(properties,coords,columns,geometry_type):
+    builder=flatbuffers.Builder(1024)
+    xy=builder.CreateNumpyVector(np.asarray(coords,dtype='<f8').ravel())
+    builder.StartObject(8)
+    builder.PrependUOffsetTRelativeSlot(1,xy,0)
+    builder.PrependUint8Slot(6,geometry_type,0)
+    geom=builder.EndObject()
+    props=builder.CreateNumpyVector(
+        np.frombuffer(_fgb_properties(properties,columns),dtype=np.uint8))
+    builder.StartObject(3)
+    builder.PrependUOffsetTRelativeSlot(0,geom,0)
+    builder.PrependUOffsetTRelativeSlot(1,props,0)
+    builder.FinishSizePrefixed(builder.EndObject())
+    return bytes(builder.Output())
+
+
+def _fgb_properties(properties,columns):
+    """ flatgeobuf property bytes: (uint16 column index, value) pairs
+    """
+    parts=[]
+    for k,(column,column_type) in enumerate(columns):
+        value=properties.get(column)
+        if value is None:
+            continue
+        parts.append(struct.pack('<H',k))
+        if column_type==FGB_STRING:
+            value=u'{}'.format(value).encode('utf-8')
+            parts.append(struct.pack('<I',len(value)))
+            parts.append(value)
+        else:
+            parts.append(struct.pack(FGB_FORMATS[column_type],value))
+    return b''.join(parts)
+
+
+def _end_vector(builder,length):
+    try:
+        return builder.EndVector()
+    except TypeError:
+        return builder.EndVector(length)
+
+
+def _require_flatbuffers():
+    if flatbuffers is None:
+        raise ImportError('flatbuffers is required for fgb exports')
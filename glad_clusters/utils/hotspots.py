@@ -0,0 +1,280 @@
+import os
+import numpy as np
+import glad_clusters.utils.multiprocess as mp
+import glad_clusters.utils.regional as regional
+import glad_clusters.clusters.processors as proc
+
+
+TILE_SIZE=256
+DEFAULT_COARSE_ZOOM=10
+DEFAULT_THRESHOLD=1.0
+DEFAULT_DILATION=1
+DEFAULT_SAMPLE=0.05
+DEFAULT_RADIUS=2
+READ_THREADS=16
+
+
+
+
+class HotspotSelection(object):
+    """ HotspotSelection:
+
+        Coarse-to-fine tile selection. Each coarse tile (coarse_z) covers
+        factor x factor tiles at z (factor=2**(z-coarse_z)), one block of
+        TILE_SIZE/factor pixels per tile. The density of a tile is the max 
+        number of coarse alerts (between the dates) in a square of 
+        radius*width fine pixels centered on its block, so scattered
+        noise does not add up. Tiles with a density of at least
+
+            threshold * min_count / factor**2
+
+        are hotspots. Hotspots are dilated by `dilation` tiles to catch 
+        clusters whose mode falls on a neighboring tile.
+
+        This is a heuristic: the coarse tiles are resampled (a coarse 
+        pixel may be empty over fine alerts and carries a single date) and
+        clusters wider than the density square are spread over it, so 
+        clusters can be missed at any threshold. Larger thresholds select
+        fewer tiles at the cost of recall. The recall has not been measured 
+        on real tiles: a random `sample` fraction of the unselected tiles
+        is run as well to estimate it (see recall), or compare against a
+        full run.
+
+        Args:
+            z<int>: fine zoom
+            tile_bounds<list>: [[x_min,y_min],[x_max,y_max]] at z
+            start_date,end_date<str>: 'yyyy-mm-dd'
+            min_count,width<int>: MShift min_count and width
+            coarse_z<int[DEFAULT_COARSE_ZOOM]>: zoom of the density pass
+            threshold<float[DEFAULT_THRESHOLD]>: fraction of min_count (see above)
+            dilation<int[DEFAULT_DILATION]>: hotspot dilation in tiles
+            radius<float[DEFAULT_RADIUS]>: density square radius in widths
+            sample<float[DEFAULT_SAMPLE]>: fraction of unselected tiles to audit
+            url<str>: url/folder of glad tiles (see regional.read_tile)
+            read_func<func>: read_func(z,x,y) returns the glad image or None
+            seed<int>: random seed for the audit sample
+    """
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,
+            z,
+            tile_bounds,
+            start_date,
+            end_date,
+            min_count,
+            width,
+            coarse_z=DEFAULT_COARSE_ZOOM,
+            threshold=DEFAULT_THRESHOLD,
+            dilation=DEFAULT_DILATION,
+            radius=DEFAULT_RADIUS,
+            sample=DEFAULT_SAMPLE,
+            url=None,
+            read_func=None,
+            read_threads=READ_THREADS,
+            seed=None):
+        (self.x_min,self.y_min),(self.x_max,self.y_max)=np.sort(
+            np.array(tile_bounds,dtype=int),axis=0).tolist()
+        self.z=int(z)
+        self.coarse_z=min(int(coarse_z),self.z)
+        self.factor=2**(self.z-self.coarse_z)
+        self.start_date=start_date
+        self.end_date=end_date
+        self.min_count=min_count
+        self.width=width
+        self.radius=radius
+        self.threshold=threshold
+        self.dilation=dilation
+        self.sample=sample
+        self.url=url or os.environ.get('url') or regional.DEFAULT_URL
+        self.read_func=read_func or (lambda z,x,y: regional.read_tile(self.url,z,x,y))
+        self.read_threads=read_threads
+        self.seed=seed
+        self._density=None
+        self._selected=None
+        self._sampled=None
+
+
+    def density(self):
+        """ (rows,cols) coarse alert density for each tile in the bounds
+            (rows along y, cols along x)
+        """
+        if self._density is None:
+            coarse=self._coarse_tiles()
+            blocks=mp.map_with_threadpool(
+                self._coarse_counts,
+                coarse,
+                max_processes=self.read_threads)
+            density=np.zeros(self._shape(),dtype=np.int64)
+            for (cx,cy),counts in zip(coarse,blocks):
+                if counts is not None:
+                    self._paste(density,cx,cy,counts)
+            self._density=density
+        return self._density
+
+
+    def min_density(self):
+        """ number of coarse alerts for a tile to be a hotspot
+        """
+        return max(1,int(np.ceil(
+            self.threshold*self.min_count/float(self.factor**2))))
+
+
+    def selected(self):
+        """ mask of tiles under or near hotspots
+        """
+        if self._selected is None:
+            hot=self.density()>=self.min_density()
+            self._selected=_dilate(hot,self.dilation)
+        return self._selected
+
+
+    def sampled(self):
+        """ mask of unselected tiles randomly chosen for the recall audit
+        """
+        if self._sampled is None:
+            unselected=np.nonzero(~self.selected().ravel())[0]
+            nb=int(np.ceil(self.sample*unselected.shape[0]))
+            rng=np.random.RandomState(self.seed)
+            sampled=np.zeros(self.selected().size,dtype=bool)
+            sampled[rng.choice(unselected,nb,replace=False)]=True
+            self._sampled=sampled.reshape(self.selected().shape)
+        return self._sampled
+
+
+    def tiles(self,audit=True):
+        """ list of tile-xy values (x,y) to run
+
+            Args:
+                audit<bool[True]>: if true include the sampled tiles
+        """
+        mask=self.selected()
+        if audit:
+            mask=mask|self.sampled()
+        return self._xy(mask)
+
+
+    def recall(self,dataframe,complete=False):
+        """ fraction of clusters on selected tiles
+
+            Args:
+                dataframe<dataframe>: clusters dataframe (needs x,y)
+                complete<bool[False]>:
+                    if true dataframe is from a full run of the bounds and
+                    the recall is exact. otherwise clusters on the sampled
+                    tiles are extrapolated to all unselected tiles
+
+            Returns:
+                recall (None if it can not be estimated)
+        """
+        rows=dataframe.y.values.astype(int)-self.y_min
+        cols=dataframe.x.values.astype(int)-self.x_min
+        inside=(
+            (rows>=0) & (rows<self._shape()[0]) &
+            (cols>=0) & (cols<self._shape()[1]))
+        rows,cols=rows[inside],cols[inside]
+        nb_selected=self.selected()[rows,cols].sum()
+        if complete:
+            missed=float(inside.sum()-nb_selected)
+        else:
+            nb_sampled=self.sampled().sum()
+            if not nb_sampled:
+                return None
+            nb_unselected=(~self.selected()).sum()
+            missed=self.sampled()[rows,cols].sum()*nb_unselected/float(nb_sampled)
+        total=nb_selected+missed
+        if not total:
+            return 1.0
+        return nb_selected/float(total)
+
+
+    def summary(self):
+        """ dict of tile counts (nb_invocations_saved assumes one
+            invocation per tile)
+        """
+        nb_tiles=self.selected().size
+        nb_selected=int(self.selected().sum())
+        nb_sampled=int(self.sampled().sum())
+        return {
+            'nb_tiles': nb_tiles,
+            'nb_coarse_tiles': len(self._coarse_tiles()),
+            'nb_selected': nb_selected,
+            'nb_sampled': nb_sampled,
+            'nb_invocations_saved': nb_tiles-nb_selected-nb_sampled }
+
+
+    #
+    # INTERNAL METHODS
+    #
+    def _shape(self):
+        return (self.y_max-self.y_min+1,self.x_max-self.x_min+1)
+
+
+    def _coarse_tiles(self):
+        return [
+            (cx,cy)
+            for cy in range(self.y_min//self.factor,self.y_max//self.factor+1)
+            for cx in range(self.x_min//self.factor,self.x_max//self.factor+1)]
+
+
+    def _coarse_counts(self,location):
+        """ (factor,factor) densities per fine tile block of a coarse tile
+        """
+        cx,cy=location
+        im=self.read_func(self.coarse_z,cx,cy)
+        if (im is None) or (im is False):
+            return None
+        alerts=proc.glad_between_dates(
+            im,
+            self.start_date,
+            self.end_date,
+            return_days=False)
+        size=int(np.ceil(self.radius*self.width/float(self.factor)))
+        counts=_box_sums(alerts,size)
+        block=TILE_SIZE//self.factor
+        return counts.reshape(self.factor,block,self.factor,block).max(axis=(1,3))
+
+
+    def _paste(self,density,cx,cy,counts):
+        x0,y0=cx*self.factor,cy*self.factor
+        rows=np.arange(self.factor)+y0-self.y_min
+        cols=np.arange(self.factor)+x0-self.x_min
+        keep_rows=(rows>=0) & (rows<density.shape[0])
+        keep_cols=(cols>=0) & (cols<density.shape[1])
+        density[np.ix_(rows[keep_rows],cols[keep_cols])]=counts[np.ix_(keep_rows,keep_cols)]
+
+
+    def _xy(self,mask):
+        rows,cols=np.nonzero(mask)
+        return list(zip((cols+self.x_min).tolist(),(rows+self.y_min).tolist()))
+
+
+
+
+#
+# HELPERS
+#
+def _box_sums(im,size):
+    """ sum of im over the (2*size+1) square around each pixel
+    """
+    height,width=im.shape
+    padded=np.pad(im.astype(np.int64),((size+1,size),(size+1,size)),mode='constant')
+    table=padded.cumsum(axis=0).cumsum(axis=1)
+    n=2*size+1
+    return (
+        table[n:n+height,n:n+width]-table[:height,n:n+width]-
+        table[n:n+height,:width]+table[:height,:width])
+
+
+def _dilate(mask,distance):
+    """ binary dilation by a (2*distance+1) square
+    """
+    if not distance:
+        return mask.copy()
+    height,width=mask.shape
+    padded=np.pad(mask,distance,mode='constant')
+    out=np.zeros_like(mask)
+    for dy in range(2*distance+1):
+        for dx in range(2*distance+1):
+            out|=padded[dy:dy+height,dx:dx+width]
+    return out
@@ -0,0 +1,154 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS=6371008.8
+
+
+class ClusterIndex(object):
+    """ ClusterIndex:
+
+        Lookup index over a clusters dataframe. Returns positional row ids
+        (for use with dataframe.iloc).
+
+        * a hash on (z,x,y) built from the dataframe's tile columns
+        * a kd-tree on the clusters' longitude/latitude. points are
+          indexed as unit vectors so distances are great-circle meters.
+
+        Both structures are built on first use.
+
+        Args:
+            dataframe<dataframe>: clusters dataframe (ClusterService.dataframe)
+    """
+    @staticmethod
+    def unit_vectors(lon,lat):
+        """ (n,3) unit vectors on the sphere for lon/lat in degrees
+        """
+        lon=np.radians(np.asarray(lon,dtype=float))
+        lat=np.radians(np.asarray(lat,dtype=float))
+        cos_lat=np.cos(lat)
+        return np.column_stack([
+            cos_lat*np.cos(lon),
+            cos_lat*np.sin(lon),
+            np.sin(lat)])
+
+
+    @staticmethod
+    def chord_to_meters(chord):
+        return 2*EARTH_RADIUS*np.arcsin(np.clip(chord/2.0,0,1))
+
+
+    @staticmethod
+    def meters_to_chord(meters):
+        return 2*np.sin(np.minimum(meters/(2.0*EARTH_RADIUS),np.pi/2))
+
+
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,dataframe):
+        self.size=dataframe.shape[0]
+        self.z=dataframe.z.values
+        self.x=dataframe.x.values
+        self.y=dataframe.y.values
+        self.i=dataframe.i.values
+        self.j=dataframe.j.values
+        self.longitude=dataframe.longitude.values.astype(float)
+        self.latitude=dataframe.latitude.values.astype(float)
+        self._tiles=None
+        self._tree=None
+
+
+    def tile(self,z,x,y):
+        """ row ids for clusters on tile z/x/y
+        """
+        return self._tile_rows().get((int(z),int(x),int(y)),np.zeros(0,dtype=int))
+
+
+    def pixel(self,z,x,y,i,j):
+        """ row ids for clusters at z/x/y/i/j
+        """
+        rows=self.tile(z,x,y)
+        return rows[(self.i[rows]==i)&(self.j[rows]==j)]
+
+
+    def nearest(self,lon,lat,k=1,max_distance=None):
+        """ nearest clusters to lon/lat
+
+            Args:
+                lon,lat<float|arr>: point(s) in degrees
+                k<int>: number of neighbors
+                max_distance<float>:
+                    max distance in meters. neighbors further away are
+                    returned with an infinite distance and row id=self.size
+
+            Returns:
+                distances (meters), row ids. for scalar lon/lat and k=1
+                these are scalars, otherwise arrays (with a trailing k
+                axis when k>1). if k is larger than the number of clusters
+                the missing neighbors are returned as for max_distance
+        """
+        points=ClusterIndex.unit_vectors(lon,lat)
+        chord=np.full((points.shape[0],k),np.inf)
+        rows=np.full((points.shape[0],k),self.size,dtype=int)
+        if self.size:
+            if max_distance is None:
+                upper=np.inf
+            else:
+                upper=ClusterIndex.meters_to_chord(max_distance)
+            found=min(k,self.size)
+            query_chord,query_rows=self.tree().query(
+                points,
+                k=found,
+                distance_upper_bound=upper)
+            chord[:,:found]=np.reshape(query_chord,(points.shape[0],found))
+            rows[:,:found]=np.reshape(query_rows,(points.shape[0],found))
+        dist=np.where(np.isinf(chord),np.inf,ClusterIndex.chord_to_meters(
+            np.where(np.isinf(chord),0,chord)))
+        if k==1:
+            dist,rows=dist[:,0],rows[:,0]
+        if np.isscalar(lon):
+            dist,rows=dist[0],rows[0]
+        return dist, rows
+
+
+    def within(self,lon,lat,radius):
+        """ row ids (sorted) for clusters within radius meters of lon/lat
+        """
+        rows=self.tree().query_ball_point(
+            ClusterIndex.unit_vectors(lon,lat)[0],
+            ClusterIndex.meters_to_chord(radius))
+        return np.sort(np.asarray(rows,dtype=int))
+
+
+    def bbox(self,min_lon,min_lat,max_lon,max_lat):
+        """ row ids for clusters with lon/lat inside the bbox
+        """
+        return np.nonzero(
+            (self.longitude>=min_lon) & (self.longitude<=max_lon) &
+            (self.latitude>=min_lat) & (self.latitude<=max_lat))[0]
+
+
+    def tree(self):
+        """ kd-tree over cluster unit vectors
+        """
+        if self._tree is None:
+            self._tree=cKDTree(
+                ClusterIndex.unit_vectors(self.longitude,self.latitude))
+        return self._tree
+
+
+    #
+    # INTERNAL METHODS
+    #
+    def _tile_rows(self):
+        if self._tiles is None:
+            keys=np.column_stack([self.z,self.x,self.y]).astype(np.int64)
+            order=np.lexsort(keys.T[::-1])
+            keys=keys[order]
+            is_start=np.ones(self.size,dtype=bool)
+            is_start[1:]=(keys[1:]!=keys[:-1]).any(axis=1)
+            starts=np.nonzero(is_start)[0]
+            self._tiles={
+                tuple(keys[s].tolist()): order[s:e]
+                for s,e in zip(starts,np.append(starts[1:],self.size))}
+        return self._tiles
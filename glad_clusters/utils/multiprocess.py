@@ -1,41 +1,290 @@
-import itertools
+from __future__ import print_function
+import time
+import threading
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+from collections import OrderedDict
+import multiprocessing
 from multiprocessing import Pool
+from multiprocessing import TimeoutError
 from multiprocessing.pool import ThreadPool
 
 
 MAX_POOL_PROCESSES=8
 MAX_THREADPOOL_PROCESSES=64
+POLL_INTERVAL=0.05
 
 
-def map_with_pool(data_load_func,jobs_list,max_processes=MAX_POOL_PROCESSES):
-  pool=Pool(processes=min(len(jobs_list),max_processes))
-  dfs=_run_procs(pool,data_load_func,jobs_list)
-  _stop_pool(pool)
-  return dfs.get()
+#
+# PUBLIC
+#
+def map_with_pool(data_load_func,jobs_list,max_processes=MAX_POOL_PROCESSES,chunksize=None,**kwargs):
+  """ ordered list of data_load_func(job) for jobs_list on a process pool
+      (see imap_with_pool for kwargs)
+  """
+  return list(imap_with_pool(
+    data_load_func,
+    jobs_list,
+    max_processes,
+    chunksize=chunksize,
+    ordered=True,
+    **kwargs))
 
 
-def map_with_threadpool(data_load_func,jobs_list,max_processes=MAX_THREADPOOL_PROCESSES):
-  pool=ThreadPool(processes=min(len(jobs_list),max_processes))
-  dfs=_run_procs(pool,data_load_func,jobs_list)
-  _stop_pool(pool)
-  return dfs.get()
+def map_with_threadpool(data_load_func,jobs_list,max_processes=MAX_THREADPOOL_PROCESSES,chunksize=None,**kwargs):
+  """ ordered list of data_load_func(job) for jobs_list on a thread pool
+      (see imap_with_pool for kwargs)
+  """
+  return list(imap_with_threadpool(
+    data_load_func,
+    jobs_list,
+    max_processes,
+    chunksize=chunksize,
+    ordered=True,
+    **kwargs))
 
 
-def _stop_pool(pool):
-  pool.close()
-  pool.join()
-  return True
+def imap_with_pool(data_load_func,jobs,max_processes=MAX_POOL_PROCESSES,**kwargs):
+  """ stream data_load_func(job) for jobs on a process pool
+
+      Jobs are read lazily and sent to the pool in chunks. At most
+      max_pending chunks are in flight, so a slow consumer (or a
+      generator of large jobs) does not fill memory. Results are yielded
+      as chunks complete. Leaving the loop early, an exception,
+      KeyboardInterrupt or setting cancel terminates the pool.
+
+      Args:
+        data_load_func<func>: function of a job (picklable for process pools)
+        jobs<iterable>: list or generator of jobs
+        max_processes<int>: pool size
+        chunksize<int[1]>:
+          jobs per task. None uses the map_async heuristic for lists
+          (len/(4*processes))
+        ordered<bool[False]>: if true yield results in job order
+        progress<func>: progress(nb_done,nb_jobs) called after each chunk
+          (nb_jobs is None for generators)
+        timeout<float>:
+          max seconds per job (times the chunk size) from the start of a
+          chunk. chunks that take longer are abandoned
+        timeout_result<func>:
+          timeout_result(job) is yielded for the jobs of abandoned chunks.
+          if None a multiprocessing.TimeoutError is raised
+        max_pending<int>: max chunks in flight (defaults to the pool size)
+        cancel<threading.Event>: stop submitting and return once set
+  """
+  return _imap(Pool,data_load_func,jobs,max_processes,**kwargs)
+
+
+def imap_with_threadpool(data_load_func,jobs,max_processes=MAX_THREADPOOL_PROCESSES,**kwargs):
+  """ stream data_load_func(job) for jobs on a thread pool (see
+      imap_with_pool). on cancellation, running jobs finish in the
+      background and queued jobs are skipped
+  """
+  return _imap(ThreadPool,data_load_func,jobs,max_processes,**kwargs)
 
 
-def _run_procs(pool,map_func,objects):
+#
+# INTERNAL
+#
+def _imap(
+    pool_class,
+    func,
+    jobs,
+    max_processes,
+    chunksize=1,
+    ordered=False,
+    progress=None,
+    timeout=None,
+    timeout_result=None,
+    max_pending=None,
+    cancel=None):
+  nb_jobs=_size(jobs)
+  if nb_jobs==0:
+    return
+  processes=max_processes if nb_jobs is None else min(nb_jobs,max_processes)
+  chunksize=chunksize or _chunksize(nb_jobs,processes)
+  max_pending=max_pending or processes
+  stop=threading.Event()
+  if pool_class is ThreadPool:
+    tasks=_Tasks(queue.Queue(),processes)
+    worker=_thread_worker(func,stop,tasks.started,tasks.cancelled)
+    pool=ThreadPool(processes=processes)
+  else:
+    tasks=_Tasks(multiprocessing.Queue(),processes)
+    worker=_process_worker
+    pool=Pool(
+      processes=processes,
+      initializer=_init_process,
+      initargs=(tasks.started,))
+  chunks=_chunks(jobs,chunksize)
+  nb_submitted=0
+  nb_done=0
+  clean=False
   try:
-    return pool.map_async(map_func,objects)
+    while True:
+      while (len(tasks.pending)<max_pending) and not (cancel and cancel.is_set()):
+        chunk=next(chunks,None)
+        if chunk is None:
+          break
+        if pool_class is ThreadPool:
+          args=((nb_submitted,chunk),)
+        else:
+          args=((func,nb_submitted,chunk),)
+        tasks.pending[nb_submitted]=(
+          chunk,
+          pool.apply_async(worker,args,callback=lambda _: tasks.wake.set()))
+        nb_submitted+=1
+      if (not tasks.pending) or (cancel and cancel.is_set()):
+        clean=(not tasks.pending) and (not tasks.nb_abandoned)
+        break
+      results=tasks.next_results(ordered,timeout,timeout_result)
+      nb_done+=len(results)
+      if progress:
+        progress(nb_done,nb_jobs)
+      for result in results:
+        yield result
   except KeyboardInterrupt:
     print("Caught KeyboardInterrupt, terminating workers")
-    pool.terminate()
-    return False
-  else:
-    print("Normal termination")
+    raise
+  finally:
+    stop.set()
+    _stop_pool(pool,terminate=not clean)
+
+
+class _Tasks(object):
+  """ chunks in flight
+
+      Workers put (index,time) on the started queue when they pick up a
+      chunk, so the timeout runs from the start of a chunk rather than
+      from its submission. Abandoned chunks are not pending (they do not
+      count toward max_pending) but their worker stays busy until they
+      finish: once all workers are busy with abandoned chunks the chunks
+      that have not started are abandoned as well (and skipped by thread
+      pool workers).
+  """
+  def __init__(self,started,processes):
+    self.started=started
+    self.processes=processes
+    self.pending=OrderedDict()
+    self.starts={}
+    self.running={}
+    self.cancelled=set()
+    self.nb_abandoned=0
+    self.wake=threading.Event()
+
+
+  def next_results(self,ordered,timeout,timeout_result):
+    """ results of the next completed (or first if ordered) chunk
+    """
+    while True:
+      self.wake.clear()
+      self._read_starts()
+      indices=[next(iter(self.pending))] if ordered else list(self.pending)
+      now=time.time()
+      stuck=self._nb_busy()>=self.processes
+      for index in indices:
+        chunk,result=self.pending[index]
+        if result.ready():
+          del self.pending[index]
+          self.starts.pop(index,None)
+          return result.get()
+        start=self.starts.get(index)
+        if timeout and (
+            ((start is not None) and ((now-start)>(timeout*len(chunk)))) or
+            ((start is None) and stuck)):
+          del self.pending[index]
+          self.cancelled.add(index)
+          self.running[index]=result
+          self.nb_abandoned+=1
+          if timeout_result is None:
+            raise TimeoutError('job timed out after {}s'.format(timeout))
+          return [timeout_result(job) for job in chunk]
+      self.wake.wait(POLL_INTERVAL)
+
+
+  def _read_starts(self):
+    while True:
+      try:
+        index,start=self.started.get_nowait()
+      except queue.Empty:
+        return
+      self.starts[index]=start
+
+
+  def _nb_busy(self):
+    """ number of abandoned chunks still running
+    """
+    for index in [i for i,r in self.running.items() if r.ready()]:
+      del self.running[index]
+      self.starts.pop(index,None)
+    return sum(1 for index in self.running if index in self.starts)
+
+
+def _stop_pool(pool,terminate=False):
+  if not terminate:
     pool.close()
     pool.join()
-    return False
+  elif isinstance(pool,ThreadPool):
+    # threads can not be killed: queued chunks are skipped (see
+    # _thread_worker) and running ones finish in the background
+    pool.close()
+  else:
+    pool.terminate()
+    pool.join()
+  return True
+
+
+def _thread_worker(func,stop,started,cancelled):
+  def _run(args):
+    index,chunk=args
+    if index in cancelled:
+      return []
+    started.put((index,time.time()))
+    results=[]
+    for job in chunk:
+      if stop.is_set():
+        break
+      results.append(func(job))
+    return results
+  return _run
+
+
+_STARTED=None
+
+
+def _init_process(started):
+  global _STARTED
+  _STARTED=started
+
+
+def _process_worker(args):
+  func,index,chunk=args
+  _STARTED.put((index,time.time()))
+  return [func(job) for job in chunk]
+
+
+def _size(jobs):
+  try:
+    return len(jobs)
+  except TypeError:
+    return None
+
+
+def _chunksize(nb_jobs,processes):
+  if nb_jobs is None:
+    return 1
+  chunksize,extra=divmod(nb_jobs,processes*4)
+  return chunksize+1 if extra else max(chunksize,1)
+
+
+def _chunks(jobs,chunksize):
+  chunk=[]
+  for job in jobs:
+    chunk.append(job)
+    if len(chunk)==chunksize:
+      yield chunk
+      chunk=[]
+  if chunk:
+    yield chunk
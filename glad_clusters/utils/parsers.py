@@ -40,6 +40,9 @@ coord_group_m.add_argument("--xy", nargs=2, type=int,  # action=ToXY,
 coord_group_m.add_argument("--tile_bounds", type=str, action=ToListAction,
                            metavar=[["minX", "minY"], ["maxX", "maxY"]],
                            help="Bounding box for x/y tiles")
+coord_group_m.add_argument("--aoi", type=str,
+                           metavar="GEOJSON",
+                           help="Polygon/MultiPolygon GeoJSON (path or string), only intersecting tiles are run")
 
 # Cluster group
 cluster_group = service_parser.add_argument_group("Cluster settings", "Configure the cluster.")
@@ -51,6 +54,29 @@ cluster_group.add_argument("-c", "--min_count", dest="min_count",
                            help="Minimum number of alerts in a cluster", type=int, default=25)
 cluster_group.add_argument("-i", "--iterations", dest="iterations",
                            help="Number of times to iterate when finding clusters", type=int, default=25)
+cluster_group.add_argument("--halo", dest="halo", type=int,
+                           help="Cluster each tile with a margin of HALO*width pixels from its neighbors")
+cluster_group.add_argument("--threads", dest="threads", type=int,
+                           help="Compute MShift point weights by blocks on THREADS threads")
+cluster_group.add_argument("--stitch", dest="stitch", action="store_true",
+                           help="Merge clusters split across tile seams (alerts within width pixels)")
+cluster_group.add_argument("--clip", dest="clip", action="store_true",
+                           help="Remove clusters whose center is outside of the --aoi polygons")
+cluster_group.add_argument("--regional", dest="regional", action="store_true",
+                           help="Run locally with the halo-tiling regional engine instead of lambda")
+cluster_group.add_argument("--tile_url", dest="tile_url", type=str,
+                           help="URL/folder of GLAD tiles for --regional/--hotspots (default environ['url'])")
+cluster_group.add_argument("--hotspots", dest="hotspots", type=float, nargs="?", const=1.0,
+                           help="Only run tiles under or near z10 hotspots. Optional threshold as a fraction of "
+                                "min_count (default 1.0, higher skips more tiles at the cost of recall)")
+cluster_group.add_argument("--cache", dest="cache", type=str, metavar="CACHE_DIR",
+                           help="Local result cache directory. Tiles with cached results are not run again")
+cluster_group.add_argument("--split_count", dest="split_count", type=int,
+                           help="Run tiles with at least SPLIT_COUNT alerts (in --history) as quadrant jobs (default 20000)")
+cluster_group.add_argument("--history", dest="history", type=str, metavar="HISTORY_FILE",
+                           help="Runtime history file. Tiles are run longest (predicted) first and the history is updated after each run")
+cluster_group.add_argument("--hotspot_sample", dest="hotspot_sample", type=float,
+                           help="Fraction of skipped tiles run anyway to estimate --hotspots recall (default 0.05, 0 to skip)")
 
 # Date group
 date_group = service_parser.add_argument_group("Dates", "Set start and end date.")
@@ -59,6 +85,9 @@ date_group.add_argument("--start_date", dest="start_date", type=str,
                         metavar="YYYY-MM-DD", help="Start date")
 date_group.add_argument("--end_date", dest="end_date", type=str,
                         metavar="YYYY-MM-DD", help="End date (optional), default today")
+date_group.add_argument("--windows", dest="windows", type=str, action=ToListAction,
+                        metavar=[["START_DATE", "END_DATE"]],
+                        help="List of date windows, each tile is read once and clustered for every window")
 
 ################
 ## Save parser
@@ -77,6 +106,8 @@ save_group.add_argument("--bucket", dest="bucket", type=str,
                         help="S3 bucket in which CSV file will be saved (optional)")
 save_group.add_argument("--temp_dir", dest="temp_dir", type=str,
                         help="Temp directory.")
+save_group.add_argument("--format", dest="format", choices=["csv", "npz", "parquet"],
+                        help="File format (default csv)", default="csv")
 
 
 #############
@@ -86,26 +117,37 @@ save_group.add_argument("--temp_dir", dest="temp_dir", type=str,
 export_parser = argparse.ArgumentParser(add_help=False)
 
 export_group = export_parser.add_argument_group("Export settings", "Export data.")
-export_group.add_argument("--format", dest="format", choices=["PG"],
-                          help="Export format (default PG)", default="PG")
+export_group.add_argument("--format", dest="format", choices=["PG", "geojson", "fgb"],
+                          help="Export format (default PG). geojson: newline-delimited GeoJSON, fgb: FlatGeobuf",
+                          default="PG")
+export_group.add_argument("-f", "--file", dest="filename", type=str,
+                          help="File name/path without extension (geojson/fgb)")
+export_group.add_argument("--geometry", dest="geometry", choices=["concave", "convex", "centroid"],
+                          help="Feature geometry for geojson/fgb (default concave)")
 export_group.add_argument("--pg_table", dest="pg_table", type=str,
                           help="PostgreSQL table name")
 export_group.add_argument("--pg_schema", dest="pg_schema", type=str,
                           help="PostgreSQL schema name")
 export_group.add_argument("--pg_dbname", dest="pg_dbname", type=str,
-                          required=True, help="PostgreSQL database name")
+                          help="PostgreSQL database name (required for PG)")
 export_group.add_argument("--pg_host", dest="pg_host", type=str,
                           help="PostgreSQL host")
 export_group.add_argument("--pg_port", dest="pg_port", type=str,
                           help="PostgreSQL port")
 export_group.add_argument("--pg_user", dest="pg_user", type=str,
-                          required=True, help="PostgreSQL user")
+                          help="PostgreSQL user (required for PG)")
 export_group.add_argument("--pg_password", dest="pg_password", type=str,
-                          required=True, help="PostgreSQL password")
+                          help="PostgreSQL password")
 export_group.add_argument("--concave", dest="concave", type=int,
                           help="Target percent of area for concave hull. Integers between 0 and 100." \
                                "When set to 100, area is equal to convex hull")
 export_group.add_argument("--temp_dir", dest="temp_dir", type=str,
-                          help="Temp directory. Make sure this directory is accessible for postgres user")
+                          help="Output directory for geojson/fgb (not used for PG, data is streamed to the database)")
 export_group.add_argument("--overwrite", dest="overwrite", action='store_true',
                           help="Overwrite existing table")
+export_group.add_argument("--upsert", dest="upsert", action='store_true',
+                          help="Update existing table, only replacing clusters for tiles that changed")
+export_group.add_argument("--pg_processes", dest="pg_processes", type=int,
+                          help="Number of database connections used to compute concave hulls")
+export_group.add_argument("--concave_batch_size", dest="concave_batch_size", type=int,
+                          help="Number of rows per concave hull batch")
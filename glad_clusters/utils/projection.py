@@ -0,0 +1,82 @@
+import numpy as np
+from glad_clusters.utils.alerts import I, J
+
+TILE_SIZE=256.0
+
+
+#
+# TILE/PIXEL -> LON/LAT
+#
+# i,j are the pixel row and column in the tile, as in MShift, the clusters
+# dataframe and alerts (see alerts.I/J): i runs along y and j along x
+#
+def lon(z,x,y=None,i=0,j=0):
+    """ longitude from z/x/y/i/j (scalars or arrays)
+    """
+    z,x,j=_floats(z,x,j)
+    return (360.0/np.power(2.0,z))*(x+(j/TILE_SIZE))-180.0
+
+
+def lat(z,x,y,i=0,j=0):
+    """ latitude from z/x/y/i/j (scalars or arrays)
+    """
+    z,y,i=_floats(z,y,i)
+    lat_rad=np.arctan(np.sinh(np.pi*(1-(2*(y+(i/TILE_SIZE))/np.power(2.0,z)))))
+    return np.degrees(lat_rad)
+
+
+def lonlat(z,x,y,i=0,j=0):
+    """ longitude, latitude from z/x/y/i/j (scalars or arrays)
+    """
+    return lon(z,x,y,i,j), lat(z,x,y,i,j)
+
+
+def alerts_lonlat(z,x,y,alerts):
+    """ longitude, latitude for alerts
+
+        Args:
+            z,x,y<int|arr>: tile for each alert (or scalars)
+            alerts<arr>:
+                (N,2+) array of [i,j,...] values (as cluster alerts)
+
+        Returns:
+            (N,) longitude array, (N,) latitude array
+    """
+    alerts=np.asarray(alerts)
+    return lonlat(z,x,y,alerts[:,I],alerts[:,J])
+
+
+#
+# LON/LAT -> TILE
+#
+def lonlat_to_xy(lon,lat,z):
+    """ tile x,y containing lon/lat (scalars or arrays)
+    """
+    n=np.power(2.0,z)
+    lat_rad=np.radians(lat)
+    x=n*(np.asarray(lon,dtype=float)+180.0)/360
+    y=n*(1.0-np.log(np.tan(lat_rad)+(1/np.cos(lat_rad)))/np.pi)/2.0
+    return _ints(x), _ints(y)
+
+
+def lonlat_to_pixel(lon,lat,z):
+    """ fractional global pixel coordinates (x*256+j,y*256+i) for lon/lat
+    """
+    n=np.power(2.0,z)*TILE_SIZE
+    lat_rad=np.radians(lat)
+    px=n*(np.asarray(lon,dtype=float)+180.0)/360
+    py=n*(1.0-np.log(np.tan(lat_rad)+(1/np.cos(lat_rad)))/np.pi)/2.0
+    return px, py
+
+
+#
+# INTERNAL
+#
+def _floats(*values):
+    return [np.asarray(v,dtype=float) if not np.isscalar(v) else float(v) for v in values]
+
+
+def _ints(values):
+    if np.isscalar(values) or np.ndim(values)==0:
+        return int(values)
+    return np.asarray(values).astype(int)
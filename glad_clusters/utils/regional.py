@@ -0,0 +1,277 @@
+from __future__ import print_function
+import os
+from collections import deque
+from datetime import datetime
+import numpy as np
+import imageio as io
+import glad_clusters.utils.multiprocess as mp
+import glad_clusters.clusters.processors as proc
+import glad_clusters.clusters.halo as halo
+from glad_clusters.clusters.meanshift import MShift
+
+
+TILE_SIZE=256
+URL_TMPL='{}/{}/{}/{}.png'
+FILE_NAME_TMPL='{}/{}/{}.png'
+DEFAULT_URL='http://wri-tiles.s3.amazonaws.com/glad_prod/tiles'
+TIMESTAMP_FMT="%Y%m%d::%H:%M:%S"
+DEFAULT_HALO=3
+BUFFER_ROWS=3
+READ_THREADS=16
+DAYS_DTYPE=np.uint16
+
+
+
+
+class HaloTileEngine(object):
+    """ HaloTileEngine:
+
+        Halo (per-tile) clustering of a tile-bounding-box on a single 
+        machine. Tile rows are streamed (north to south) through a rolling
+        buffer of BUFFER_ROWS decoded rows, so each tile is read once. Once
+        the row below a tile is buffered, MShift is run on the tile plus a
+        margin of halo*width pixels cut from its 8 buffered neighbors, and
+        only clusters whose mode is on the tile are kept. This is the same
+        clustering as lambda runs with halo set.
+
+        Mean-shift is not run over global coordinates: a cluster only sees
+        the alerts within the margin of its mode's tile. Clusters wider than
+        halo*width pixels are still cut at tile seams. Use 
+        ClusterService.stitch to merge them.
+
+        Memory is bounded by BUFFER_ROWS rows of (uint16) days-since images
+        whatever the number of rows in the region. With processes, tile 
+        windows are streamed through a single process pool (see 
+        multiprocess.imap_with_pool) which only reads ahead max_pending
+        windows, so the next row is read while the current one is 
+        clustered.
+
+        Args:
+            z<int>: tile-zoom
+            tile_bounds<list>: [[x_min,y_min],[x_max,y_max]]
+            start_date,end_date<str>: 'yyyy-mm-dd'
+            width,min_count,iterations<int>: MShift params
+            halo<int[DEFAULT_HALO]>: margin (in widths) around each tile
+            url<str>:
+                url/folder of glad tiles (url/z/x/y.png). defaults to
+                environ['url'] or DEFAULT_URL
+            read_func<func>:
+                read_func(z,x,y) returns the glad image or None. if set
+                url is ignored
+            processes<int>:
+                if set, tiles are clustered in a process pool of this size
+            read_threads<int[READ_THREADS]>: threads used to read a row
+            concave<int>: concave hull percent passed to MShift
+            threads<int>: MShift threads (see MShift)
+            tiles<list>: 
+                if set only clusters for these tiles (x,y) are computed 
+                (ie the cover of an aoi)
+    """
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,
+            z,
+            tile_bounds,
+            start_date,
+            end_date,
+            width,
+            min_count,
+            iterations,
+            halo=DEFAULT_HALO,
+            url=None,
+            read_func=None,
+            processes=None,
+            read_threads=READ_THREADS,
+            concave=None,
+            threads=None,
+            tiles=None):
+        (self.x_min,self.y_min),(self.x_max,self.y_max)=np.sort(
+            np.array(tile_bounds,dtype=int),axis=0).tolist()
+        self.z=int(z)
+        self.start_date=start_date
+        self.end_date=end_date
+        self.width=width
+        self.min_count=min_count
+        self.iterations=iterations
+        self.halo=halo or DEFAULT_HALO
+        self.url=url or os.environ.get('url') or DEFAULT_URL
+        self.read_func=read_func or self._read_tile
+        self.processes=processes
+        self.read_threads=read_threads
+        self.concave=concave
+        self.threads=threads
+        self.tiles=set(tiles) if tiles is not None else None
+        self.margin=min(int(self.halo*self.width),TILE_SIZE)
+        self.timestamp=datetime.now().strftime(TIMESTAMP_FMT)
+        self.nb_tiles_read=0
+
+
+    def responses(self,progress=None):
+        """ iterator of processed tile responses (see
+            ClusterService._process_response) row by row
+
+            Tiles without clusters yield None.
+
+            Args:
+                progress<func>: 
+                    progress(nb_done,None) called as tiles complete (with 
+                    processes)
+        """
+        if self.processes:
+            return mp.imap_with_pool(
+                _cluster_tile,
+                self.jobs(),
+                self.processes,
+                ordered=True,
+                progress=progress,
+                max_pending=2*self.processes)
+        else:
+            return (_cluster_tile(job) for job in self.jobs())
+
+
+    def jobs(self):
+        """ generator of (request-data,window) for tiles with alerts in
+            their window, row by row
+        """
+        buffer=deque(maxlen=BUFFER_ROWS)
+        for y in range(self.y_min-1,self.y_max+2):
+            buffer.append((y,self._read_row(y)))
+            if len(buffer)==BUFFER_ROWS:
+                for job in self._row_jobs(buffer):
+                    yield job
+
+
+    def tile_window(self,buffer,x):
+        """ days-since window for tile x of the center row of buffer
+
+            Returns:
+                None if there are no alerts in the window, otherwise the
+                (TILE_SIZE+2*margin,TILE_SIZE+2*margin) window of global
+                pixels centered on the tile
+        """
+        rows=[row for _,row in buffer]
+        core=rows[1].get(x)
+        strips={}
+        for dx,dy in halo.NEIGHBORS:
+            tile=rows[1+dy].get(self._wrap(x+dx))
+            if tile is not None:
+                strips[(dx,dy)]=halo.neighbor_strip(
+                    halo.border_frame(tile,self.margin),dx,dy,self.margin)
+        if (core is None) and (not strips):
+            return None
+        if core is None:
+            core=np.zeros((TILE_SIZE,TILE_SIZE),dtype=DAYS_DTYPE)
+        window=halo.halo_data(core,strips,self.margin)
+        if not window.any():
+            return None
+        return window
+
+
+    #
+    # INTERNAL METHODS
+    #
+    def _read_row(self,y):
+        """ dict of x: days-since image for the tiles of row y within
+            the bounds (plus one tile on each side). missing tiles and
+            tiles without alerts are not kept
+        """
+        n=2**self.z
+        if (y<0) or (y>=n):
+            return {}
+        xs=[self._wrap(x) for x in range(self.x_min-1,self.x_max+2)]
+        xs=sorted(set(xs))
+        tiles=mp.map_with_threadpool(
+            lambda x: self._days(x,y),
+            xs,
+            max_processes=self.read_threads)
+        self.nb_tiles_read+=len(xs)
+        return { x: days for x,days in zip(xs,tiles) if days is not None }
+
+
+    def _days(self,x,y):
+        im=self.read_func(self.z,x,y)
+        if (im is None) or (im is False):
+            return None
+        days=proc.glad_between_dates(im,self.start_date,self.end_date)
+        if not days.any():
+            return None
+        return days.astype(DAYS_DTYPE)
+
+
+    def _row_jobs(self,buffer):
+        y=buffer[1][0]
+        jobs=[]
+        for x in range(self.x_min,self.x_max+1):
+            if (self.tiles is not None) and ((x,y) not in self.tiles):
+                continue
+            window=self.tile_window(buffer,x)
+            if window is not None:
+                jobs.append((self._request_data(x,y),window))
+        return jobs
+
+
+    def _request_data(self,x,y):
+        return {
+            "z": self.z,
+            "x": x,
+            "y": y,
+            "start_date": self.start_date,
+            "end_date": self.end_date,
+            "min_count": self.min_count,
+            "width": self.width,
+            "iterations": self.iterations,
+            "halo": self.halo,
+            "concave": self.concave,
+            "threads": self.threads,
+            "margin": self.margin,
+            "file_name": FILE_NAME_TMPL.format(self.z,x,y),
+            "timestamp": self.timestamp }
+
+
+    def _read_tile(self,z,x,y):
+        return read_tile(self.url,z,x,y)
+
+
+    def _wrap(self,x):
+        return x%(2**self.z)
+
+
+
+
+#
+# PUBLIC
+#
+def read_tile(url,z,x,y):
+    """ glad image at url/z/x/y.png (None if missing)
+    """
+    try:
+        return io.imread(URL_TMPL.format(url,z,x,y))
+    except Exception:
+        return None
+
+
+#
+# HELPERS
+#
+def _cluster_tile(job):
+    """ cluster a tile window (module level for process pools)
+    """
+    data,window=job
+    margin=data.pop('margin')
+    mshift=MShift(
+        data=window.astype(float),
+        width=data['width'],
+        min_count=data['min_count'],
+        iterations=data['iterations'],
+        concave=data['concave'],
+        core=halo.core_bounds(margin),
+        origin=(margin,margin),
+        threads=data.pop('threads',None))
+    clusters=mshift.clusters_data()
+    nb_clusters=clusters.pop('nb_clusters',0)
+    if not nb_clusters:
+        return None
+    data['data']=clusters
+    data['nb_clusters']=nb_clusters
+    return data
@@ -0,0 +1,222 @@
+import re
+import json
+import itertools
+import numpy as np
+import pandas as pd
+import glad_clusters.utils.projection as proj
+from glad_clusters.utils.alerts import RaggedAlerts
+
+
+PAYLOAD_KEY='payload'
+POOL_THRESHOLD=2000
+CLUSTER_KEYS=['count','area','min_date','max_date','i','j']
+WINDOW_KEY='window'
+PARTIAL_KEY='partial'
+NB_ALERTS_KEY='nb_alerts'
+INT_DTYPE=np.int32
+CATEGORICAL_COLUMNS=['file_name','timestamp']
+
+
+#
+# PUBLIC
+#
+def decode(response):
+    """ decode raw lambda payload kept under PAYLOAD_KEY (if any)
+
+        Args:
+            response<dict|None>: processed response
+
+        Returns:
+            response dict with the payload merged in
+    """
+    if response and (PAYLOAD_KEY in response):
+        response=dict(response)
+        payload=response.pop(PAYLOAD_KEY)
+        if payload:
+            payload=json.loads(payload)
+            if payload: response.update(payload)
+    return response
+
+
+def has_key(response,key):
+    """ true if the processed response has a truthy top-level key
+
+        Raw payloads (PAYLOAD_KEY) are not decoded but searched for the
+        json key. Only use this for keys the handler writes when they are
+        set and which do not occur in the clusters data (PARTIAL_KEY, 
+        'error', 'errorMessage', 'unchanged').
+    """
+    if not response:
+        return False
+    if response.get(key):
+        return True
+    payload=response.get(PAYLOAD_KEY)
+    if not payload:
+        return False
+    token='"{}"'.format(key)
+    if isinstance(payload,bytes):
+        token=token.encode('utf-8')
+    return token in payload
+
+
+def is_partial(response):
+    """ true if the lambda stopped clustering at its deadline (see
+        MShift deadline)
+    """
+    return has_key(response,PARTIAL_KEY)
+
+
+def is_error(response):
+    """ true for error responses (handler errors or lambda failures)
+    """
+    return has_key(response,'error') or has_key(response,'errorMessage')
+
+
+def alert_count(response):
+    """ number of alerts on the tile, clustered or not, as reported by
+        the handler (NB_ALERTS_KEY). raw payloads are searched for the
+        key without being decoded
+
+        Returns:
+            int or None if the response does not report it
+    """
+    if not response:
+        return None
+    if response.get(NB_ALERTS_KEY) is not None:
+        return int(response[NB_ALERTS_KEY])
+    payload=response.get(PAYLOAD_KEY)
+    if not payload:
+        return None
+    if isinstance(payload,bytes):
+        payload=payload.decode('utf-8')
+    match=re.search(r'"{}":\s*(\d+)'.format(NB_ALERTS_KEY),payload)
+    return int(match.group(1)) if match else None
+
+
+def tile_columns(response):
+    """ typed column arrays for a single tile response
+
+        Args:
+            response<dict|None>: processed (possibly undecoded) response
+
+        Returns:
+            None, ('error',response) or ('clusters',columns-dict)
+    """
+    response=decode(response)
+    if not response:
+        return None
+    if response.get('error') or response.get('errorMessage'):
+        return 'error', response
+    clusters=response.get('data',{}).get('clusters',[])
+    if not clusters:
+        return None
+    keys=_cluster_keys(response)
+    values=np.array(
+        [[c.get(k) for k in keys] for c in clusters],
+        dtype=np.int64).reshape(-1,len(keys))
+    counts=np.array([len(c.get('alerts',[])) for c in clusters],dtype=np.int64)
+    alerts=np.array(
+        list(itertools.chain.from_iterable(c.get('alerts',[]) for c in clusters)),
+        dtype=INT_DTYPE).reshape(-1,3)
+    columns={ k: values[:,n].astype(INT_DTYPE) for n,k in enumerate(keys) }
+    columns.update({
+        'z': int(response.get('z')),
+        'x': int(response.get('x')),
+        'y': int(response.get('y')),
+        'file_name': response.get('file_name'),
+        'timestamp': response.get('timestamp'),
+        'alerts': alerts,
+        'alerts_counts': counts })
+    return 'clusters', columns
+
+
+def build(responses,columns,processes=None,map_func=None):
+    """ build clusters dataframe and alerts from responses
+
+        Each tile response is converted to typed column arrays (optionally
+        in a process pool, see POOL_THRESHOLD) which are then concatenated
+        in descending timestamp order.
+
+        Args:
+            responses<list>: processed responses
+            columns<list>: dataframe columns. 'index' is prepended and
+                'alerts' is returned separately as RaggedAlerts
+            processes<int>: if set and there are more than POOL_THRESHOLD
+                responses, decode/convert responses using map_func
+            map_func<func>: map_func(func,items,max_processes)
+
+        Returns:
+            dataframe, RaggedAlerts, list of error responses
+    """
+    responses=responses or []
+    if processes and map_func and (len(responses)>=POOL_THRESHOLD):
+        tiles=map_func(tile_columns,responses,processes)
+    else:
+        tiles=[tile_columns(r) for r in responses]
+    errors=[t[1] for t in tiles if t and (t[0]=='error')]
+    tiles=[t[1] for t in tiles if t and (t[0]=='clusters')]
+    sizes=np.array([t['count'].shape[0] for t in tiles],dtype=np.int64)
+    starts=np.cumsum(sizes)-sizes
+    order=_order(tiles)
+    tiles=[tiles[k] for k in order]
+    return (
+        _dataframe(tiles,sizes[order],starts[order],columns),
+        _alerts(tiles),
+        errors)
+
+
+#
+# INTERNAL
+#
+def _order(tiles):
+    """ tile order for descending timestamps (ties keep response order)
+    """
+    timestamps=np.array([str(t['timestamp']) for t in tiles])
+    if not len(timestamps):
+        return np.zeros(0,dtype=int)
+    _,ranks=np.unique(timestamps,return_inverse=True)
+    return np.lexsort((np.arange(len(tiles)),-ranks))
+
+
+def _dataframe(tiles,sizes,starts,columns):
+    columns=['index']+[c for c in columns if c!='alerts']
+    if not tiles:
+        return pd.DataFrame(columns=columns)
+    data={}
+    for key in CLUSTER_KEYS+[WINDOW_KEY]:
+        if key in columns:
+            data[key]=np.concatenate([t[key] for t in tiles])
+    for key in ['z','x','y']:
+        data[key]=np.repeat(
+            np.array([t[key] for t in tiles],dtype=INT_DTYPE),sizes)
+    for key in CATEGORICAL_COLUMNS:
+        values=np.array([str(t[key]) for t in tiles])
+        categories,codes=np.unique(values,return_inverse=True)
+        data[key]=pd.Categorical.from_codes(np.repeat(codes,sizes),categories)
+    data['longitude'],data['latitude']=proj.lonlat(
+        data['z'],data['x'],data['y'],data['i'],data['j'])
+    data['index']=np.repeat(starts,sizes)+_ranges(sizes)
+    return pd.DataFrame(data,columns=columns)
+
+
+def _cluster_keys(response):
+    """ CLUSTER_KEYS plus WINDOW_KEY for multi-window responses
+    """
+    if response.get('windows'):
+        return CLUSTER_KEYS+[WINDOW_KEY]
+    return CLUSTER_KEYS
+
+
+def _alerts(tiles):
+    if not tiles:
+        return RaggedAlerts.from_arrays([])
+    return RaggedAlerts.from_counts(
+        np.concatenate([t['alerts'] for t in tiles]),
+        np.concatenate([t['alerts_counts'] for t in tiles]))
+
+
+def _ranges(sizes):
+    """ concatenated aranges: [0..sizes[0]),[0..sizes[1]),...
+    """
+    starts=np.cumsum(sizes)-sizes
+    return np.arange(sizes.sum())-np.repeat(starts,sizes)
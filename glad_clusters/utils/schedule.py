@@ -0,0 +1,247 @@
+from __future__ import print_function
+import os
+import json
+import threading
+import numpy as np
+import glad_clusters.utils.responses as resp
+
+
+DEFAULT_PATH=os.path.join(os.path.expanduser('~'),'.glad_clusters','runtimes.json')
+DEFAULT_RUNTIME=1.0
+SMOOTHING=0.5
+MIN_MODEL_TILES=3
+KEY_TMPL='{}/{}/{}'
+DEFAULT_PARAMETERS=''
+
+
+
+
+class RuntimeHistory(object):
+    """ RuntimeHistory:
+
+        Per-tile runtime store used to schedule runs longest-first. For
+        each tile (z/x/y) it keeps an exponentially smoothed runtime
+        (seconds) and the number of alerts (clustered or not) of its last
+        run.
+        Tiles are grouped by request parameters (see 
+        ClusterService.parameter_key) so runs with different dates or
+        widths do not share runtimes, counts or models.
+
+        The cost of a tile is predicted from (in order):
+
+            * its smoothed runtime
+            * its alert count (from the history or passed in, ie from a
+              prior run with tile_counts) through a quadratic runtime model
+              (MShift is quadratic in the number of alerts) fit on the
+              tiles with both a runtime and a count
+            * the median runtime of the parameters' tiles (DEFAULT_RUNTIME 
+              if there are none)
+
+        Args:
+            path<str[DEFAULT_PATH]>: json file (None to keep in memory)
+            smoothing<float[SMOOTHING]>: weight of new runtimes
+    """
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,path=DEFAULT_PATH,smoothing=SMOOTHING):
+        self.path=path
+        self.smoothing=smoothing
+        self._lock=threading.Lock()
+        self._models={}
+        self.groups=self._load()
+
+
+    def tiles(self,parameters=DEFAULT_PARAMETERS):
+        """ dict of z/x/y: tile history for parameters
+        """
+        return self.groups.get(parameters,{})
+
+
+    def runtime(self,z,x,y,parameters=DEFAULT_PARAMETERS):
+        """ smoothed runtime of tile (None if it has not been run)
+        """
+        return self.tiles(parameters).get(_key(z,x,y),{}).get('runtime')
+
+
+    def count(self,z,x,y,parameters=DEFAULT_PARAMETERS):
+        """ alert count of the last run of tile (None if unknown)
+        """
+        return self.tiles(parameters).get(_key(z,x,y),{}).get('count')
+
+
+    def predict(self,z,tiles,counts=None,parameters=DEFAULT_PARAMETERS):
+        """ (n,) predicted runtimes for tiles
+
+            Args:
+                z<int>: tile-zoom
+                tiles<list>: tile-xy values (x,y)
+                counts<dict>:
+                    optional (x,y): alert count used for tiles without
+                    a runtime (takes precedence over stored counts)
+                parameters<str[DEFAULT_PARAMETERS]>: 
+                    request parameters key (see ClusterService.parameter_key)
+        """
+        counts=counts or {}
+        default=self._default(parameters)
+        costs=np.full(len(tiles),default,dtype=float)
+        for k,(x,y) in enumerate(tiles):
+            runtime=self.runtime(z,x,y,parameters)
+            if runtime is not None:
+                costs[k]=runtime
+            else:
+                count=counts.get((x,y),self.count(z,x,y,parameters))
+                if count is not None:
+                    costs[k]=self._predict_count(count,default,parameters)
+        return costs
+
+
+    def longest_first(self,z,tiles,counts=None,parameters=DEFAULT_PARAMETERS):
+        """ tiles sorted by descending predicted runtime (ties keep the
+            input order)
+        """
+        tiles=list(tiles)
+        costs=self.predict(z,tiles,counts,parameters)
+        order=np.argsort(-costs,kind='mergesort')
+        return [tiles[k] for k in order]
+
+
+    def update(self,z,runtimes,counts=None,parameters=DEFAULT_PARAMETERS):
+        """ update the history after a run
+
+            Args:
+                z<int>: tile-zoom
+                runtimes<dict>: (x,y): runtime in seconds
+                counts<dict>: 
+                    (x,y): number of alerts. only pass tiles 
+                    that ran successfully
+                parameters<str[DEFAULT_PARAMETERS]>: 
+                    request parameters key (see ClusterService.parameter_key)
+        """
+        counts=counts or {}
+        with self._lock:
+            tiles=self.groups.setdefault(parameters,{})
+            for (x,y),runtime in runtimes.items():
+                tile=tiles.setdefault(_key(z,x,y),{})
+                previous=tile.get('runtime')
+                if previous is None:
+                    tile['runtime']=float(runtime)
+                else:
+                    tile['runtime']=(
+                        self.smoothing*float(runtime)+
+                        (1-self.smoothing)*previous)
+                tile['runs']=tile.get('runs',0)+1
+            for (x,y),count in counts.items():
+                tiles.setdefault(_key(z,x,y),{})['count']=int(count)
+            self._models.pop(parameters,None)
+
+
+    def model(self,parameters=DEFAULT_PARAMETERS):
+        """ coefficients (a,b,c) of runtime=a+b*count+c*count**2
+            for parameters (None if there are less than MIN_MODEL_TILES 
+            tiles with runtimes and counts)
+        """
+        if self._models.get(parameters) is None:
+            data=np.array([
+                (t['count'],t['runtime']) for t in self.tiles(parameters).values()
+                if ('count' in t) and ('runtime' in t)],dtype=float)
+            if data.shape[0]<MIN_MODEL_TILES:
+                return None
+            counts,runtimes=data.T
+            design=np.column_stack([np.ones_like(counts),counts,counts**2])
+            self._models[parameters]=np.linalg.lstsq(design,runtimes,rcond=None)[0]
+        return self._models[parameters]
+
+
+    def save(self):
+        if not self.path:
+            return False
+        folder=os.path.dirname(self.path)
+        if folder and (not os.path.isdir(folder)):
+            os.makedirs(folder)
+        tmp_path='{}.tmp'.format(self.path)
+        with self._lock:
+            with open(tmp_path,'w') as file:
+                json.dump(self.groups,file)
+        os.rename(tmp_path,self.path)
+        return True
+
+
+    #
+    # INTERNAL METHODS
+    #
+    def _load(self):
+        """ parameters: tiles dict. files without parameter groups (z/x/y 
+            keys) are loaded under DEFAULT_PARAMETERS
+        """
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as file:
+                groups=json.load(file)
+            if any(('runtime' in v) or ('count' in v) for v in groups.values()):
+                groups={ DEFAULT_PARAMETERS: groups }
+            return groups
+        return {}
+
+
+    def _default(self,parameters):
+        runtimes=[
+            t['runtime'] for t in self.tiles(parameters).values() 
+            if 'runtime' in t]
+        if runtimes:
+            return float(np.median(runtimes))
+        return DEFAULT_RUNTIME
+
+
+    def _predict_count(self,count,default,parameters):
+        model=self.model(parameters)
+        if model is None:
+            return default
+        a,b,c=model
+        runtime=a+b*count+c*count**2
+        return max(float(runtime),0.0)
+
+
+
+
+#
+# PUBLIC
+#
+def tile_counts(dataframe):
+    """ dict of (x,y): number of clustered alerts from a clusters dataframe
+        (ie. a prior run)
+    """
+    if dataframe is None or (not dataframe.shape[0]):
+        return {}
+    sums=dataframe.groupby(['x','y'])['count'].sum()
+    return { (int(x),int(y)): int(c) for (x,y),c in sums.items() }
+
+
+def response_counts(responses):
+    """ dict of (x,y): number of alerts from processed responses
+
+        The tile's alert count reported by the handler (responses.alert_count)
+        is used when present, so noise that is not clustered is counted.
+        Older responses without it fall back to the number of clustered
+        alerts, which needs decoded responses: raw payloads without the
+        count are skipped, as are errors and unchanged tiles.
+    """
+    counts={}
+    for response in responses:
+        if response and ('x' in response) and ('y' in response):
+            if resp.is_error(response) or resp.has_key(response,'unchanged'):
+                continue
+            count=resp.alert_count(response)
+            if count is None:
+                if resp.PAYLOAD_KEY in response:
+                    continue
+                clusters=(response.get('data') or {}).get('clusters') or []
+                count=sum(c.get('count',0) for c in clusters)
+            counts[(int(response['x']),int(response['y']))]=count
+    return counts
+
+
+#
+# HELPERS
+#
+def _key(z,x,y):
+    return KEY_TMPL.format(int(z),int(x),int(y))
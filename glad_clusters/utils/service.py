@@ -1,9 +1,15 @@
 from __future__ import print_function
 import os
+import time
+import threading
 from datetime import datetime
-import math
 import itertools
 import json
+import io
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
 import boto3
 from boto3.session import Config
 import numpy as np
@@ -11,10 +17,28 @@ import pandas as pd
 import glad_clusters.utils.multiprocess as mp
 import psycopg2
 from glad_clusters.clusters.convex_hull import ConvexHull
+from glad_clusters.clusters.concave_hull import ConcaveHull
+from glad_clusters.clusters.concave_hull import concave_hulls
+from glad_clusters.clusters.concave_hull import bbox_ring
 import inspect
 from argparse import ArgumentParser
 import copy
 import glad_clusters.utils.sql as sql
+import glad_clusters.utils.storage as storage
+import glad_clusters.utils.projection as proj
+import glad_clusters.utils.responses as resp
+import glad_clusters.utils.ewkb as ewkb
+import glad_clusters.utils.exporters as exporters
+import glad_clusters.utils.stitch as stitch
+import glad_clusters.utils.split as split
+import glad_clusters.utils.regional as regional
+import glad_clusters.utils.hotspots as hotspots
+import glad_clusters.utils.aoi as geo
+import glad_clusters.utils.schedule as schedule
+from glad_clusters.utils.alerts import RaggedAlerts
+from glad_clusters.utils.cache import ResultCache
+from glad_clusters.utils.schedule import RuntimeHistory
+from glad_clusters.utils.index import ClusterIndex
 from glad_clusters.utils.parsers import service_parser
 from glad_clusters.utils.parsers import save_parser
 from glad_clusters.utils.parsers import export_parser
@@ -35,6 +59,12 @@ LAMBDA_FUNCTION_NAME='gfw-glad-clusters-v1-dev-meanshift'
 DEFAULT_CSV_IDENT='clusters'
 CSV_NAME_TMPL="{}_{}%{}_{}%{}%{}%{}_{}%{}%{}%{}"
 CONVERTERS={ "alerts" :lambda r: np.array(json.loads(r)) }
+DEFAULT_FORMAT='csv'
+LONLAT_TOLERANCE=1.0
+PG_COPY_CHUNK_SIZE=5000
+DEFAULT_CONCAVE=80
+DATE_RANGE_TMPL="{}-{}"
+PARAMETERS_TMPL="{}%{}%{}"
 
 
 DATAFRAME_COLUMNS=[
@@ -61,6 +91,9 @@ VIEW_COLUMNS=[
     'timestamp']
 
 
+WINDOW_COLUMN='window'
+
+
 ERROR_COLUMNS=[
     'z','x','y',
     'centroid_longitude',
@@ -74,6 +107,7 @@ BOTO3_CONFIG={
 }
 
 MAX_PROCESSES=200
+SPLIT_COUNT=20000
 
 class ClusterService(object):
     """ ClusterService:
@@ -88,6 +122,9 @@ class ClusterService(object):
                 tile_bounds<list>: tiles-xy bounding box
                 lat,lon<int,int>: latitude,longitude used to run a single tile
                 x,y<int,int>: tile-xy used to run a single tile
+                aoi<dict|str>: 
+                    polygon/multipolygon geojson (dict, string or path). only
+                    tiles intersecting the polygons are run (see clip)
 
             Other run arguments:
 
@@ -96,6 +133,32 @@ class ClusterService(object):
                 min_count<int>: minimum number of alerts in a cluster
                 width<int>: gaussian width in cluster algorithm
                 iterations<int>: number of times to iterate when finding clusters
+                halo<int>: 
+                    if set, clusters are found on each tile plus a margin of 
+                    halo*width pixels from its neighbors, and only clusters
+                    whose center is on the tile are kept
+                threads<int>:
+                    if set, MShift computes point weights by blocks on this
+                    many threads (see MShift threads). results are unchanged
+                windows<list>:
+                    list of [start_date,end_date] windows. tiles are read
+                    once and clustered for each window. the dataframe has
+                    a 'window' column (date-range key of the window) and
+                    start_date/end_date span all windows
+                cache<ResultCache|str>:
+                    result cache (or local cache directory). tiles with
+                    cached results for the same request, engine and tile
+                    content are not run
+                split_count<int[SPLIT_COUNT]>:
+                    tiles with at least split_count alerts (in the runtime
+                    history) or whose lambda invocation fails or is partial 
+                    (ie. times out, see partial_tiles) are run as 4 quadrant jobs, with an overlap of 
+                    OVERLAP_WIDTHS*width pixels, and merged (see 
+                    split.merge). None disables splitting
+                history<RuntimeHistory|str>:
+                    runtime history (or path of its json file). tiles are
+                    run longest (predicted) first and the history is updated
+                    after each run
                 z<int>: tile-zoom
                 bucket<str>: aws-bucket used for saving csv file
 
@@ -113,23 +176,41 @@ class ClusterService(object):
             region=DEFAULT_REGION,
             bucket=DEFAULT_BUCKET,
             url_base=None,
-            errors=True):
-        """ get dataframes from csv
+            errors=True,
+            format=None,
+            columns=None):
+        """ get dataframes from csv, npz or parquet
 
             Args:
-                filename<str>: name/path of csv without '.csv' extension 
+                filename<str>: name/path of file without extension
                 local<bool[False]>: if true read from local file else read from s3 file
                 region<str>: aws-region required if not local and not url_base
                 bucket<str>: aws-bucket required if not local
                 url_base<str>: aws-url-root for bucket
                 errors<bool[True]>: if true include errors-csv
+                format<str>: 
+                    one of storage.FORMATS. if none the format is taken from
+                    the filename extension, or for local files the first
+                    existing npz/parquet/csv file.
+                columns<list>: 
+                    only read these columns. if 'alerts' is not included
+                    the alerts data is not read/parsed.
         """
+        filename,format=ClusterService._filename_format(filename,format,local)
         if local:
-            dfpath='{}.csv'.format(filename)
-            if errors: edfpath='{}.errors.csv'.format(filename)
+            dfpath='{}.{}'.format(filename,format)
+            edfpath='{}.errors.csv'.format(filename)
         else:
-            dfpath,edfpath=ClusterService.get_urls(filename,region,bucket,url_base,errors)
-        df=pd.read_csv(dfpath,converters=CONVERTERS)
+            dfpath,edfpath=ClusterService.get_urls(
+                filename,region,bucket,url_base,True,format)
+        if format in storage.COLUMNAR_FORMATS:
+            if not local: dfpath=io.BytesIO(urlopen(dfpath).read())
+            df=storage.read(dfpath,format,columns)
+        elif columns is None:
+            df=pd.read_csv(dfpath,converters=CONVERTERS)
+        else:
+            converters={ k: v for k,v in CONVERTERS.items() if k in columns }
+            df=pd.read_csv(dfpath,usecols=columns,converters=converters)
         if errors:
             try:
                 edf=pd.read_csv(edfpath)
@@ -145,19 +226,21 @@ class ClusterService(object):
             region=DEFAULT_REGION,
             bucket=DEFAULT_BUCKET,
             url_base=None,
-            errors=True):
-        """ get urls for dataframe csvs
+            errors=True,
+            format=DEFAULT_FORMAT):
+        """ get urls for dataframe files
 
             Args:
-                filename<str>: name/path of csv without '.csv' extension 
+                filename<str>: name/path of file without extension
                 region<str>: aws-region required if not local and not url_base
                 bucket<str>: aws-bucket required if not local
                 url_base<str>: aws-url-root for bucket
                 errors<bool[True]>: if true include errors-csv-url
+                format<str[DEFAULT_FORMAT]>: one of storage.FORMATS
         """
         if not url_base: url_base=S3_URL_TMPL.format(region)
         url_base="{}/{}".format(url_base,bucket)
-        dfpath='{}/{}.csv'.format(url_base,filename)
+        dfpath='{}/{}.{}'.format(url_base,filename,format)
         if errors:
             edfpath='{}/{}.errors.csv'.format(url_base,filename)
             return dfpath, edfpath
@@ -171,16 +254,20 @@ class ClusterService(object):
             region=DEFAULT_REGION,
             bucket=DEFAULT_BUCKET,
             url_base=None,
-            errors=True):
-        """ init service from csv
+            errors=True,
+            format=None,
+            columns=None):
+        """ init service from csv (or npz/parquet)
 
             Args:
-                filename<str>: name/path of csv without '.csv' extension 
+                filename<str>: name/path of file without extension
                 local<bool[False]>: if true read from local file else read from s3 file
                 region<str>: aws-region required if not local and not url_base
                 bucket<str>: aws-bucket required if not local
                 url_base<str>: aws-url-root for bucket
                 errors<bool[True]>: if true include errors-csv
+                format<str>: file format (see get_dataframes)
+                columns<list>: only read these columns (see get_dataframes)
         """
         df,edf=ClusterService.get_dataframes(
             filename,
@@ -188,7 +275,9 @@ class ClusterService(object):
             region,
             bucket,
             url_base,
-            errors)
+            errors,
+            format,
+            columns)
         run_params=ClusterService.run_params(df)
         return ClusterService(
                 dataframe=df,
@@ -223,21 +312,37 @@ class ClusterService(object):
         return sdate, edate
 
 
+    @staticmethod
+    def _filename_format(filename,format=None,local=False):
+        """ split extension from filename and determine file format
+        """
+        root,ext=os.path.splitext(filename)
+        ext=ext.lstrip('.')
+        if ext in storage.FORMATS:
+            filename=root
+            format=format or ext
+        if not format:
+            format=DEFAULT_FORMAT
+            if local:
+                for fmt in storage.COLUMNAR_FORMATS:
+                    if os.path.exists('{}.{}'.format(filename,fmt)):
+                        format=fmt
+                        break
+        return filename, format
+
+
     @staticmethod
     def lat(z,x,y,i=0,j=0):
-        """ latitude from z/x/y/i/j
+        """ latitude from z/x/y/i/j (scalars or numpy arrays)
         """
-        lat_rad=math.atan(math.sinh(math.pi*(1-(2*(y+(j/256.0))/(2**z)))))
-        lat=(lat_rad*180.0)/math.pi
-        return lat
+        return proj.lat(z,x,y,i,j)
 
 
     @staticmethod
     def lon(z,x,y,i=0,j=0):
-        """ longitude from z/x/y/i/j
+        """ longitude from z/x/y/i/j (scalars or numpy arrays)
         """
-        lon=(360.0/(2**z))*(x+(i/256.0))-180.0
-        return lon
+        return proj.lon(z,x,y,i,j)
 
 
     #
@@ -258,47 +363,362 @@ class ClusterService(object):
             z=DEFAULT_ZOOM,
             bucket=DEFAULT_BUCKET,
             dataframe=None,
-            errors_dataframe=None):
+            errors_dataframe=None,
+            halo=None,
+            threads=None,
+            windows=None,
+            cache=None,
+            aoi=None,
+            history=None,
+            split_count=SPLIT_COUNT):
         self._init_properties()
         self.start_date=start_date
         self.end_date=end_date
+        self.windows=None
+        if windows:
+            self.windows=[list(w) for w in windows]
+            self.start_date=min(w[0] for w in self.windows)
+            self.end_date=max(w[1] for w in self.windows)
         self.min_count=min_count
         self.width=width
         self.iterations=iterations
+        self.halo=halo
+        self.threads=threads
         self.z=z
         self.bucket=bucket
+        if isinstance(cache,str):
+            cache=ResultCache(directory=cache)
+        self.cache=cache
+        if isinstance(history,str):
+            history=RuntimeHistory(path=history)
+        self.history=history
+        self.split_count=split_count
         self._dataframe=dataframe
         self._error_dataframe=errors_dataframe
-        self._set_tile_bounds(bounds,tile_bounds,lon,lat,x,y)
+        self._set_tile_bounds(bounds,tile_bounds,lon,lat,x,y,aoi)
 
 
-    def run(self,max_processes=MAX_PROCESSES,force=False):
+    def run(self,
+            max_processes=MAX_PROCESSES,
+            force=False,
+            decode_processes=None,
+            tiles=None,
+            progress=None,
+            timeout=None):
         """ find clusters on tiles
 
+            Responses are collected as tiles complete. On KeyboardInterrupt
+            the pending tiles are cancelled and the dataframe is built from
+            the completed ones.
+
             Args:
                 max_processes<int>: number of processes used in launching jobs
                 force<bool[False]>: if true run even if dataframe is loaded
+                decode_processes<int>: 
+                    if set, lambda payloads are kept as raw json and decoded 
+                    in a process pool of this size when building the dataframe
+                    (only used for runs with more than resp.POOL_THRESHOLD tiles)
+                tiles<list>: tile-xy values (x,y) to run. defaults to self.tiles()
+                progress<func>: progress(nb_done,nb_tiles) called as tiles complete
+                timeout<float>: 
+                    seconds after which a tile is abandoned and reported
+                    as an error
         """
         if (self._dataframe is not None) and (not force):
             print("WARNING: data already loaded pass 'force=True' to overwrite")
         else:
+            previous=getattr(self,'responses',None)
             try:
                 # self.responses=None
+                self.decode_processes=decode_processes
                 self.lambda_client=boto3.client('lambda',config=Config(**BOTO3_CONFIG))
+                if tiles is None:
+                    tiles=self.tiles()
+                if self.history is not None:
+                    tiles=self.history.longest_first(
+                        self.z,
+                        tiles,
+                        parameters=self.parameter_key())
+                if self.cache is not None:
+                    self.cache.reset_stats()
+                self._runtimes={}
+                self._partial=set()
+                self._abandoned=set()
                 if (self.x and self.y):
                     self.responses=[self._run_tile()]
+                elif tiles:
+                    self.responses=[]
+                    try:
+                        for response in mp.imap_with_threadpool(
+                                self._run_tile,
+                                tiles,
+                                max_processes=max_processes,
+                                chunksize=1,
+                                progress=progress,
+                                timeout=timeout,
+                                timeout_result=self._abandon_tile(timeout)):
+                            self.responses.append(response)
+                    except KeyboardInterrupt:
+                        print("WARNING: run cancelled after {} of {} tiles".format(
+                            len(self.responses),
+                            len(tiles)))
                 else:
-                    xys=itertools.product(
-                        range(self.x_min,self.x_max+1),
-                        range(self.y_min,self.y_max+1))
-                    self.responses=mp.map_with_threadpool(
-                        self._run_tile,
-                        list(xys),
-                        max_processes=max_processes)
+                    self.responses=[]
+                if self.cache is not None:
+                    print("CACHE: {}".format(self.cache.summary()))
+                if self.history is not None:
+                    self._update_history()
+                if self._partial:
+                    print("WARNING: {} partial tiles (see partial_tiles)".format(
+                        len(self._partial)))
                 self._dataframe=None
+                self._alerts=None
+                self._index=None
                 self._errors=None
             except Exception as e:
                 print("ERROR: run failure -- {}".format(e))
+                self._fail_run(tiles,previous,e)
+
+
+    def run_hotspots(self,
+            coarse_z=hotspots.DEFAULT_COARSE_ZOOM,
+            threshold=hotspots.DEFAULT_THRESHOLD,
+            dilation=hotspots.DEFAULT_DILATION,
+            sample=hotspots.DEFAULT_SAMPLE,
+            url=None,
+            seed=None,
+            max_processes=MAX_PROCESSES,
+            force=False,
+            decode_processes=None):
+        """ coarse-to-fine run: a density pass over coarse_z tiles flags
+            hotspots and lambda is only invoked for tiles under or near 
+            them (see hotspots.HotspotSelection). 
+
+            Args:
+                coarse_z<int>: zoom of the density pass
+                threshold<float>: 
+                    min coarse density as a fraction of min_count. values 
+                    above 1 skip more tiles at the cost of recall
+                dilation<int>: number of tiles kept around hotspots
+                sample<float>: 
+                    fraction of skipped tiles run anyway to estimate recall
+                    (see hotspot_recall). 0 skips the estimate
+                url<str>: url/folder of glad tiles (url/z/x/y.png)
+                seed<int>: random seed for the sample
+                (other args): see run
+
+            Returns:
+                HotspotSelection summary dict
+        """
+        if (self._dataframe is not None) and (not force):
+            print("WARNING: data already loaded pass 'force=True' to overwrite")
+            return None
+        self.hotspots=hotspots.HotspotSelection(
+            z=self.z,
+            tile_bounds=[[self.x_min,self.y_min],[self.x_max,self.y_max]],
+            start_date=self.start_date,
+            end_date=self.end_date,
+            min_count=self.min_count,
+            width=self.width,
+            coarse_z=coarse_z,
+            threshold=threshold,
+            dilation=dilation,
+            sample=sample,
+            url=url,
+            seed=seed)
+        tiles=self.hotspots.tiles()
+        if self._aoi_tiles is not None:
+            tiles=sorted(set(tiles)&set(self._aoi_tiles))
+        self.run(
+            max_processes=max_processes,
+            force=force,
+            decode_processes=decode_processes,
+            tiles=tiles)
+        return self.hotspots.summary()
+
+
+    def hotspot_recall(self,complete_dataframe=None):
+        """ recall of the last run_hotspots
+        
+            Args:
+                complete_dataframe<dataframe>:
+                    clusters from a full run of the same bounds. if set the
+                    recall is exact, otherwise it is estimated from the
+                    sampled tiles (None if sample was 0)
+        """
+        if complete_dataframe is None:
+            return self.hotspots.recall(self.dataframe())
+        else:
+            return self.hotspots.recall(complete_dataframe,complete=True)
+
+
+    def run_incremental(self,
+            previous,
+            since=None,
+            max_processes=MAX_PROCESSES,
+            force=False,
+            decode_processes=None,
+            approximate=False):
+        """ update a previous run with the alerts that arrived since
+
+            Each tile request carries `since`. Tiles without alerts between
+            since and end_date are not clustered (the lambda returns them as
+            unchanged) and their previous clusters are carried forward, as
+            are clusters on tiles that errored. Changed tiles are fully 
+            re-clustered, so their clusters equal those of a full run.
+
+            Args:
+                previous<ClusterService|dataframe>: 
+                    previous run (ie from ClusterService.read). a dataframe
+                    must be full (with alerts)
+                since<str>: 
+                    'yyyy-mm-dd'. defaults to the previous end_date (or for 
+                    dataframes the latest alert date)
+                approximate<bool[False]>:
+                    if true changed tiles are clustered with MShift seeded by
+                    the previous modes on the tile, which converges in fewer
+                    iterations. new alerts near a previous mode are merged 
+                    into it, so clusters can differ from a full run (see 
+                    MShift approximate)
+                (other args): see run
+
+            Returns:
+                dict of tile/cluster counts
+        """
+        if (self._dataframe is not None) and (not force):
+            print("WARNING: data already loaded pass 'force=True' to overwrite")
+            return None
+        if isinstance(previous,ClusterService):
+            if previous.start_date!=self.start_date:
+                raise ValueError('incremental runs require the previous start_date')
+            since=since or previous.end_date
+            previous_alerts=previous.alerts()
+            previous=previous.dataframe(full=True)
+        else:
+            since=since or ClusterService.run_params(previous)['end_date']
+            previous_alerts=RaggedAlerts.from_arrays(previous['alerts'])
+        self._incremental={ 'since': since }
+        if approximate:
+            self._incremental['seeds']=_seeds(previous)
+        try:
+            self.run(
+                max_processes=max_processes,
+                force=force,
+                decode_processes=decode_processes)
+        finally:
+            self._incremental=None
+        unchanged=self._unchanged_tiles()
+        tiles=set(self.tiles())
+        carried=np.array([
+            ((x,y) in unchanged) and ((x,y) in tiles)
+            for x,y in zip(previous.x.values.tolist(),previous.y.values.tolist())],
+            dtype=bool)
+        rows=np.nonzero(carried)[0]
+        self._carried=(previous.iloc[rows],previous_alerts.take(rows))
+        return {
+            'nb_tiles': len(tiles),
+            'nb_unchanged': len(unchanged&tiles),
+            'nb_carried': int(rows.shape[0]) }
+
+
+    def run_regional(self,url=None,processes=None,force=False,halo=None,progress=None):
+        """ find clusters locally with halo tiling (see 
+            regional.HaloTileEngine) instead of lambda. clusters wider
+            than halo*width pixels are cut at tile seams (see stitch)
+
+            Args:
+                url<str>: url/folder of glad tiles (url/z/x/y.png)
+                processes<int>: if set cluster each tile row in a process pool
+                force<bool[False]>: if true run even if dataframe is loaded
+                halo<int>: margin in widths (defaults to self.halo or regional.DEFAULT_HALO)
+                progress<func>: progress(nb_done,None) called as tiles complete
+        """
+        if (self._dataframe is not None) and (not force):
+            print("WARNING: data already loaded pass 'force=True' to overwrite")
+        else:
+            engine=regional.HaloTileEngine(
+                z=self.z,
+                tile_bounds=[[self.x_min,self.y_min],[self.x_max,self.y_max]],
+                start_date=self.start_date,
+                end_date=self.end_date,
+                width=self.width,
+                min_count=self.min_count,
+                iterations=self.iterations,
+                halo=halo or self.halo,
+                url=url,
+                processes=processes,
+                threads=self.threads,
+                tiles=self._aoi_tiles)
+            self.load_responses([r for r in engine.responses(progress) if r])
+
+
+    def load_responses(self,responses,decode_processes=None):
+        """ set processed tile responses (ie. from a BatchQueue). the 
+            dataframe is rebuilt from them on the next access
+
+            Args:
+                responses<list>: processed responses (see _process_response)
+                decode_processes<int>: see run
+        """
+        self.decode_processes=decode_processes
+        self.responses=responses
+        self._dataframe=None
+        self._alerts=None
+        self._index=None
+        self._errors=None
+
+
+    def stitch(self,distance=None):
+        """ merge clusters split across tile seams (see stitch.stitch)
+
+            Args:
+                distance<float>: 
+                    max pixel distance between alerts of stitched clusters.
+                    defaults to width
+
+            Returns:
+                number of clusters merged into a neighbor
+        """
+        if distance is None: distance=self.width
+        dataframe=self.dataframe(full=True)
+        self._dataframe,self._alerts,nb_merged=stitch.stitch(
+            dataframe,
+            self.alerts(),
+            distance)
+        self._dataframe['alerts']=self._alerts.to_object_array()
+        self._index=None
+        return nb_merged
+
+
+    def partial_tiles(self):
+        """ tile-xy values (x,y) of the last run whose clustering stopped
+            at the lambda deadline. their clusters are approximate (points
+            were not fully shifted) and they should be re-run elsewhere
+            (ie. run_regional with an aoi or tile_bounds of these tiles)
+        """
+        return sorted(self._partial)
+
+
+    def clip(self):
+        """ remove clusters whose center is outside of the aoi polygons
+
+            Returns:
+                number of clusters removed
+        """
+        if self.aoi is None:
+            return 0
+        dataframe=self.dataframe(full=True)
+        alerts=self.alerts()
+        inside=geo.contains(
+            self.aoi,
+            dataframe.longitude.values,
+            dataframe.latitude.values)
+        rows=np.nonzero(inside)[0]
+        self._dataframe=dataframe.iloc[rows].reset_index(drop=True)
+        self._alerts=alerts.take(rows)
+        self._dataframe['alerts']=self._alerts.to_object_array()
+        self._index=None
+        return int((~inside).sum())
 
 
     def name(self,ident=DEFAULT_CSV_IDENT):
@@ -331,7 +751,9 @@ class ClusterService(object):
             region=DEFAULT_REGION,
             bucket=DEFAULT_BUCKET,
             url_base=None,
-            errors=True):
+            errors=True,
+            format=None,
+            columns=None):
         filename=self.name(ident)
         df,edf=ClusterService.get_dataframes(
             filename,
@@ -339,8 +761,12 @@ class ClusterService(object):
             region,
             bucket,
             url_base,
-            errors)
+            errors,
+            format,
+            columns)
         self._dataframe=df
+        self._alerts=None
+        self._index=None
         self._error_dataframe=edf
 
 
@@ -350,14 +776,17 @@ class ClusterService(object):
             local=False,
             bucket=None,
             errors=True,
-            temp_dir=None):
-        """ write responses to csv
+            temp_dir=None,
+            format=DEFAULT_FORMAT,
+            compress=True,
+            concave=None):
+        """ write responses to csv (or npz/parquet)
 
             Args:
 
                 Use one of the following:
             
-                    filename<str>: name/path of csv without '.csv' extension 
+                    filename<str>: name/path of file without extension
                     ident<str[DEFAULT_CSV_IDENT]>: prefix to default_name 
                 
                 Other arguments:
@@ -365,14 +794,26 @@ class ClusterService(object):
                     local<bool[False]>: if true write to local file else write to s3 file
                     bucket<str>: aws-bucket required if not local and not self.bucket
                     errors<bool[True]>: if true save errors-csv
+                    format<str[DEFAULT_FORMAT]>: 
+                        one of storage.FORMATS. npz/parquet store the summary 
+                        columns natively and the alerts as a flat int16 array
+                        plus per-cluster offsets
+                    compress<bool[True]>: if true compress npz/parquet data
+                    concave<int>: 
+                        if set add 'concave_area' and 'footprint' (hex EWKB 
+                        polygon) columns with concave hulls computed for this
+                        percent of convex area (see footprints)
         """
         if not filename: filename=self.name(ident)
         if temp_dir and local:
             filename = os.path.join(temp_dir, filename)
         if self._dataframe is None: self._process_responses()
-        self._dataframe['alerts']=self._dataframe['alerts'].apply(lambda a: a.tolist())
+        if format in storage.COLUMNAR_FORMATS:
+            self._save_columnar(filename,local,bucket,errors,format,compress,concave)
+            return
+        dataframe=self._footprint_dataframe(concave).assign(alerts=self.alerts().tolist())
         if local:
-            self.dataframe(full=True).to_csv(
+            dataframe.to_csv(
                 "{}.csv".format(filename),
                 index=None)
             if errors and self.errors().shape[0]:
@@ -383,7 +824,7 @@ class ClusterService(object):
             obj=boto3.resource('s3').Object(
                 bucket or self.bucket,
                 "{}.csv".format(filename))
-            obj.put(Body=self.dataframe(full=True).to_csv(None,index=None))
+            obj.put(Body=dataframe.to_csv(None,index=None))
             obj.Acl().put(ACL=CSV_ACL)
             if errors and self.errors().shape[0]:
                 obj=boto3.resource('s3').Object(
@@ -391,7 +832,7 @@ class ClusterService(object):
                     "{}.errors.csv".format(filename))
                 obj.put(Body=self.errors().to_csv(None,index=None))
                 obj.Acl().put(ACL=CSV_ACL)
-        self._dataframe['alerts']=self._dataframe['alerts'].apply(lambda a: np.array(a))
+
 
     def export(self,
                format="PG",
@@ -405,7 +846,12 @@ class ClusterService(object):
                pg_user=None,
                pg_password=None,
                concave=100,
-               overwrite=False
+               overwrite=False,
+               upsert=False,
+               pg_processes=sql.CONCAVE_PROCESSES,
+               concave_batch_size=sql.CONCAVE_BATCH_SIZE,
+               filename=None,
+               geometry=exporters.DEFAULT_GEOMETRY
                ):
         """ Export response to selected format
 
@@ -413,9 +859,11 @@ class ClusterService(object):
 
                 Use one of the following:
 
-                    format<str(PG)>: Export format
+                    format<str(PG)>: 
+                        Export format. 'PG' or one of exporters.FORMATS 
+                        ('geojson': newline-delimited GeoJSON, 'fgb': FlatGeobuf)
                     ident<str[DEFAULT_CSV_IDENT]>: Prefix to default_name
-                    temp_dir<str>: Temporary folder for CSV export
+                    temp_dir<str>: Unused for PG, rows are streamed from memory
                     pg_table<str>: PG table name
                     pg_schema<str{public)>: PG working schema
                     pg_dbname<str>: Database name.
@@ -426,59 +874,100 @@ class ClusterService(object):
 
                 Other arguments:
 
-                    overwrite<bool[False]>: if true write overwrite existing data
+                    overwrite<bool[False]>: 
+                        if true write overwrite existing data. the existing
+                        rows are only replaced once all concave hulls are 
+                        computed (see sql.load_data)
+                    upsert<bool[False]>:
+                        if true and the table exists, only replace clusters for
+                        tiles (z/x/y, date-range and run parameters) whose
+                        clusters have changed. other rows, and the rows of 
+                        tiles with errors (or timed out) in this run, are left
+                        untouched. replaced tiles are committed before their concave hulls
+                        are computed: if that fails, re-running the upsert 
+                        computes the missing hulls
                     concave<int(100)>: Percentage of convex area
+                    pg_processes<int[sql.CONCAVE_PROCESSES]>:
+                        number of database connections used to compute concave hulls
+                    concave_batch_size<int[sql.CONCAVE_BATCH_SIZE]>:
+                        number of rows per concave hull batch
 
-        """
+                File arguments (geojson/fgb):
 
-        if format == "PG":
+                    filename<str>: name/path of file without extension (default name(ident))
+                    geometry<str[exporters.DEFAULT_GEOMETRY]>:
+                        one of exporters.GEOMETRIES. 'concave' uses the concave
+                        argument, 'centroid' writes points
 
-            if not pg_table:
-                pg_table = self.name(ident).replace("%", "").replace(":", "").replace("-", "") + "_" + str(concave)
+            Returns:
+                PG table name or file path
 
-            # TODO add temp_dir to local_env
-            if not temp_dir:
-                temp_dir = os.getcwd()
-            filename = os.path.join(temp_dir, pg_table + ".csv")
+        """
 
+        if format in exporters.FORMATS:
 
             if self._dataframe is None:
                 self._process_responses()
 
-            self._dataframe['alerts'] = self._dataframe['alerts'].apply(
-                lambda a: str(a.tolist()).replace('[', '{').replace(']', '}'))
-            self.dataframe(full=True).to_csv(filename, index=None)
+            path = "{}.{}".format(filename or self.name(ident), exporters.EXTENSIONS[format])
+            if temp_dir:
+                path = os.path.join(temp_dir, path)
+            exporters.write(path, format, self.dataframe(full=True), self.alerts(), geometry, concave)
+            return path
 
-            # if errors and self.errors().shape[0]:
-            #     self.errors().to_csv("{}.errors.csv".format(filename), index=None)
+        elif format == "PG":
+
+            if not (pg_dbname and pg_user):
+                raise Exception('pg_dbname and pg_user are required for PG exports.')
 
             if not pg_table:
-                pg_table = os.path.basename(filename)
+                pg_table = self.name(ident).replace("%", "").replace(":", "").replace("-", "") + "_" + str(concave)
 
-            conn = psycopg2.connect(database=pg_dbname, user=pg_user, password=pg_password, host=pg_host, port=pg_port)
+            if self._dataframe is None:
+                self._process_responses()
+
+            def connect():
+                return psycopg2.connect(database=pg_dbname, user=pg_user, password=pg_password, host=pg_host, port=pg_port)
+
+            conn = connect()
+            concave_kwargs = {
+                'connect': connect,
+                'processes': int(pg_processes),
+                'batch_size': int(concave_batch_size) }
 
             # check if pg_table already exists.
             # If yes delete all data, otherwise create table
             exists = sql.table_exists(conn, pg_schema, pg_table, True)
 
-            if overwrite and exists:
-                sql.delete_data(conn, pg_schema, pg_table)
-            elif not exists:
-                sql.create_schema(conn, pg_schema)
-                sql.create_table(conn, pg_schema, pg_table)
+            # tables created before date_range/parameters were added are
+            # migrated in place (COPY_COLUMNS includes them)
+            if exists:
+                sql.ensure_key_columns(conn, pg_schema, pg_table)
+
+            if upsert and exists and (not overwrite):
+                changed, inserted = sql.upsert_data(
+                    conn, pg_schema, pg_table,
+                    self._pg_copy_chunks(),
+                    self._pg_tile_chunks(),
+                    concave,
+                    **concave_kwargs)
+                print("UPSERT: {} tiles changed, {} clusters inserted".format(changed, inserted))
             else:
-                raise Exception('PG table already exist and overwrite set to false.')
+                if overwrite and exists:
+                    sql.delete_data(conn, pg_schema, pg_table)
+                elif not exists:
+                    sql.create_schema(conn, pg_schema, True)
+                    sql.create_table(conn, pg_schema, pg_table)
+                else:
+                    raise Exception('PG table already exist and overwrite/upsert set to false.')
 
-            # Load the data
-            sql.load_data(conn, pg_schema, pg_table, filename, concave)
+                # Stream the data (multipoint geometries are built client side)
+                sql.load_data(conn, pg_schema, pg_table, self._pg_copy_chunks(), concave, **concave_kwargs)
 
-            # Close connection and clean up
+            # Close connection
             conn.commit()
             conn.close()
 
-            os.remove(filename)
-            self._dataframe['alerts'] = self._dataframe['alerts'].apply(lambda a: np.array(a))
-
         else:
             raise Exception('Unsupported format.')
 
@@ -487,17 +976,56 @@ class ClusterService(object):
     def request_size(self):
         """ get number of tiles in request
         """
+        if self._aoi_tiles is not None:
+            return len(self._aoi_tiles)
         return (self.x_max-self.x_min+1)*(self.y_max-self.y_min+1)
 
 
+    def tiles(self):
+        """ list of tile-xy values (x,y) in request
+        """
+        if self._aoi_tiles is not None:
+            return list(self._aoi_tiles)
+        return list(itertools.product(
+            range(self.x_min,self.x_max+1),
+            range(self.y_min,self.y_max+1)))
+
+
+    def date_range(self):
+        """ date-range key used in exports
+        """
+        return DATE_RANGE_TMPL.format(self.start_date,self.end_date)
+
+
+    def parameters(self):
+        """ run-parameters key (width%min_count%iterations) used in exports
+        """
+        return PARAMETERS_TMPL.format(self.width,self.min_count,self.iterations)
+
+
+    def parameter_key(self):
+        """ json key of the tile request parameters (without x/y and 
+            threads, which does not change results). services with the same
+            key get identical results for a tile (see BatchQueue and
+            RuntimeHistory)
+        """
+        data=self._request_data(0,0,as_dict=True)
+        data.pop('x')
+        data.pop('y')
+        data.pop('threads',None)
+        return json.dumps(data,sort_keys=True)
+
+
     def bounds(self):
         """ get lat/lon-bounds
         """
-        lat_min=ClusterService.lat(self.z,self.x_min,self.y_min,0,0)
-        lat_max=ClusterService.lat(self.z,self.x_max,self.y_max,254.0,254.0)
-        lon_min=ClusterService.lon(self.z,self.x_min,self.y_min,0,0)
-        lon_max=ClusterService.lon(self.z,self.x_max,self.y_max,254.0,254.0)
-        return [[lon_min,lat_min],[lon_max,lat_max]]
+        lons,lats=proj.lonlat(
+            self.z,
+            np.array([self.x_min,self.x_max]),
+            np.array([self.y_min,self.y_max]),
+            np.array([0,254.0]),
+            np.array([0,254.0]))
+        return [[float(lons[0]),float(lats[0])],[float(lons[1]),float(lats[1])]]
 
 
     def bounding_box(self):
@@ -525,7 +1053,7 @@ class ClusterService(object):
         if full:
             return self._dataframe
         else:
-            return self._dataframe[VIEW_COLUMNS]
+            return self._dataframe[_view_columns(self._dataframe.columns)]
 
 
     def summary(self,dataframe=None):
@@ -558,11 +1086,11 @@ class ClusterService(object):
         if row_id is not None:
             row=df.iloc[row_id]
             z,x,y=row.z,row.x,row.y
-        df=df[((df.z==z)&(df.x==x)&(df.y==y))]
+        df=df.iloc[self.cluster_index().tile(z,x,y)]
         if full:
             return df
         else:
-            return df[VIEW_COLUMNS]
+            return df[_view_columns(df.columns)]
 
 
     def errors(self):
@@ -573,6 +1101,29 @@ class ClusterService(object):
         return self._error_dataframe
 
 
+    def alerts(self,row_id=None):
+        """ return alerts container (or alerts for a single cluster)
+
+            The alerts for all clusters are held in a single RaggedAlerts
+            container aligned with the rows of dataframe(full=True). The
+            dataframe's alerts column holds views into the same data.
+
+            Args:
+                row_id<int>: 
+                    if set return the alerts array for this row (O(1) view)
+                    otherwise return the RaggedAlerts container
+        """
+        if self._alerts is None:
+            dataframe=self.dataframe(full=True)
+            if self._alerts is None:
+                self._alerts=RaggedAlerts.from_arrays(dataframe['alerts'])
+                dataframe['alerts']=self._alerts.to_object_array()
+        if row_id is None:
+            return self._alerts
+        else:
+            return self._alerts[row_id]
+
+
     def cluster(self,
             row_id=None,
             lat=None,lon=None,
@@ -589,8 +1140,12 @@ class ClusterService(object):
                 Use one of the following to select the row:
 
                     row_id<int>: dataframe index for cluster
-                    lat,lon<floats>: latitude,longitude for cluster
-                    z,x,y,i,j<ints>: tile/pixel location for cluster
+                    lat,lon<floats>: 
+                        latitude,longitude for cluster. the nearest cluster
+                        (and any others at the same location) is selected
+                    z,x,y,i,j<ints>: 
+                        tile/pixel location for cluster. if i,j are not 
+                        passed select from all clusters on tile
 
                     (optional - really consider using row_id):
                         timestamp<str>: timestamp for cluster
@@ -603,28 +1158,115 @@ class ClusterService(object):
                         if false return only VIEW_COLUMNS.
                         else include all columns (including input/alerts data)
         """
+        df=self.dataframe(full=True)
         if self._not_none([row_id]):
-            row=self.dataframe(full=True).iloc[row_id]
+            row=df.iloc[row_id]
         else:
-            test=True
+            index=self.cluster_index()
             if self._not_none([lon,lat]):
-                test=test & (
-                    (self.dataframe(full=True).latitude==lat) &
-                    (self.dataframe(full=True).longitude==lon))
+                dist,_=index.nearest(lon,lat)
+                rows=index.within(lon,lat,dist+LONLAT_TOLERANCE)
+            elif self._not_none([x,y,z,i,j]):
+                rows=index.pixel(z,x,y,i,j)
             elif self._not_none([x,y,z]):
-                test=test & (
-                    (self.dataframe(full=True).z==z) &
-                    (self.dataframe(full=True).x==x) &
-                    (self.dataframe(full=True).y==y))
+                rows=index.tile(z,x,y)
+            else:
+                rows=np.arange(df.shape[0])
             if timestamp:
-                test=test & (self.dataframe(full=True).timestamp==timestamp)
-            rows=self.dataframe(full=True)[test]
-            if ascending: rows.sort_values('timestamp',inplace=True)
+                rows=rows[df.timestamp.values[rows]==timestamp]
+            rows=df.iloc[rows]
+            if ascending: rows=rows.sort_values('timestamp')
             row=rows.iloc[0]
         if full:
             return row
         else:
-            return row[VIEW_COLUMNS]
+            return row[_view_columns(row.index)]
+
+
+    def nearest(self,lon,lat,k=1,max_distance=None,full=False):
+        """ nearest clusters to point(s)
+
+            Args:
+                lon,lat<float|arr>: 
+                    point in degrees, or arrays of points (ie to join 
+                    clusters to an external point dataset)
+                k<int>: number of clusters per point
+                max_distance<float>: ignore clusters further than this (meters)
+                full<bool[False]>:
+                    if true return all columns
+                    otherwise only return VIEW_COLUMNS
+
+            Returns:
+                dataframe rows with 'distance' (meters) and 'point' 
+                (position of the point in lon/lat) columns
+        """
+        dist,rows=self.cluster_index().nearest(lon,lat,k,max_distance)
+        dist=np.asarray(dist).reshape(-1,k)
+        rows=np.asarray(rows).reshape(-1,k)
+        points=np.repeat(np.arange(dist.shape[0]),dist.shape[1])
+        dist,rows=dist.ravel(),rows.ravel()
+        found=np.isfinite(dist)
+        return self._rows(rows[found],full).assign(
+            distance=dist[found],
+            point=points[found])
+
+
+    def within(self,lon,lat,radius,full=False):
+        """ clusters within radius (meters) of lon/lat
+
+            Args:
+                full<bool[False]>:
+                    if true return all columns
+                    otherwise only return VIEW_COLUMNS
+        """
+        return self._rows(self.cluster_index().within(lon,lat,radius),full)
+
+
+    def within_bounds(self,bounds,full=False):
+        """ clusters inside lon/lat bounds
+
+            Args:
+                bounds<list>: [[min_lon,min_lat],[max_lon,max_lat]]
+                full<bool[False]>:
+                    if true return all columns
+                    otherwise only return VIEW_COLUMNS
+        """
+        (min_lon,min_lat),(max_lon,max_lat)=np.sort(bounds,axis=0)
+        return self._rows(
+            self.cluster_index().bbox(min_lon,min_lat,max_lon,max_lat),
+            full)
+
+
+    def alert_coordinates(self,row_ids=None):
+        """ longitude, latitude and days-since for every alert
+
+            Args:
+                row_ids<arr>: if set only return alerts for these rows
+            
+            Returns:
+                (N,3) array of [longitude,latitude,days-since] values,
+                ordered as alerts().data (or alerts().take(row_ids).data)
+        """
+        df=self.dataframe(full=True)
+        alerts=self.alerts()
+        if row_ids is not None:
+            alerts=alerts.take(row_ids)
+            df=df.iloc[row_ids]
+        rows=alerts.row_ids()
+        lons,lats=proj.alerts_lonlat(
+            df.z.values[rows],
+            df.x.values[rows],
+            df.y.values[rows],
+            alerts.data)
+        return np.column_stack([lons,lats,alerts.data[:,2]])
+
+
+    def cluster_index(self):
+        """ return (lazily built) ClusterIndex for dataframe(full=True)
+        """
+        if self._index is None:
+            self._index=ClusterIndex(self.dataframe(full=True))
+        return self._index
 
 
     def convex_hull(self,row_id=None,alerts=None):
@@ -635,21 +1277,88 @@ class ClusterService(object):
                 alerts<array>: alerts for cluster
         """
         if alerts is None:
-            alerts=self.dataframe(full=True).iloc[row_id].alerts
+            alerts=self.alerts(row_id)
         return ConvexHull(alerts[:,0:2]).hull
 
 
+    def concave_hull(self,row_id=None,alerts=None,concave=DEFAULT_CONCAVE):
+        """ get concave_hull vertices for cluster
+
+            Args:
+                row_id<int>: if not alerts, dataframe row index for cluster
+                alerts<array>: alerts for cluster
+                concave<int[DEFAULT_CONCAVE]>: target percent of convex area
+        """
+        if alerts is None:
+            alerts=self.alerts(row_id)
+        return ConcaveHull(alerts[:,0:2],concave).hull
+
+
+    def footprints(self,concave=DEFAULT_CONCAVE,row_ids=None):
+        """ concave hull footprints for clusters
+
+            Clusters whose hull has no area (single alerts or alerts
+            along a line) use their pixel bounding box.
+
+            Args:
+                concave<int[DEFAULT_CONCAVE]>: target percent of convex area
+                row_ids<arr>: if set only return footprints for these rows
+
+            Returns:
+                (n,) concave areas (pixels), (N,2) array of closed ring 
+                [longitude,latitude] vertices, (n+1,) ring offsets
+        """
+        df=self.dataframe(full=True)
+        alerts=self.alerts()
+        if row_ids is not None:
+            alerts=alerts.take(row_ids)
+            df=df.iloc[row_ids]
+        hulls=concave_hulls(alerts,concave)
+        areas=np.array([h.area for h in hulls],dtype=float)
+        rings=[
+            h.hull if h.area>0 else bbox_ring(h.points)
+            for h in hulls]
+        counts=np.array([r.shape[0] for r in rings],dtype=np.int64)
+        offsets=np.zeros(len(rings)+1,dtype=np.int64)
+        offsets[1:]=np.cumsum(counts)
+        if not len(rings):
+            return areas, np.zeros((0,2)), offsets
+        vertices=np.concatenate(rings)
+        rows=np.repeat(np.arange(len(rings)),counts)
+        lons,lats=proj.alerts_lonlat(
+            df.z.values[rows],
+            df.x.values[rows],
+            df.y.values[rows],
+            vertices)
+        return areas, np.column_stack([lons,lats]), offsets
+
+
 
 
     #
     #  INTERNAL METHODS
     #
     def _init_properties(self):
+        self.cache=None
+        self.history=None
+        self._runtimes={}
+        self._partial=set()
+        self._abandoned=set()
+        self._lock=threading.Lock()
+        self._history_tiles=None
+        self.aoi=None
+        self._aoi_tiles=None
         self.x=None
         self.y=None
+        self.decode_processes=None
+        self.hotspots=None
+        self._incremental=None
+        self._carried=None
+        self._alerts=None
+        self._index=None
 
 
-    def _request_data(self,x,y,as_dict=False):
+    def _request_data(self,x,y,as_dict=False,quadrant=None):
         data={
             "z":self.z,
             "x":x,
@@ -659,19 +1368,40 @@ class ClusterService(object):
             "min_count":self.min_count,
             "width":self.width,
             "iterations":self.iterations }
+        if self.halo:
+            data["halo"]=self.halo
+        if self.threads:
+            data["threads"]=self.threads
+        if self.windows:
+            data["windows"]=self.windows
+        if quadrant is not None:
+            data["quadrant"]=quadrant
+        if self._incremental and (not as_dict):
+            data["since"]=self._incremental['since']
+            seeds=self._incremental.get('seeds',{}).get((x,y))
+            if seeds:
+                data["seeds"]=seeds
+                data["approximate"]=True
         if as_dict:
             return data
         else:
             return json.dumps(data)
 
 
-    def _set_tile_bounds(self,bounds,tile_bounds,lon,lat,x,y):
+    def _set_tile_bounds(self,bounds,tile_bounds,lon,lat,x,y,aoi=None):
         """
             NOTE: if a single pair (x,y) or (lon,lat) the x,y-values 
             will be set for the find_by_tile method.
         """
-        if bounds:
-            tile_bounds=[self._lonlat_to_xy(*lonlat) for lonlat in bounds]
+        if aoi:
+            self.aoi=geo.polygons(aoi)
+            self._aoi_tiles=sorted(geo.tile_cover(self.aoi,self.z))
+            if not self._aoi_tiles:
+                raise ValueError('AOI does not intersect any tile')
+            tile_bounds=self._aoi_tiles
+        elif bounds:
+            lons,lats=np.array(bounds,dtype=float).T
+            tile_bounds=np.column_stack(self._lonlat_to_xy(lons,lats))
         elif (lat and lon):
             self.x,self.y=self._lonlat_to_xy(lon,lat)
             tile_bounds=[[self.x,self.y],[self.x,self.y]]
@@ -685,18 +1415,18 @@ class ClusterService(object):
 
 
     def _lonlat_to_xy(self,lon,lat):
-        lat_rad=math.radians(lat)
-        x=(2**self.z)*(lon+180.0)/360
-        y=(2**self.z)*(1.0-math.log(math.tan(lat_rad)+(1/math.cos(lat_rad)))/math.pi)/2.0
-        return int(x),int(y)
+        return proj.lonlat_to_xy(lon,lat,self.z)
 
 
     def _process_response(self,x,y,response):
         if response:
-            payload=json.loads(response.get('Payload',{}).read())
             processed_response=self._request_data(x,y,as_dict=True)
-            if payload:
-                processed_response.update(payload)
+            if self.decode_processes:
+                processed_response[resp.PAYLOAD_KEY]=response.get('Payload').read()
+            else:
+                payload=json.loads(response.get('Payload',{}).read())
+                if payload:
+                    processed_response.update(payload)
             return processed_response
         return None
 
@@ -717,71 +1447,228 @@ class ClusterService(object):
             x=self.x
             y=self.y
         if (x and y):
+            # tiles abandoned by run (timeout) must not update the run
+            # state, which may belong to a later run by the time they end
+            runtimes,partial,abandoned=self._runtimes,self._partial,self._abandoned
             try:
-                response=self.lambda_client.invoke(
-                    FunctionName=LAMBDA_FUNCTION_NAME,
-                    InvocationType='RequestResponse',
-                    LogType='Tail',
-                    Payload=self._request_data(x,y))
-                return self._process_response(x,y,response)
+                key=self._cache_key(x,y)
+                if key:
+                    cached=self.cache.get(key)
+                    if cached is not None:
+                        return cached
+                start=time.time()
+                if self._is_dense(x,y):
+                    response=self._run_quadrants(x,y)
+                else:
+                    response,failed=self._invoke(x,y)
+                    if self.split_count and (failed or resp.is_partial(response)):
+                        response=self._run_quadrants(x,y)
+                with self._lock:
+                    if (x,y) in abandoned:
+                        return response
+                    runtimes[(x,y)]=time.time()-start
+                    if resp.is_partial(response):
+                        partial.add((x,y))
+                if key:
+                    self.cache.set(key,response)
+                return response
             except Exception as e:
-                error_data=self._request_data(x,y,as_dict=True)
-                error_data['data']={ 'x':x, 'y': y }
-                error_data['error']="{}".format(e)
-                error_data['error_trace']="service.1"
-                return error_data
+                return self._error_response(x,y,"{}".format(e),"service.1")
+
+
+    def _abandon_tile(self,timeout):
+        """ timeout_result for run: error response for a timed out tile,
+            which is marked as abandoned
+        """
+        abandoned=self._abandoned
+        def _timeout_result(location):
+            x,y=location
+            with self._lock:
+                abandoned.add((x,y))
+            return self._error_response(
+                x,
+                y,
+                'tile timed out after {}s'.format(timeout),
+                'service.3')
+        return _timeout_result
+
+
+    def _fail_run(self,tiles,previous,error):
+        """ keep the responses of a failed run and add an error response
+            for each tile it left without one, so the failure is reported
+            by errors() rather than read as tiles without clusters
+        """
+        if (self.x and self.y):
+            tiles=[(self.x,self.y)]
+        elif tiles is None:
+            tiles=self.tiles()
+        responses=getattr(self,'responses',None)
+        if responses is previous:
+            responses=[]
+        responses=[r for r in (responses or []) if r]
+        done=set(
+            (int(r['x']),int(r['y'])) for r in responses
+            if (r.get('x') is not None) and (r.get('y') is not None))
+        error='run failure -- {}'.format(error)
+        self.load_responses(responses+[
+            self._error_response(x,y,error,'service.4')
+            for x,y in tiles if (x,y) not in done])
+
+
+    def _error_response(self,x,y,error,error_trace):
+        error_data=self._request_data(x,y,as_dict=True)
+        error_data['data']={ 'x':x, 'y': y }
+        error_data['error']=error
+        error_data['error_trace']=error_trace
+        return error_data
+
+
+    def _invoke(self,x,y,quadrant=None):
+        """ invoke lambda for tile x,y (or one of its quadrants)
+
+            Returns:
+                processed response, true if the function failed (ie. timed out)
+        """
+        response=self.lambda_client.invoke(
+            FunctionName=LAMBDA_FUNCTION_NAME,
+            InvocationType='RequestResponse',
+            LogType='Tail',
+            Payload=self._request_data(x,y,quadrant=quadrant))
+        failed=bool(response.get('FunctionError'))
+        return self._process_response(x,y,response), failed
+
+
+    def _is_dense(self,x,y):
+        """ true if the runtime history has at least split_count alerts 
+            for tile x,y
+        """
+        if (not self.split_count) or (self.history is None):
+            return False
+        count=self.history.count(self.z,x,y,self.parameter_key())
+        return (count or 0)>=self.split_count
+
+
+    def _run_quadrants(self,x,y):
+        """ run the quadrants of tile x,y in parallel and merge them
+        """
+        responses=mp.map_with_threadpool(
+            lambda quadrant: self._invoke(x,y,quadrant)[0],
+            list(range(split.NB_QUADRANTS)),
+            max_processes=split.NB_QUADRANTS)
+        return split.merge(
+            [resp.decode(r) for r in responses],
+            self.min_count)
+
+
+    def _cache_key(self,x,y):
+        """ result cache key for tile x,y (None if there is no cache or
+            the tile can not be cached)
+        """
+        if self.cache is None:
+            return None
+        return self.cache.key(json.loads(self._request_data(x,y)),LAMBDA_FUNCTION_NAME)
+
+
+    def _update_history(self):
+        """ update and save the runtime history with the invoked tiles.
+            alert counts are only updated for tiles that did not fail.
+            counts are the tile's total alerts reported by the lambda, so
+            noisy tiles with few clustered alerts are still split (see
+            _is_dense; tiles without a response have a count of 0). raw 
+            payloads (decode_processes) without the total are not decoded 
+            here: their clustered counts are recorded when the dataframe is
+            built (see _update_history_counts)
+        """
+        failed=set(
+            (int(r['x']),int(r['y'])) for r in (self.responses or [])
+            if resp.is_error(r))
+        tiles=[t for t in self._runtimes if t not in failed]
+        counts=schedule.response_counts(self.responses or [])
+        if self.decode_processes:
+            self._history_tiles=[t for t in tiles if t not in counts]
+            counts={ t: counts[t] for t in tiles if t in counts }
+        else:
+            self._history_tiles=None
+            counts={ t: counts.get(t,0) for t in tiles }
+        self.history.update(
+            self.z,
+            self._runtimes,
+            counts,
+            parameters=self.parameter_key())
+        self.history.save()
+
+
+    def _update_history_counts(self,dataframe):
+        """ record the (clustered) alert counts of the tiles of the last
+            run that did not report their total from the clusters dataframe
+        """
+        counts=schedule.tile_counts(dataframe)
+        self.history.update(
+            self.z,
+            {},
+            { t: counts.get(t,0) for t in self._history_tiles },
+            parameters=self.parameter_key())
+        self.history.save()
+        self._history_tiles=None
 
 
     def _process_responses(self):
-        rows,error_rows=self._dataframes_rows()
-        self._dataframe=pd.DataFrame(
-            rows,
-            columns=DATAFRAME_COLUMNS)
+        columns=DATAFRAME_COLUMNS
+        if self.windows:
+            columns=columns[:-1]+[WINDOW_COLUMN]+columns[-1:]
+        self._dataframe,self._alerts,errors=resp.build(
+            self.responses,
+            columns,
+            self.decode_processes,
+            mp.map_with_pool)
+        if self.windows:
+            self._dataframe[WINDOW_COLUMN]=self._window_keys(
+                self._dataframe[WINDOW_COLUMN].values)
+        if (self.history is not None) and self._history_tiles:
+            self._update_history_counts(self._dataframe)
+        if self._carried is not None:
+            self._dataframe,self._alerts=self._with_carried(
+                self._dataframe,
+                self._alerts)
+        self._dataframe['alerts']=self._alerts.to_object_array()
+        self._index=None
         self._error_dataframe=pd.DataFrame(
-            error_rows,
+            [self._error_row(e.get('error') or e.get('errorMessage'),e) for e in errors],
             columns=ERROR_COLUMNS)
-        self._dataframe.sort_values(
-            'timestamp',
-            ascending=False,
-            inplace=True)
-        self._dataframe.reset_index(inplace=True)
         self._error_dataframe.reset_index(inplace=True)
         if DELETE_RESPONSES: self.responses=None
 
 
-    def _dataframes_rows(self):
-        rows=[]
-        error_rows=[]
-        for response in self.responses:
-            if response:
-                error=response.get('error') or response.get('errorMessage')
-                if error:
-                    error_rows.append(self._error_row(error,response))
-                else:
-                    rows+=self._response_rows(response)
-        return rows,error_rows
-
-
-    def _response_rows(self,response):
-        rrows=[]
-        z=int(response.get('z'))
-        x=int(response.get('x'))
-        y=int(response.get('y'))
-        for cluster in response.get('data',{}).get('clusters',[]):
-            i=int(cluster.get('i'))
-            j=int(cluster.get('j'))
-            rrows.append([
-                    int(cluster.get('count')),
-                    int(cluster.get('area')),
-                    cluster.get('min_date'),
-                    cluster.get('max_date'),
-                    ClusterService.lon(z,x,y,i,j),
-                    ClusterService.lat(z,x,y,i,j),
-                    z,x,y,i,j,
-                    response['file_name'],
-                    response['timestamp'],
-                    np.array(cluster.get('alerts')).astype(int)])
-        return rrows
+    def _window_keys(self,windows):
+        """ date-range keys (categorical) for window indices
+        """
+        keys=[DATE_RANGE_TMPL.format(*w) for w in self.windows]
+        return pd.Categorical.from_codes(np.asarray(windows,dtype=int),keys)
+
+
+    def _unchanged_tiles(self):
+        """ (x,y) of tiles without new alerts or with errors (see run_incremental)
+        """
+        tiles=set()
+        for response in (self.responses or []):
+            if resp.has_key(response,'unchanged') or resp.is_error(response):
+                x,y=response.get('x'),response.get('y')
+                if (x is not None) and (y is not None):
+                    tiles.add((int(x),int(y)))
+        return tiles
+
+
+    def _with_carried(self,dataframe,alerts):
+        """ append the clusters carried forward by run_incremental
+        """
+        carried,carried_alerts=self._carried
+        carried=carried.reindex(columns=dataframe.columns)
+        carried['index']=np.arange(carried.shape[0])+dataframe.shape[0]
+        dataframe=pd.concat([dataframe,carried],ignore_index=True)
+        for column in resp.CATEGORICAL_COLUMNS:
+            dataframe[column]=dataframe[column].astype(str).astype('category')
+        self._carried=None
+        return dataframe, RaggedAlerts.concatenate([alerts,carried_alerts])
 
 
     def _error_row(self,error,response):
@@ -790,17 +1677,141 @@ class ClusterService(object):
         x=response.get('x')
         y=response.get('y')
         if (z and x and y):
-            lon=ClusterService.lon(int(z),int(x),int(y),128,128)
-            lat=ClusterService.lat(int(z),int(x),int(y),128,128)
+            lon,lat=proj.lonlat(int(z),int(x),int(y),128,128)
         else:
             lon,lat=None,None
         return [z,x,y,lon,lat,error,error_trace]
 
 
+    def _rows(self,rows,full):
+        df=self.dataframe(full=True).iloc[rows]
+        if full:
+            return df
+        else:
+            return df[_view_columns(df.columns)]
+
+
+    def _pg_copy_chunks(self,chunk_size=PG_COPY_CHUNK_SIZE):
+        """ COPY text-format chunks of sql.COPY_COLUMNS
+        
+            multipoint is hex EWKB of [longitude,latitude,days-since] points
+        """
+        df=self.dataframe(full=True)
+        for start in range(0,df.shape[0],chunk_size):
+            rows=np.arange(start,min(start+chunk_size,df.shape[0]))
+            alerts=self.alerts().take(rows)
+            chunk=df.iloc[rows]
+            chunk=chunk.assign(
+                alerts=sql.array_literals(alerts.data,alerts.offsets),
+                date_range=self._date_ranges(chunk),
+                parameters=self.parameters(),
+                multipoint=ewkb.multipoints_z(
+                    self.alert_coordinates(rows),
+                    alerts.offsets))
+            yield chunk[sql.COPY_COLUMNS].to_csv(
+                None,sep='\t',header=False,index=False)
+
+
+    def _date_ranges(self,dataframe):
+        """ date-range key for each row (the window for multi-window runs)
+        """
+        if WINDOW_COLUMN in dataframe.columns:
+            return dataframe[WINDOW_COLUMN].astype(str).values
+        return self.date_range()
+
+
+    def _pg_tile_chunks(self):
+        """ COPY text-format chunk of sql.TILE_COLUMNS for the tiles in request
+
+            tiles with errors or abandoned by run are left out: they have 
+            no rows in the dataframe, so upsert_data would otherwise delete
+            their existing rows
+        """
+        failed=self._failed_tiles()
+        xys=np.array(
+            [xy for xy in self.tiles() if tuple(xy) not in failed],
+            dtype=int).reshape(-1,2)
+        if self.windows:
+            date_ranges=[DATE_RANGE_TMPL.format(*w) for w in self.windows]
+        else:
+            date_ranges=[self.date_range()]
+        tiles=pd.DataFrame({
+            'z': self.z,
+            'x': np.tile(xys[:,0],len(date_ranges)),
+            'y': np.tile(xys[:,1],len(date_ranges)),
+            'date_range': np.repeat(date_ranges,xys.shape[0]),
+            'parameters': self.parameters() },columns=sql.TILE_COLUMNS)
+        yield tiles.to_csv(None,sep='\t',header=False,index=False)
+
+
+    def _failed_tiles(self):
+        """ (x,y) of tiles with errors or abandoned by run
+        """
+        tiles=set(self._abandoned)
+        errors=self.errors()
+        if errors is not None:
+            for x,y in zip(errors.x.values,errors.y.values):
+                if pd.notnull(x) and pd.notnull(y):
+                    tiles.add((int(x),int(y)))
+        return tiles
+
+
+    def _footprint_dataframe(self,concave=None):
+        """ dataframe(full=True), with footprint columns if concave is set
+        """
+        dataframe=self.dataframe(full=True)
+        if concave:
+            areas,coords,offsets=self.footprints(concave)
+            dataframe=dataframe.assign(
+                concave_area=areas.round().astype(int),
+                footprint=ewkb.polygons(coords,offsets))
+        return dataframe
+
+
+    def _save_columnar(self,filename,local,bucket,errors,format,compress,concave=None):
+        path="{}.{}".format(filename,format)
+        dataframe=self._footprint_dataframe(concave)
+        if local:
+            storage.write(path,dataframe,format,compress,self.alerts())
+            if errors and self.errors().shape[0]:
+                self.errors().to_csv(
+                    "{}.errors.csv".format(filename),
+                    index=None)
+        else:
+            obj=boto3.resource('s3').Object(bucket or self.bucket,path)
+            obj.put(Body=storage.to_bytes(
+                dataframe,format,compress,self.alerts()))
+            obj.Acl().put(ACL=CSV_ACL)
+            if errors and self.errors().shape[0]:
+                obj=boto3.resource('s3').Object(
+                    bucket or self.bucket,
+                    "{}.errors.csv".format(filename))
+                obj.put(Body=self.errors().to_csv(None,index=None))
+                obj.Acl().put(ACL=CSV_ACL)
+
+
     def _not_none(self,values):
         test=[ (val is not None) for val in values ]
         return np.prod(test).astype(bool)
 
+
+def _view_columns(columns):
+    """ VIEW_COLUMNS (plus WINDOW_COLUMN for multi-window runs)
+    """
+    if WINDOW_COLUMN in columns:
+        return VIEW_COLUMNS+[WINDOW_COLUMN]
+    return VIEW_COLUMNS
+
+
+def _seeds(dataframe):
+    """ dict of (x,y): [[i,j],...] cluster modes
+    """
+    seeds={}
+    columns=[dataframe[c].values.astype(int).tolist() for c in ['x','y','i','j']]
+    for x,y,i,j in zip(*columns):
+        seeds.setdefault((x,y),[]).append([i,j])
+    return seeds
+
 #
 # Main
 #
@@ -857,7 +1868,27 @@ def _run(args):
 def _run_service(args):
     service=_print_info(args,True)
     print("\nRUN: {}".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    service.run()
+    if getattr(args, "regional", False):
+        service.run_regional(url=getattr(args, "tile_url", None))
+    elif getattr(args, "hotspots", None) is not None:
+        sample=getattr(args, "hotspot_sample", None)
+        summary=service.run_hotspots(
+            threshold=args.hotspots,
+            sample=hotspots.DEFAULT_SAMPLE if sample is None else sample,
+            url=getattr(args, "tile_url", None))
+        print("\tNB TILES: {nb_tiles} (SELECTED: {nb_selected}, SAMPLED: {nb_sampled})".format(**summary))
+        print("\tINVOCATIONS SAVED: {}".format(summary['nb_invocations_saved']))
+        recall=service.hotspot_recall()
+        if recall is not None:
+            print("\tESTIMATED RECALL: {:.3f}".format(recall))
+    else:
+        service.run()
+    if getattr(args, "stitch", False):
+        print("\tNB STITCHED: {}".format(service.stitch()))
+    if getattr(args, "clip", False):
+        print("\tNB CLIPPED: {}".format(service.clip()))
+    if service.partial_tiles():
+        print("\tPARTIAL TILES: {}".format(service.partial_tiles()))
     nb_clusters,count,area,min_date,max_date=service.summary()
     print("\tNB CLUSTERS: {}".format(nb_clusters))
     print("\tNB ERRORS: {}".format(service.errors().shape[0]))
@@ -884,8 +1915,11 @@ def _export(args):
     service = _run_service(args)
 
     print("EXPORT: {}".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    pg_table = service.export(**kwargs)
-    print("\tpg_table: {}".format(pg_table))
+    output = service.export(**kwargs)
+    if kwargs.get("format", "PG") == "PG":
+        print("\tpg_table: {}".format(output))
+    else:
+        print("\tfilename: {}".format(output))
     print("COMPLETE: {}\n\n".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
 
 
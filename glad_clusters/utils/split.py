@@ -0,0 +1,113 @@
+import numpy as np
+import glad_clusters.clusters.processors as proc
+import glad_clusters.clusters.quadrants as quadrants
+from glad_clusters.clusters.convex_hull import ConvexHull
+from glad_clusters.clusters.concave_hull import ConcaveHull
+import glad_clusters.utils.responses as resp
+
+
+NB_QUADRANTS=quadrants.NB_QUADRANTS
+QUADRANT_KEY='quadrant'
+
+
+#
+# PUBLIC
+#
+def merge(responses,min_count):
+    """ tile response from the (decoded) quadrant responses of a tile
+
+        Each quadrant job only keeps clusters whose mode is on its
+        quadrant, so the clusters are concatenated. Alerts in the overlaps
+        can be assigned to clusters of two quadrants. These are kept in
+        the cluster with the closest mode and clusters that lost alerts
+        have their count/area/dates (and concave hull) recomputed and are
+        dropped if they fall below min_count.
+
+        Args:
+            responses<list>: processed and decoded quadrant responses
+            min_count<int>: MShift min_count
+
+        Returns:
+            processed tile response (the first error response if any
+            quadrant failed). partial if any quadrant is partial. every
+            quadrant reports the alert count of the whole tile, which is
+            kept from the first
+    """
+    responses=[r for r in responses if r]
+    for response in responses:
+        if response.get('error') or response.get('errorMessage'):
+            return _tile_response(response)
+    if not responses:
+        return None
+    clusters=[
+        c for r in responses
+        for c in ((r.get('data') or {}).get('clusters') or [])]
+    clusters=_deduplicated(clusters,min_count,responses[0].get('concave'))
+    merged=_tile_response(responses[0])
+    merged['data']={ 'clusters': clusters }
+    merged['nb_clusters']=len(clusters)
+    merged.pop(resp.PARTIAL_KEY,None)
+    if any(r.get(resp.PARTIAL_KEY) for r in responses):
+        merged[resp.PARTIAL_KEY]=True
+    return merged
+
+
+#
+# INTERNAL
+#
+def _tile_response(response):
+    response=dict(resp.decode(response))
+    response.pop(QUADRANT_KEY,None)
+    return response
+
+
+def _deduplicated(clusters,min_count,concave=None):
+    """ assign shared alerts to the closest mode. repeated until no
+        cluster falls below min_count, so alerts of dropped clusters go
+        back to the remaining ones
+    """
+    while clusters:
+        masks=_closest(clusters)
+        counts=[int(m.sum()) for m in masks]
+        if min(counts)>=min_count:
+            break
+        clusters=[c for c,n in zip(clusters,counts) if n>=min_count]
+    else:
+        return []
+    return [
+        c if m.all() else _updated(c,np.asarray(c['alerts'],dtype=np.int64)[m],concave)
+        for c,m in zip(clusters,masks)]
+
+
+def _closest(clusters):
+    """ mask of the alerts of each cluster that are closer to its mode
+        than to the mode of any other cluster sharing them (per window)
+    """
+    alerts=[np.asarray(c['alerts'],dtype=np.int64).reshape(-1,3) for c in clusters]
+    sizes=np.array([a.shape[0] for a in alerts],dtype=np.int64)
+    data=np.concatenate(alerts)
+    owner=np.repeat(np.arange(len(clusters)),sizes)
+    modes=np.array([[c['i'],c['j']] for c in clusters],dtype=float)
+    windows=np.array([c.get(resp.WINDOW_KEY,0) for c in clusters],dtype=np.int64)
+    distance=np.hypot(data[:,0]-modes[owner,0],data[:,1]-modes[owner,1])
+    order=np.lexsort((distance,data[:,1],data[:,0],windows[owner]))
+    keys=np.column_stack([windows[owner],data[:,0],data[:,1]])[order]
+    is_first=np.ones(order.shape[0],dtype=bool)
+    is_first[1:]=(keys[1:]!=keys[:-1]).any(axis=1)
+    keep=np.zeros(data.shape[0],dtype=bool)
+    keep[order[is_first]]=True
+    return np.split(keep,np.cumsum(sizes)[:-1])
+
+
+def _updated(cluster,alerts,concave=None):
+    cluster=dict(cluster)
+    cluster['count']=int(alerts.shape[0])
+    cluster['area']=int(round(ConvexHull(alerts[:,:-1]).area))
+    cluster['min_date']=proc.date_for_days(int(alerts[:,-1].min()))
+    cluster['max_date']=proc.date_for_days(int(alerts[:,-1].max()))
+    cluster['alerts']=alerts.tolist()
+    if concave and ('concave_hull' in cluster):
+        hull=ConcaveHull(alerts[:,:-1],concave)
+        cluster['concave_area']=int(round(hull.area))
+        cluster['concave_hull']=hull.hull.astype(int).tolist()
+    return cluster
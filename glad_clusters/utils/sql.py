@@ -1,4 +1,15 @@
+import threading
 import psycopg2
+import glad_clusters.utils.multiprocess as mp
+
+
+CONCAVE_BATCH_SIZE = 2000
+CONCAVE_PROCESSES = 4
+
+
+TILE_COLUMNS = ["z", "x", "y", "date_range", "parameters"]
+KEY_COLUMNS = ["z", "x", "y", "i", "j", "date_range", "parameters"]
+SUMMARY_COLUMNS = ["i", "j", "count", "area", "min_date", "max_date"]
 
 
 def table_exists(conn, pg_schema, pg_table, commit=False):
@@ -69,6 +80,8 @@ def create_table(conn, pg_schema, pg_table, commit=False):
                 file_name text,
                 "timestamp" text,
                 alerts integer[],
+                date_range text,
+                parameters text,
                 CONSTRAINT {1}_pkey PRIMARY KEY (index)
                 )
             WITH (
@@ -92,7 +105,12 @@ def create_table(conn, pg_schema, pg_table, commit=False):
                 ON {0}.{1}
                 USING gist
                 (concave);
-    """.format(pg_schema, pg_table)
+
+            CREATE UNIQUE INDEX {1}_key_idx
+                ON {0}.{1}
+                USING btree
+                ({2});
+    """.format(pg_schema, pg_table, ",".join(KEY_COLUMNS))
     cur.execute(sql)
 
     cur.close()
@@ -123,22 +141,88 @@ def delete_data(conn, pg_schema, pg_table, commit=False):
     return
 
 
-def load_data(conn, pg_schema, pg_table, filename, concave, commit=False):
+COPY_COLUMNS = ["index", "count", "area", "min_date", "max_date", "longitude", "latitude",
+                "z", "x", "y", "i", "j", "file_name", "timestamp", "alerts", "date_range",
+                "parameters", "multipoint"]
+
+
+class IteratorFile(object):
+    """ Read-only file-like object over an iterator of strings.
+        Used to stream COPY data to PostgreSQL without a temp file.
+
+        Args:
+            chunks<iterable>: iterator of text chunks
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ""
+
+    def read(self, size=-1):
+        while (size < 0) or (len(self._buffer) < size):
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def array_literals(data, offsets):
+    """ PostgreSQL 2d-array literals ('{{i,j,days},...}') for ragged integer data
+
+        Args:
+            data<array>: (N,k) integer array
+            offsets<array>: (n+1,) offsets, rows for item m are data[offsets[m]:offsets[m+1]]
     """
-    Load data from into selected export table in PostgreSQL database.
-    Make sure required functions exist and update geometries
+    rows = ["{" + ",".join(str(v) for v in row) + "}" for row in data.tolist()]
+    return ["{" + ",".join(rows[s:e]) + "}" for s, e in zip(offsets[:-1], offsets[1:])]
+
+
+def load_data(conn, pg_schema, pg_table, chunks, concave, commit=False, connect=None,
+              **concave_kwargs):
+    """
+    Load data into selected export table in PostgreSQL database
+    and update concave geometries.
+
+    If connect is passed, rows are loaded into a staging table on a new
+    connection where the concave hulls are computed in parallel (see
+    update_concave). The rows are then copied into the table on conn, so
+    the transaction of conn (ie. an overwrite's DELETE) is not committed
+    before the rows and their hulls are in place.
 
         Args:
-            cur<psycopg2.cursor: Database cursor
+            conn<psycopg2.connection>: Database connection
+            pg_schema<string>: Schema name
             pg_table<string>: Table name
-            filename<string>: path and filename of CSV file
+            chunks<iterable>: COPY text-format chunks for COPY_COLUMNS
+                (multipoint geometry as hex EWKB)
+            concave<int>: Target percent of area for concave hull
             commit<boolean(False)>: Make commit after statement
+            connect<func>: Returns a new psycopg2.connection
+            concave_kwargs: update_concave options (processes, batch_size, verbose)
     """
-    _unnest_2d_1d(conn)
-    _sinh(conn)
-    _load_csv(conn, pg_schema, pg_table, filename)
-    _update_multipoint(conn, pg_schema, pg_table)
-    _update_concave(conn, pg_schema, pg_table, concave)
+    if connect is None:
+        copy_data(conn, pg_schema, pg_table, chunks)
+        update_concave(conn, pg_schema, pg_table, concave, **concave_kwargs)
+    else:
+        staging = "{}_load".format(pg_table)
+        staging_conn = connect()
+        try:
+            drop_table(staging_conn, pg_schema, staging, commit=True)
+            create_table(staging_conn, pg_schema, staging, commit=True)
+            copy_data(staging_conn, pg_schema, staging, chunks)
+            update_concave(staging_conn, pg_schema, staging, concave, connect=connect,
+                           commit=True, **concave_kwargs)
+        finally:
+            staging_conn.close()
+        insert_data(conn, pg_schema, pg_table, staging)
+        drop_table(conn, pg_schema, staging)
 
     if commit:
         conn.commit()
@@ -146,23 +230,21 @@ def load_data(conn, pg_schema, pg_table, filename, concave, commit=False):
     return
 
 
-def _unnest_2d_1d(conn, commit=False):
+def insert_data(conn, pg_schema, pg_table, source, commit=False):
+    """ Insert all rows (with concave geometries) of source into table
 
-    cur = conn.cursor()
-    sql = """
-    CREATE OR REPLACE FUNCTION unnest_2d_1d(anyarray)
-        RETURNS SETOF anyarray AS
-            $BODY$
-            SELECT array_agg($1[d1][d2])
-                FROM   generate_subscripts($1,1) d1
-                    ,  generate_subscripts($1,2) d2
-                GROUP  BY d1
-                ORDER  BY d1
-                $BODY$
-        LANGUAGE sql IMMUTABLE
-            COST 100
-            ROWS 1000;
+        Args:
+            conn<psycopg2.connection>: Database connection
+            pg_schema<string>: Schema name
+            pg_table<string>: Table name
+            source<string>: Name of a table created with create_table
+            commit<boolean(False)>: Make commit after statement
     """
+    cur = conn.cursor()
+
+    columns = ",".join('"{}"'.format(c) for c in COPY_COLUMNS + ["concave"])
+    sql = "INSERT INTO {0}.{1} ({3}) SELECT {3} FROM {0}.{2};".format(
+        pg_schema, pg_table, source, columns)
     cur.execute(sql)
 
     cur.close()
@@ -173,38 +255,71 @@ def _unnest_2d_1d(conn, commit=False):
     return
 
 
-def _sinh(conn, commit=False):
+def drop_table(conn, pg_schema, pg_table, commit=False):
+    """ Drop table if it exists
 
+        Args:
+            conn<psycopg2.connection>: Database connection
+            pg_table<string>: Table name
+            commit<boolean(False)>: Make commit after statement
+    """
     cur = conn.cursor()
+    sql = "DROP TABLE IF EXISTS {0}.{1};".format(pg_schema, pg_table)
+    cur.execute(sql)
 
-    sql = """
-    CREATE OR REPLACE FUNCTION sinh(x numeric)
-        RETURNS double precision AS
-        $BODY$
-            BEGIN
-                RETURN (exp(x) - exp(-x))/2;
-            END;
-        $BODY$
-            LANGUAGE plpgsql VOLATILE
-            COST 100;
+    cur.close()
+
+    if commit:
+        conn.commit()
+
+    return
+
+
+def copy_data(conn, pg_schema, pg_table, chunks, columns=COPY_COLUMNS, commit=False):
+    """ Stream rows into table with COPY ... FROM STDIN (text format)
+
+        Args:
+            conn<psycopg2.connection>: Database connection
+            pg_schema<string>: Schema name
+            pg_table<string>: Table name
+            chunks<iterable>: text-format COPY chunks
+            columns<list>: Table columns in chunk order
+            commit<boolean(False)>: Make commit after statement
     """
-    cur.execute(sql)
+    cur = conn.cursor()
+
+    sql = "COPY {0}.{1}({2}) FROM STDIN;".format(
+        pg_schema, pg_table, ",".join('"{}"'.format(c) for c in columns))
+    cur.copy_expert(sql, IteratorFile(chunks))
 
     cur.close()
 
     if commit:
         conn.commit()
+
     return
 
 
-def _load_csv(conn, pg_schema, pg_table, filename, commit=False):
+def ensure_key_columns(conn, pg_schema, pg_table, commit=False):
+    """ Add date_range/parameters columns and the unique key index
+        to export tables created before they existed
 
+        Args:
+            conn<psycopg2.connection>: Database connection
+            pg_schema<string>: Schema name
+            pg_table<string>: Table name
+            commit<boolean(False)>: Make commit after statement
+    """
     cur = conn.cursor()
 
     sql = """
-    COPY {0}.{1}(index,count,area,min_date,max_date,longitude,latitude,z,x,y,i,j,file_name,timestamp,alerts) 
-        FROM '{2}' DELIMITER ',' CSV HEADER;
-    """.format(pg_schema, pg_table, filename)
+        ALTER TABLE {0}.{1} ADD COLUMN IF NOT EXISTS date_range text;
+        ALTER TABLE {0}.{1} ADD COLUMN IF NOT EXISTS parameters text;
+        CREATE UNIQUE INDEX IF NOT EXISTS {1}_key_idx
+            ON {0}.{1}
+            USING btree
+            ({2});
+    """.format(pg_schema, pg_table, ",".join(KEY_COLUMNS))
     cur.execute(sql)
 
     cur.close()
@@ -215,55 +330,214 @@ def _load_csv(conn, pg_schema, pg_table, filename, commit=False):
     return
 
 
-def _update_multipoint(conn, pg_schema, pg_table, commit=False):
+def upsert_data(conn, pg_schema, pg_table, chunks, tile_chunks, concave, commit=False,
+                **concave_kwargs):
+    """
+    Merge data into an existing export table.
 
-    cur = conn.cursor()
+    Rows and the list of tiles that were run are loaded into temporary
+    staging tables. Tiles (keyed on z/x/y/date_range/parameters) whose
+    cluster summaries differ from the existing rows are replaced, all
+    other tiles are left untouched. Concave hulls are only computed for
+    the inserted rows.
+
+        Args:
+            conn<psycopg2.connection>: Database connection
+            pg_schema<string>: Schema name
+            pg_table<string>: Table name
+            chunks<iterable>: COPY text-format chunks for COPY_COLUMNS
+            tile_chunks<iterable>: COPY text-format chunks for TILE_COLUMNS
+            concave<int>: Target percent of area for concave hull
+            commit<boolean(False)>: Make commit after statement
+            concave_kwargs: update_concave options (connect, processes, batch_size, verbose)
+
+        Returns:
+            (number of changed tiles, number of inserted rows)
+    """
+    staging = "{}_staging".format(pg_table)
+    staging_tiles = "{}_staging_tiles".format(pg_table)
 
+    cur = conn.cursor()
     sql = """
-        WITH t AS (SELECT "index" AS id, z, x, y, unnest_2d_1d(alerts) AS alerts FROM {0}.{1})
-        UPDATE {0}.{1}
-            SET multipoint = g.multipoint
-        FROM
-            (SELECT 
-                id, 
-                st_collect(
-                ST_SetSRID(ST_MakePoint(
-                    (360.0/(2^z))*(x+(alerts[2]/256.0))-180.0,
-                    (atan(sinh((pi()*(1-(2*(y+(alerts[1]/256.0))/(2^z))))::numeric))*180.0)/pi(),
-                    alerts[3]),
-                4326)) AS multipoint
-            FROM t
-        GROUP BY id) AS g
-        WHERE "index" = id;
-    """.format(pg_schema, pg_table)
+        CREATE TEMP TABLE {2} (LIKE {0}.{1} INCLUDING DEFAULTS) ON COMMIT DROP;
+        CREATE TEMP TABLE {3} (
+            z integer, x integer, y integer, date_range text, parameters text
+        ) ON COMMIT DROP;
+    """.format(pg_schema, pg_table, staging, staging_tiles)
     cur.execute(sql)
+    cur.close()
+
+    copy_data(conn, "pg_temp", staging, chunks)
+    copy_data(conn, "pg_temp", staging_tiles, tile_chunks, TILE_COLUMNS)
 
+    tile = ",".join(TILE_COLUMNS)
+    summary = "md5(string_agg(concat_ws(',', {0}), ';' ORDER BY i, j))".format(
+        ", ".join(SUMMARY_COLUMNS))
+    columns = ",".join('"{}"'.format(c) for c in COPY_COLUMNS if c != "index")
+
+    cur = conn.cursor()
+    sql = """
+        CREATE TEMP TABLE {2}_changed ON COMMIT DROP AS
+            WITH s AS (
+                SELECT {4}, {5} AS hash FROM {2} GROUP BY {4}
+            ), t AS (
+                SELECT {6}, {5} AS hash
+                FROM {0}.{1} t JOIN {3} r USING ({4})
+                GROUP BY {6}
+            )
+            SELECT {4} FROM s FULL OUTER JOIN t USING ({4})
+            WHERE s.hash IS DISTINCT FROM t.hash;
+
+        DELETE FROM {0}.{1} t
+            USING {2}_changed c
+            WHERE {7};
+
+        INSERT INTO {0}.{1} ("index", {8})
+            SELECT
+                (SELECT coalesce(max("index"), -1) FROM {0}.{1}) + row_number() OVER (),
+                {8}
+            FROM {2} JOIN {2}_changed USING ({4});
+    """.format(
+        pg_schema, pg_table, staging, staging_tiles, tile, summary,
+        ", ".join("t.{}".format(c) for c in TILE_COLUMNS),
+        " AND ".join("t.{0} = c.{0}".format(c) for c in TILE_COLUMNS),
+        columns)
+    cur.execute(sql)
+    inserted = cur.rowcount
+    cur.execute("SELECT count(*) FROM {}_changed".format(staging))
+    changed = cur.fetchone()[0]
     cur.close()
 
+    update_concave(conn, pg_schema, pg_table, concave, only_missing=True, **concave_kwargs)
+
     if commit:
         conn.commit()
-    return
 
+    return changed, inserted
 
-def _update_concave(conn, pg_schema, pg_table, concave, commit=False):
 
+def update_concave(conn, pg_schema, pg_table, concave, only_missing=False,
+                   connect=None, processes=CONCAVE_PROCESSES,
+                   batch_size=CONCAVE_BATCH_SIZE, verbose=True, commit=False):
+    """
+    Update concave geometries in id-range batches.
+
+    Each batch computes ST_ConcaveHull once per row. If connect is passed
+    the current transaction is committed (so rows are visible to other
+    sessions) and batches are distributed over a pool of connections,
+    each batch being committed as it completes.
+
+        Args:
+            conn<psycopg2.connection>: Database connection
+            pg_schema<string>: Schema name
+            pg_table<string>: Table name
+            concave<int>: Target percent of area for concave hull
+            only_missing<boolean(False)>: Only update rows without a concave hull
+            connect<func>: Returns a new psycopg2.connection. If None batches
+                run sequentially on conn
+            processes<int>: Number of connections used
+            batch_size<int>: Number of ids per batch
+            verbose<boolean(True)>: Print progress
+            commit<boolean(False)>: Make commit after statement
+
+        Returns:
+            Number of updated rows
+    """
+    batches = _concave_batches(conn, pg_schema, pg_table, only_missing, batch_size)
+    progress = _Progress(len(batches), verbose)
+
+    if connect and (processes > 1) and (len(batches) > 1):
+        conn.commit()
+        workers = min(processes, len(batches))
+
+        def _update_batches(worker):
+            worker_conn = connect()
+            try:
+                nb_rows = 0
+                for batch in batches[worker::workers]:
+                    nb_rows += _update_concave(
+                        worker_conn, pg_schema, pg_table, concave, batch, only_missing, True)
+                    progress.update()
+                return nb_rows
+            finally:
+                worker_conn.close()
+
+        nb_rows = sum(mp.map_with_threadpool(_update_batches, list(range(workers)), workers))
+    else:
+        nb_rows = 0
+        for batch in batches:
+            nb_rows += _update_concave(conn, pg_schema, pg_table, concave, batch, only_missing)
+            progress.update()
+
+    if commit:
+        conn.commit()
+
+    return nb_rows
+
+
+def _concave_batches(conn, pg_schema, pg_table, only_missing, batch_size):
+    """ [start, end) index ranges covering the rows to update
+    """
     cur = conn.cursor()
 
     sql = """
-    UPDATE {0}.{1}
-        SET concave = 
-        CASE 
-            WHEN ST_GeometryType(ST_ConcaveHull(ST_Force2D(multipoint), {2})) != 'ST_Polygon' THEN
-                St_Buffer(ST_ConcaveHull(ST_Force2D(multipoint), {2})::geography, 15)::geometry
-            ELSE
-                ST_ConcaveHull(ST_Force2D(multipoint), {2})
-            END;
-    """.format(pg_schema, pg_table, concave/100)
+        SELECT min("index"), max("index") FROM {0}.{1} {2};
+    """.format(pg_schema, pg_table, "WHERE concave IS NULL" if only_missing else "")
     cur.execute(sql)
+    min_index, max_index = cur.fetchone()
+
+    cur.close()
+
+    if min_index is None:
+        return []
+    return [(start, min(start + batch_size, max_index + 1))
+            for start in range(min_index, max_index + 1, batch_size)]
+
+
+def _update_concave(conn, pg_schema, pg_table, concave, batch, only_missing=False, commit=False):
+
+    cur = conn.cursor()
+
+    sql = """
+    UPDATE {0}.{1} AS t
+        SET concave =
+        CASE
+            WHEN ST_GeometryType(h.hull) != 'ST_Polygon' THEN
+                St_Buffer(h.hull::geography, 15)::geometry
+            ELSE
+                h.hull
+            END
+    FROM (
+        SELECT "index", ST_ConcaveHull(ST_Force2D(multipoint), {2}) AS hull
+        FROM {0}.{1}
+        WHERE "index" >= %s AND "index" < %s {3}
+    ) AS h
+    WHERE t."index" = h."index";
+    """.format(pg_schema, pg_table, concave/100.0,
+               "AND concave IS NULL" if only_missing else "")
+    cur.execute(sql, batch)
+    nb_rows = cur.rowcount
 
     cur.close()
 
     if commit:
         conn.commit()
 
-    return
+    return nb_rows
+
+
+class _Progress(object):
+    """ thread-safe batch counter printing progress
+    """
+    def __init__(self, total, verbose=True):
+        self.total = total
+        self.verbose = verbose
+        self.done = 0
+        self.lock = threading.Lock()
+        self.step = max(1, total // 20)
+
+    def update(self):
+        with self.lock:
+            self.done += 1
+            if self.verbose and ((self.done % self.step == 0) or (self.done == self.total)):
+                print("\tconcave: {}/{} batches".format(self.done, self.total))
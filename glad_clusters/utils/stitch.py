@@ -0,0 +1,217 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import glad_clusters.utils.projection as proj
+import glad_clusters.clusters.processors as proc
+from glad_clusters.clusters.convex_hull import ConvexHull
+from glad_clusters.utils.alerts import RaggedAlerts, I, J, DAYS
+
+
+TILE_SIZE=int(proj.TILE_SIZE)
+NEIGHBORS=[(dx,dy) for dx in (-1,0,1) for dy in (-1,0,1)]
+
+
+#
+# PUBLIC
+#
+def stitch(dataframe,alerts,distance):
+    """ merge clusters split across tile seams
+
+        Only alerts within distance of a tile edge can be near an alert
+        on another tile. These are hashed into distance-sized cells on
+        global pixel coordinates ((x*256+j,y*256+i)) and compared with
+        alerts in the 3x3 neighboring cells, so the cost is linear in the
+        number of border alerts. Clusters on different tiles with alerts
+        within distance of each other are merged (transitively) into the
+        cluster with the largest count.
+
+        Merged clusters keep the representative's z/x/y, file_name and
+        timestamp. Their alerts are expressed relative to that tile (so
+        pixel values may fall outside [0,256)), count/area/dates are
+        recomputed and i/j/longitude/latitude are the count-weighted mean
+        of the merged clusters' centers.
+
+        Args:
+            dataframe<dataframe>: clusters dataframe (full=True)
+            alerts<RaggedAlerts>: alerts aligned with dataframe rows
+            distance<float>: max pixel distance between stitched alerts
+
+        Returns:
+            dataframe, RaggedAlerts, number of clusters merged away
+    """
+    nb_rows=dataframe.shape[0]
+    if not nb_rows:
+        return dataframe, alerts, 0
+    groups=_groups(dataframe,alerts,distance)
+    representatives=_representatives(groups,dataframe['count'].values)
+    is_merged=representatives!=np.arange(nb_rows)
+    if not is_merged.any():
+        return dataframe, alerts, 0
+    keep=~is_merged
+    alerts=_merged_alerts(dataframe,alerts,representatives)
+    dataframe=_merged_dataframe(dataframe,alerts,representatives)
+    rows=np.nonzero(keep)[0]
+    return (
+        dataframe.iloc[rows].reset_index(drop=True),
+        alerts.take(rows),
+        int(is_merged.sum()))
+
+
+def global_pixels(dataframe,alerts):
+    """ global pixel coordinates for every alert
+
+        Returns:
+            (N,) global x (x*256+j), (N,) global y (y*256+i)
+    """
+    rows=alerts.row_ids()
+    gx=dataframe.x.values.astype(np.int64)[rows]*TILE_SIZE+alerts.data[:,J]
+    gy=dataframe.y.values.astype(np.int64)[rows]*TILE_SIZE+alerts.data[:,I]
+    return gx, gy
+
+
+#
+# INTERNAL
+#
+def _groups(dataframe,alerts,distance):
+    """ connected component label for each cluster
+    """
+    nb_rows=dataframe.shape[0]
+    gx,gy=global_pixels(dataframe,alerts)
+    cluster=alerts.row_ids()
+    border=_is_border(alerts.data,distance)
+    gx,gy,cluster=gx[border],gy[border],cluster[border]
+    first,second=_close_pairs(gx,gy,distance)
+    tiles=_tile_ids(dataframe)
+    first,second=cluster[first],cluster[second]
+    across=tiles[first]!=tiles[second]
+    first,second=first[across],second[across]
+    graph=coo_matrix(
+        (np.ones(first.shape[0],dtype=np.int8),(first,second)),
+        shape=(nb_rows,nb_rows))
+    _,labels=connected_components(graph,directed=False)
+    return labels
+
+
+def _is_border(data,distance):
+    """ mask for alerts within distance of a tile edge
+    """
+    low=distance
+    high=TILE_SIZE-1-distance
+    return (
+        (data[:,I]<=low) | (data[:,I]>=high) |
+        (data[:,J]<=low) | (data[:,J]>=high))
+
+
+def _close_pairs(gx,gy,distance):
+    """ index pairs (first<second) of points within distance
+
+        Points are bucketed in distance-sized cells, so only pairs in
+        neighboring cells are compared.
+    """
+    if not gx.shape[0]:
+        return np.zeros(0,dtype=np.int64), np.zeros(0,dtype=np.int64)
+    size=max(float(distance),1.0)
+    cx=np.floor(gx/size).astype(np.int64)
+    cy=np.floor(gy/size).astype(np.int64)
+    cx-=cx.min()-1
+    cy-=cy.min()-1
+    width=cy.max()+2
+    keys=cx*width+cy
+    order=np.argsort(keys,kind='mergesort')
+    cells,starts,counts=np.unique(keys[order],return_index=True,return_counts=True)
+    firsts,seconds=[],[]
+    for dx,dy in NEIGHBORS:
+        targets=keys+dx*width+dy
+        found=np.searchsorted(cells,targets)
+        found=np.minimum(found,cells.shape[0]-1)
+        hit=cells[found]==targets
+        points=np.nonzero(hit)[0]
+        found=found[hit]
+        nb=counts[found]
+        first=np.repeat(points,nb)
+        offsets=np.repeat(starts[found]-np.cumsum(nb)+nb,nb)+np.arange(nb.sum())
+        second=order[offsets]
+        is_pair=first<second
+        firsts.append(first[is_pair])
+        seconds.append(second[is_pair])
+    first=np.concatenate(firsts)
+    second=np.concatenate(seconds)
+    close=np.hypot(gx[first]-gx[second],gy[first]-gy[second])<=distance
+    return first[close], second[close]
+
+
+def _tile_ids(dataframe):
+    tiles=np.column_stack([
+        dataframe.z.values,
+        dataframe.x.values,
+        dataframe.y.values]).astype(np.int64)
+    _,ids=np.unique(tiles,axis=0,return_inverse=True)
+    return ids.ravel()
+
+
+def _representatives(groups,counts):
+    """ row of the largest (first on ties) cluster in each group
+    """
+    order=np.lexsort((np.arange(groups.shape[0]),-counts,groups))
+    is_first=np.ones(order.shape[0],dtype=bool)
+    is_first[1:]=groups[order][1:]!=groups[order][:-1]
+    firsts=np.zeros(groups.max()+1,dtype=np.int64)
+    firsts[groups[order][is_first]]=order[is_first]
+    return firsts[groups]
+
+
+def _merged_alerts(dataframe,alerts,representatives):
+    """ alerts moved to their representative row and tile
+    """
+    rows=alerts.row_ids()
+    targets=representatives[rows]
+    x=dataframe.x.values.astype(np.int64)
+    y=dataframe.y.values.astype(np.int64)
+    data=alerts.data.copy()
+    data[:,J]+=(x[rows]-x[targets])*TILE_SIZE
+    data[:,I]+=(y[rows]-y[targets])*TILE_SIZE
+    order=np.argsort(targets,kind='mergesort')
+    counts=np.bincount(targets,minlength=len(alerts))
+    return RaggedAlerts.from_counts(data[order],counts)
+
+
+def _merged_dataframe(dataframe,alerts,representatives):
+    """ recompute summary columns for representative rows
+    """
+    dataframe=dataframe.copy()
+    nb_rows=dataframe.shape[0]
+    merged=np.unique(representatives[representatives!=np.arange(nb_rows)])
+    counts=dataframe['count'].values.astype(float)
+    x=dataframe.x.values.astype(np.int64)
+    y=dataframe.y.values.astype(np.int64)
+    gi=y*TILE_SIZE+dataframe.i.values
+    gj=x*TILE_SIZE+dataframe.j.values
+    weights=np.bincount(representatives,weights=counts,minlength=nb_rows)
+    mean_i=np.bincount(representatives,weights=counts*gi,minlength=nb_rows)
+    mean_j=np.bincount(representatives,weights=counts*gj,minlength=nb_rows)
+    i=np.round(mean_i[merged]/weights[merged]).astype(np.int64)-y[merged]*TILE_SIZE
+    j=np.round(mean_j[merged]/weights[merged]).astype(np.int64)-x[merged]*TILE_SIZE
+    lons,lats=proj.lonlat(
+        dataframe.z.values[merged],x[merged],y[merged],i,j)
+    min_days=alerts.reduce(np.minimum,DAYS)[merged]
+    max_days=alerts.reduce(np.maximum,DAYS)[merged]
+    columns=dataframe.columns
+    _set(dataframe,merged,'count',alerts.counts()[merged])
+    _set(dataframe,merged,'area',[
+        int(round(ConvexHull(alerts[int(row)][:,0:2]).area)) for row in merged])
+    _set(dataframe,merged,'min_date',[proc.date_for_days(int(d)) for d in min_days])
+    _set(dataframe,merged,'max_date',[proc.date_for_days(int(d)) for d in max_days])
+    _set(dataframe,merged,'i',i)
+    _set(dataframe,merged,'j',j)
+    _set(dataframe,merged,'longitude',lons)
+    _set(dataframe,merged,'latitude',lats)
+    if 'alerts' in columns:
+        dataframe['alerts']=alerts.to_object_array()
+    return dataframe
+
+
+def _set(dataframe,rows,column,values):
+    if column in dataframe.columns:
+        position=dataframe.columns.get_loc(column)
+        dtype=dataframe[column].dtype
+        dataframe.iloc[rows,position]=np.asarray(values).astype(dtype)
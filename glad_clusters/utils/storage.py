@@ -0,0 +1,215 @@
+import io
+import numpy as np
+import pandas as pd
+from glad_clusters.utils.alerts import RaggedAlerts
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa=None
+    pq=None
+
+
+FORMATS=['csv','npz','parquet']
+COLUMNAR_FORMATS=['npz','parquet']
+ALERTS_COLUMN='alerts'
+ALERTS_DATA='__alerts_data__'
+ALERTS_OFFSETS='__alerts_offsets__'
+COLUMNS_KEY='__columns__'
+STORAGE_DTYPE=np.int16
+ALERTS_WIDTH=3
+DEFAULT_PARQUET_COMPRESSION='snappy'
+
+
+#
+# NPZ
+#
+def write_npz(path,dataframe,compress=True,alerts=None):
+    """ write dataframe to npz
+
+        Summary columns are stored as typed arrays. Alerts are stored
+        as one flat int16 array plus per-cluster offsets.
+
+        Args:
+            path<str|file>: path or file-like object
+            dataframe<dataframe>: clusters dataframe
+            compress<bool[True]>: if true use np.savez_compressed
+            alerts<RaggedAlerts>: 
+                alerts aligned with dataframe rows. if none they are
+                built from the dataframe's alerts column
+    """
+    arrays={}
+    columns=[c for c in dataframe.columns if c!=ALERTS_COLUMN]
+    for column in columns:
+        arrays[column]=_column_array(dataframe[column])
+    alerts=_ragged(dataframe,alerts)
+    if alerts is not None:
+        arrays[ALERTS_DATA]=alerts.data.astype(STORAGE_DTYPE)
+        arrays[ALERTS_OFFSETS]=alerts.offsets
+    arrays[COLUMNS_KEY]=np.array(columns+([ALERTS_COLUMN] if alerts is not None else []))
+    if compress:
+        np.savez_compressed(path,**arrays)
+    else:
+        np.savez(path,**arrays)
+    return path
+
+
+def read_npz(path,columns=None,alerts=True):
+    """ read dataframe from npz
+
+        Only the requested arrays are read from the archive so
+        summaries can be loaded without touching the alerts.
+
+        Args:
+            path<str|file>: path or file-like object
+            columns<list>: columns to read (default all)
+            alerts<bool[True]>: if false skip the alerts column
+    """
+    with np.load(path,allow_pickle=False) as npz:
+        columns=_projection(list(npz[COLUMNS_KEY]),columns,alerts)
+        data={}
+        for column in columns:
+            if column==ALERTS_COLUMN:
+                data[column]=RaggedAlerts(
+                    npz[ALERTS_DATA],
+                    npz[ALERTS_OFFSETS])
+            else:
+                data[column]=npz[column]
+    return _dataframe(data,columns)
+
+
+#
+# PARQUET
+#
+def write_parquet(path,
+        dataframe,
+        compression=DEFAULT_PARQUET_COMPRESSION,
+        alerts=None):
+    """ write dataframe to parquet (requires pyarrow)
+
+        The alerts column is written as a list<fixed_size_list<int16,3>>
+        built directly from the flat alerts array and offsets.
+
+        Args:
+            path<str|file>: path or file-like object
+            dataframe<dataframe>: clusters dataframe
+            compression<str>: parquet compression codec (or None)
+            alerts<RaggedAlerts>: alerts aligned with dataframe rows
+    """
+    _require_pyarrow()
+    arrays=[]
+    names=[]
+    for column in dataframe.columns:
+        if column!=ALERTS_COLUMN:
+            arrays.append(pa.array(_column_array(dataframe[column])))
+            names.append(column)
+    alerts=_ragged(dataframe,alerts)
+    if alerts is not None:
+        points=pa.FixedSizeListArray.from_arrays(
+            pa.array(alerts.data.astype(STORAGE_DTYPE).ravel()),ALERTS_WIDTH)
+        arrays.append(pa.ListArray.from_arrays(
+            pa.array(alerts.offsets.astype(np.int32)),points))
+        names.append(ALERTS_COLUMN)
+    table=pa.Table.from_arrays(arrays,names=names)
+    pq.write_table(table,path,compression=compression)
+    return path
+
+
+def read_parquet(path,columns=None,alerts=True):
+    """ read dataframe from parquet (requires pyarrow)
+
+        Args:
+            path<str|file>: path or file-like object
+            columns<list>: columns to read (default all)
+            alerts<bool[True]>: if false skip the alerts column
+    """
+    _require_pyarrow()
+    pfile=pq.ParquetFile(path)
+    columns=_projection(pfile.schema_arrow.names,columns,alerts)
+    table=pfile.read(columns=columns)
+    data={}
+    for column in columns:
+        if column==ALERTS_COLUMN:
+            arr=table.column(column).combine_chunks()
+            offsets=np.asarray(arr.offsets)
+            values=np.asarray(arr.values.flatten()).astype(STORAGE_DTYPE)
+            values=values.reshape(-1,ALERTS_WIDTH)
+            data[column]=RaggedAlerts(values,offsets-offsets[0])
+        else:
+            data[column]=table.column(column).to_numpy()
+    return _dataframe(data,columns)
+
+
+#
+# DISPATCH
+#
+def write(path,dataframe,fmt,compress=True,alerts=None):
+    """ write dataframe in a columnar format ('npz' or 'parquet')
+    """
+    if fmt=='npz':
+        return write_npz(path,dataframe,compress,alerts)
+    elif fmt=='parquet':
+        compression=DEFAULT_PARQUET_COMPRESSION if compress else None
+        return write_parquet(path,dataframe,compression,alerts)
+    else:
+        raise ValueError('Unsupported columnar format: {}'.format(fmt))
+
+
+def read(path,fmt,columns=None,alerts=True):
+    """ read dataframe from a columnar format ('npz' or 'parquet')
+    """
+    if fmt=='npz':
+        return read_npz(path,columns,alerts)
+    elif fmt=='parquet':
+        return read_parquet(path,columns,alerts)
+    else:
+        raise ValueError('Unsupported columnar format: {}'.format(fmt))
+
+
+def to_bytes(dataframe,fmt,compress=True,alerts=None):
+    """ serialize dataframe to bytes in a columnar format
+    """
+    buf=io.BytesIO()
+    write(buf,dataframe,fmt,compress,alerts)
+    return buf.getvalue()
+
+
+#
+# INTERNAL
+#
+def _column_array(series):
+    if series.dtype.kind=='O':
+        return np.array(series.astype(str).tolist())
+    return series.values
+
+
+def _projection(available,columns,alerts):
+    if columns is None:
+        columns=available
+    columns=[c for c in columns if c in available]
+    if not alerts:
+        columns=[c for c in columns if c!=ALERTS_COLUMN]
+    return columns
+
+
+def _ragged(dataframe,alerts):
+    if (alerts is None) and (ALERTS_COLUMN in dataframe.columns):
+        alerts=RaggedAlerts.from_arrays(dataframe[ALERTS_COLUMN])
+    return alerts
+
+
+def _dataframe(data,columns):
+    df=pd.DataFrame({c: data[c] for c in columns if c!=ALERTS_COLUMN},
+        columns=[c for c in columns if c!=ALERTS_COLUMN])
+    for column in df.columns:
+        if df[column].dtype.kind=='U':
+            df[column]=df[column].astype(object)
+    if ALERTS_COLUMN in columns:
+        df[ALERTS_COLUMN]=data[ALERTS_COLUMN].to_object_array()
+        df=df[columns]
+    return df
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError('pyarrow is required for parquet storage')
@@ -0,0 +1,19 @@
+import glad_clusters.utils.multiprocess as mp
+from glad_clusters.utils.batch import BatchQueue
+from test_service import _service, _response
+
+
+def test_failed_run_reports_errors(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION','us-east-1')
+    service=_service(12)
+    def _imap(func,tiles,**kwargs):
+        yield _response(service,*tiles[0])
+        raise RuntimeError('pool died')
+    monkeypatch.setattr(mp,'imap_with_threadpool',_imap)
+    queue=BatchQueue()
+    queue.add(service)
+    queue.run()
+    assert service.dataframe().shape[0]==1
+    errors=service.errors()
+    assert sorted(zip(errors.x,errors.y))==[(11,20),(12,20)]
+    assert errors.error.str.contains('pool died').all()
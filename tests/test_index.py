@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+from glad_clusters.utils.index import ClusterIndex
+
+
+def _dataframe(lons,lats):
+    n=len(lons)
+    return pd.DataFrame({
+        'z': [12]*n,
+        'x': list(range(n)),
+        'y': [0]*n,
+        'i': [0]*n,
+        'j': [0]*n,
+        'longitude': lons,
+        'latitude': lats })
+
+
+def test_nearest_k_larger_than_size():
+    index=ClusterIndex(_dataframe([0.0,1.0,2.0],[0.0,0.0,0.0]))
+    lons=np.array([0.1,1.1,2.1,0.9,1.9])
+    dist,rows=index.nearest(lons,np.zeros(5),k=5)
+    assert dist.shape==(5,5)
+    assert rows.shape==(5,5)
+    assert rows[:,0].tolist()==[0,1,2,1,2]
+    assert np.isfinite(dist[:,:3]).all()
+    assert np.isinf(dist[:,3:]).all()
+    assert (rows[:,3:]==index.size).all()
+
+
+def test_nearest_single_cluster_keeps_k_axis():
+    index=ClusterIndex(_dataframe([0.0],[0.0]))
+    dist,rows=index.nearest(np.array([0.1,0.2]),np.zeros(2),k=3)
+    assert dist.shape==(2,3)
+    assert rows[:,0].tolist()==[0,0]
+    assert (rows[:,1:]==1).all()
+    dist,rows=index.nearest(0.1,0.0,k=1)
+    assert np.isscalar(dist) and rows==0
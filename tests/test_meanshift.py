@@ -0,0 +1,26 @@
+import numpy as np
+from glad_clusters.clusters.meanshift import MShift
+
+
+def _runs():
+    # previous run: a single block of alerts. new alerts arrive next to it
+    data=np.zeros((256,256))
+    data[100:107,100:107]=10
+    previous=MShift(data,width=5,min_count=6)
+    seeds=[[int(i),int(j)] for i,j,_ in previous.clusters()]
+    data[100:107,112:119]=20
+    full=MShift(data,width=5,min_count=6)
+    seeded=MShift(data,width=5,min_count=6,seeds=seeds)
+    approximate=MShift(data,width=5,min_count=6,seeds=seeds,approximate=True)
+    return full, seeded, approximate
+
+
+def test_seeded_run_equals_full_run():
+    full,seeded,_=_runs()
+    assert np.array_equal(seeded.clustered_data(),full.clustered_data())
+    assert seeded.clusters().tolist()==full.clusters().tolist()
+
+
+def test_approximate_seeded_run_can_differ():
+    full,_,approximate=_runs()
+    assert approximate.clusters().tolist()!=full.clusters().tolist()
@@ -0,0 +1,37 @@
+import numpy as np
+from glad_clusters.clusters.meanshift import MShift
+import glad_clusters.utils.projection as proj
+
+
+def _cluster_data():
+    data=np.zeros((256,256))
+    data[38:43,190:215]=100
+    mshift=MShift(data,width=5,min_count=6,iterations=10)
+    clusters=mshift.clusters_data()['clusters']
+    assert len(clusters)==1
+    return clusters[0]
+
+
+def test_centroid_lies_among_alert_points():
+    cluster=_cluster_data()
+    alerts=np.array(cluster['alerts'])
+    lon,lat=proj.lonlat(12,1355,2045,cluster['i'],cluster['j'])
+    lons,lats=proj.alerts_lonlat(12,1355,2045,alerts)
+    assert lons.min()<=lon<=lons.max()
+    assert lats.min()<=lat<=lats.max()
+
+
+def test_alerts_lonlat_matches_lonlat():
+    alerts=np.array([[10,200,5],[250,3,7]])
+    lons,lats=proj.alerts_lonlat(12,1355,2045,alerts)
+    expected=proj.lonlat(12,1355,2045,alerts[:,0],alerts[:,1])
+    assert np.allclose(lons,expected[0])
+    assert np.allclose(lats,expected[1])
+
+
+def test_j_runs_east_and_i_runs_south():
+    lon_0,lat_0=proj.lonlat(12,1355,2045,0,0)
+    lon_j,lat_j=proj.lonlat(12,1355,2045,0,255)
+    lon_i,lat_i=proj.lonlat(12,1355,2045,255,0)
+    assert (lon_j>lon_0) and (lat_j==lat_0)
+    assert (lat_i<lat_0) and (lon_i==lon_0)
@@ -0,0 +1,111 @@
+import os
+import numpy as np
+import pytest
+import psycopg2
+from glad_clusters.clusters.meanshift import MShift
+from glad_clusters.utils.service import ClusterService
+from glad_clusters.utils.schedule import RuntimeHistory
+import glad_clusters.utils.responses as resp
+
+PG_DBNAME=os.environ.get('GLAD_TEST_PG_DBNAME')
+PG_ARGS={
+    'pg_dbname': PG_DBNAME,
+    'pg_user': os.environ.get('GLAD_TEST_PG_USER'),
+    'pg_password': os.environ.get('GLAD_TEST_PG_PASSWORD'),
+    'pg_host': os.environ.get('GLAD_TEST_PG_HOST','localhost') }
+PG_TABLE='test_upsert_failed_tiles'
+needs_pg=pytest.mark.skipif(not PG_DBNAME,reason='GLAD_TEST_PG_DBNAME not set')
+
+
+def _service(x_max):
+    return ClusterService(
+        tile_bounds=[[10,20],[x_max,20]],
+        start_date='2017-01-01',
+        end_date='2017-06-01',
+        min_count=6)
+
+
+def _response(service,x,y,offset=0):
+    data=np.zeros((256,256))
+    data[40+offset:50+offset,60:70]=100
+    response=service._request_data(x,y,as_dict=True)
+    response['data']=MShift(data,width=5,min_count=6,iterations=5).clusters_data()
+    response['nb_clusters']=response['data'].pop('nb_clusters')
+    return response
+
+
+def _history_service(tmp_path):
+    service=_service(11)
+    service.history=RuntimeHistory(path=str(tmp_path.joinpath('runtimes.json')))
+    service.split_count=500
+    service._runtimes={ (10,20): 1.0, (11,20): 1.0 }
+    return service
+
+
+def _tiles(service):
+    chunk=''.join(service._pg_tile_chunks())
+    return set(tuple(int(v) for v in line.split('\t')[1:3]) for line in chunk.splitlines())
+
+
+def test_upsert_tiles_skip_failed_tiles():
+    service=_service(12)
+    service.load_responses([
+        service._error_response(10,20,'lambda failed','service.2')])
+    service._abandoned.add((11,20))
+    assert _tiles(service)=={(12,20)}
+
+
+def test_upsert_tiles_without_errors():
+    service=_service(11)
+    service.load_responses([_response(service,10,20)])
+    assert service.dataframe().shape[0]==1
+    assert _tiles(service)=={(10,20),(11,20)}
+
+
+@needs_pg
+def test_upsert_keeps_rows_of_failed_tiles():
+    first=_service(11)
+    first.load_responses([_response(first,10,20),_response(first,11,20)])
+    first.export(pg_table=PG_TABLE,overwrite=True,**PG_ARGS)
+    second=_service(11)
+    second.load_responses([
+        second._error_response(10,20,'lambda failed','service.2'),
+        _response(second,11,20,offset=100)])
+    second.export(pg_table=PG_TABLE,upsert=True,**PG_ARGS)
+    conn=psycopg2.connect(
+        database=PG_ARGS['pg_dbname'],
+        user=PG_ARGS['pg_user'],
+        password=PG_ARGS['pg_password'],
+        host=PG_ARGS['pg_host'])
+    try:
+        cur=conn.cursor()
+        cur.execute('SELECT x, i FROM public.{} ORDER BY x'.format(PG_TABLE))
+        rows=cur.fetchall()
+        cur.execute('DROP TABLE public.{}'.format(PG_TABLE))
+        conn.commit()
+    finally:
+        conn.close()
+    assert [x for x,_ in rows]==[10,11]
+    assert rows[1][1]==second.dataframe().i.values[0]
+
+
+def test_history_counts_unclustered_alerts(tmp_path):
+    service=_history_service(tmp_path)
+    noisy=_response(service,10,20)
+    noisy[resp.NB_ALERTS_KEY]=1000
+    service.responses=[noisy,_response(service,11,20)]
+    service._update_history()
+    assert service.history.count(service.z,10,20,service.parameter_key())==1000
+    assert service._is_dense(10,20)
+    assert not service._is_dense(11,20)
+
+
+def test_history_counts_raw_payloads(tmp_path):
+    service=_history_service(tmp_path)
+    service.decode_processes=2
+    service.responses=[
+        { 'x': 10, 'y': 20, resp.PAYLOAD_KEY: b'{"nb_alerts": 1000, "data": {"clusters": []}}' },
+        { 'x': 11, 'y': 20, resp.PAYLOAD_KEY: '{"data": {"clusters": []}}' }]
+    service._update_history()
+    assert service._is_dense(10,20)
+    assert service._history_tiles==[(11,20)]
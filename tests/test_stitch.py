@@ -0,0 +1,54 @@
+import numpy as np
+from glad_clusters.clusters.meanshift import MShift
+from glad_clusters.utils.service import ClusterService
+import glad_clusters.utils.projection as proj
+
+
+def _response(service,x,y,rows,cols):
+    data=np.zeros((256,256))
+    data[rows,cols]=100
+    response=service._request_data(x,y,as_dict=True)
+    response['data']=MShift(data,width=5,min_count=6,iterations=10).clusters_data()
+    response['nb_clusters']=response['data'].pop('nb_clusters')
+    return response
+
+
+def test_stitch_across_x_seam():
+    # one cluster split across the seam of tiles x=10 and x=11: j (the
+    # column) is along x, so it is at the end of tile 10's j axis and the
+    # start of tile 11's. i is away from the tile edges so a transposed
+    # i/j would not merge it
+    service=ClusterService(
+        tile_bounds=[[10,20],[11,20]],
+        start_date='2017-01-01',
+        end_date='2017-06-01',
+        min_count=6)
+    service.load_responses([
+        _response(service,10,20,slice(28,36),slice(250,256)),
+        _response(service,11,20,slice(28,36),slice(0,6))])
+    assert service.dataframe().shape[0]==2
+    assert service.stitch(distance=5)==1
+    df=service.dataframe(full=True)
+    alerts=service.alerts()
+    assert df.shape[0]==1
+    row=df.iloc[0]
+    assert (row.x,row.y)==(10,20)
+    assert row['count']==96
+    assert 28<=row.i<=35
+    assert abs(row.j-256)<=1
+    lons,lats=proj.alerts_lonlat(row.z,row.x,row.y,alerts[0])
+    assert lons.min()<=row.longitude<=lons.max()
+    assert lats.min()<=row.latitude<=lats.max()
+
+
+def test_no_stitch_across_y_seam_for_x_border():
+    # alerts on the x seam side of vertically adjacent tiles are far apart
+    service=ClusterService(
+        tile_bounds=[[10,20],[10,21]],
+        start_date='2017-01-01',
+        end_date='2017-06-01',
+        min_count=6)
+    service.load_responses([
+        _response(service,10,20,slice(28,36),slice(250,256)),
+        _response(service,10,21,slice(28,36),slice(0,6))])
+    assert service.stitch(distance=5)==0